@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Compare the streaming per-pixel quantiles of dark_quantiles.py with keeping
+every frame and calling np.percentile, on synthetic darks with stray photons.
+"""
+
+import argparse
+import time
+import numpy as np
+
+from dark_quantiles import QuantileHist
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_dark_quantiles.py', description='benchmark the streaming per-pixel quantiles')
+    parser.add_argument('-n', '--frames', type=str, default = '1000,10000,100000', \
+                        help="comma separated numbers of frames to test")
+    parser.add_argument('-p', '--pixels', type=int, default = 1000, \
+                        help="number of pixels (the memory of the exact method is frames x pixels x 2 bytes)")
+    parser.add_argument('-w', '--half_width', type=int, default = 32, \
+                        help="half width of the histogram window in adus")
+    parser.add_argument('-b', '--buffer_size', type=int, default = 500, \
+                        help="number of frames per buffer")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_cmdline_args()
+    qs   = [5, 50, 95]
+    rng  = np.random.RandomState(0)
+    # dark offsets, gaussian noise of 5 adus and 1% of values with a 30 adu photon
+    offset = rng.normal(1000., 50., args.pixels)
+
+    print 'pixels:', args.pixels, 'half width:', args.half_width, 'percentiles:', qs
+    print '{0:>8} {1:>12} {2:>12} {3:>10} {4:>10} {5:>12} {6:>10} {7:>10}'.format( \
+          'frames', 'exact MB', 'stream MB', 'exact s', 'stream s', 'identical', 'max error', 'mean bias')
+    for n in [int(i) for i in args.frames.split(',')]:
+        frames  = offset + rng.normal(0., 5., (n, args.pixels))
+        frames += 30. * (rng.random_sample(frames.shape) < 0.01)
+        frames  = np.rint(frames).astype(np.int16)
+
+        t0    = time.time()
+        exact = np.percentile(frames, qs, axis=0, interpolation='lower')
+        t_exact = time.time() - t0
+
+        t0   = time.time()
+        ref  = np.rint(np.median(frames[: args.buffer_size], axis=0)).astype(np.int16)
+        hist = QuantileHist(ref, args.half_width)
+        for i in range(0, n, args.buffer_size):
+            hist.add_buffer(frames[i : i + args.buffer_size])
+        values, outside = hist.quantiles(qs)
+        t_stream = time.time() - t0
+
+        identical = np.mean([np.mean(v == e) for v, e in zip(values, exact)])
+        error     = np.max([np.max(np.abs(v - e)) for v, e in zip(values, exact)])
+        # how far the mean is pulled up by the photons compared to the median
+        bias      = np.mean(np.mean(frames, axis=0) - values[1])
+        print '{0:8d} {1:12.1f} {2:12.3f} {3:10.2f} {4:10.2f} {5:11.1f}% {6:10.1f} {7:10.2f}'.format( \
+              n, frames.nbytes / 1024.**2, hist.nbytes() / 1024.**2, t_exact, t_stream, 100 * identical, error, bias)
+        del frames
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Time the dark statistics (dark_stats.DarkStats, [params] stats = True)
+against the plain int64 sum of darkcal.py on a buffer of synthetic frames
+(see utils/event_source.py), and print the memory of each per pixel.
+"""
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+from dark_stats import DarkStats
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import synthetic_frames, detector_shapes
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_dark_stats.py', description='benchmark the dark statistics')
+    parser.add_argument('-n', '--frames', type=int, default = 32, \
+                        help="number of frames in the buffer")
+    parser.add_argument('-d', '--detector', type=str, default = 'cspad', \
+                        help="cspad, pnccd or opal")
+    parser.add_argument('-r', '--repeats', type=int, default = 3, \
+                        help="the best of this many runs is shown")
+    return parser.parse_args()
+
+def best_time(f, repeats):
+    ts = []
+    for i in range(repeats):
+        t0 = time.time()
+        f()
+        ts.append(time.time() - t0)
+    return min(ts)
+
+if __name__ == '__main__':
+    args   = parse_cmdline_args()
+    shape, dtype = detector_shapes[args.detector]
+    frames = synthetic_frames(shape, dtype)
+    buffer = np.array([frames[i % len(frames)] for i in range(args.frames)])
+
+    im_sum = np.zeros(shape, dtype=np.int64)
+    def add_sum():
+        for frame in buffer :
+            im_sum[...] += frame
+    stats  = DarkStats(buffer[0])
+
+    t_sum   = best_time(add_sum, args.repeats) / args.frames
+    t_stats = best_time(lambda : stats.add_buffer(buffer), args.repeats) / args.frames
+    nbytes  = sum([getattr(stats, name).itemsize for name in ['ref', 'sum', 'sum2', 'min', 'max']])
+
+    print 'detector:', args.detector, shape, np.dtype(dtype).name
+    print '{0:>8} {1:>10} {2:>12}'.format('', 'ms/frame', 'bytes/pixel')
+    print '{0:>8} {1:10.2f} {2:12d}'.format('sum', 1e3 * t_sum, im_sum.itemsize)
+    print '{0:>8} {1:10.2f} {2:12d}'.format('stats', 1e3 * t_stats, nbytes)
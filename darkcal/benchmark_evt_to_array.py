@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Time the old evt_to_array of darkcal.py (a new stacked array every event,
+the detector kind found by try / except) against writing every event
+straight into a preallocated buffer or into the sum (utils/detector.py),
+on the synthetic psana stand-in (utils/event_source.py).
+"""
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import open_source, psana_obj_from_string, detector_types
+from detector import detector_kind, frame_shape, fill_frame, add_frame
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_evt_to_array.py', description='benchmark the frame assembly of darkcal.py')
+    parser.add_argument('-n', '--events', type=int, default = 500, \
+                        help="number of events")
+    parser.add_argument('-d', '--detector', type=str, default = 'cspad', \
+                        help="cspad, pnccd or opal")
+    parser.add_argument('-b', '--buffer_size', type=int, default = 32, \
+                        help="number of frames per buffer")
+    return parser.parse_args()
+
+def new_array(a, *owners):
+    """1 if a is a new array (it shares no memory with any of the owners, the preallocated arrays), else 0."""
+    return int(not any([np.may_share_memory(a, o) for o in owners]))
+
+def evt_to_array_old(im):
+    try :
+        # cspad
+        im_np = np.array([im.quads(j).data() for j in range(im.quads_shape()[0])])
+    except :
+        try :
+            # pnccds
+            im_np = np.array([im.frame(j).data() for j in range(im.frame_shape()[0])])
+        except :
+            # opal
+            im_np = im.data16()
+    return im_np
+
+if __name__ == '__main__':
+    args = parse_cmdline_args()
+    psana, ds = open_source('synthetic:detector=' + args.detector + ':events=' + str(args.events))
+    det_type  = psana_obj_from_string('psana.' + detector_types[args.detector].name, psana)
+    det_src   = psana.Source('DetInfo(Standin.0)')
+    run   = ds.runs().next()
+    times = run.times()
+    ims   = [run.event(t).get(det_type, det_src) for t in times]
+
+    # old: a new array per event, accumulated straight away
+    im_sum  = None
+    allocs  = 0
+    t0 = time.time()
+    for im in ims :
+        im_np = evt_to_array_old(im)
+        # the data16 of an opal is psana's own array, anything else is new
+        allocs += im_np.flags.owndata and im_np is not im.data16()
+        if im_sum is None :
+            im_sum = im_np.astype(np.int64)
+            allocs += 1
+        else :
+            im_sum += im_np
+    t_old   = time.time() - t0
+    sum_old = im_sum
+
+    # buffered: the kind once, then every event into a reusable buffer
+    # (the buffer and the sum are the only arrays, counted once)
+    t0 = time.time()
+    kind = detector_kind(ims[0])
+    shape, dtype = frame_shape(ims[0], kind)
+    buffer = np.empty((args.buffer_size,) + shape, dtype=dtype)
+    im_sum = np.zeros(shape, dtype=np.int64)
+    allocs_buf = 2
+    j = 0
+    for im in ims :
+        allocs_buf += new_array(fill_frame(im, kind, buffer[j]), buffer)
+        j += 1
+        if j == args.buffer_size :
+            for b in buffer :
+                im_sum += b
+            j = 0
+    for b in buffer[:j] :
+        im_sum += b
+    t_buf   = time.time() - t0
+    sum_buf = im_sum
+
+    # direct: every event added straight into the sum
+    t0 = time.time()
+    kind = detector_kind(ims[0])
+    shape, dtype = frame_shape(ims[0], kind)
+    im_sum = np.zeros(shape, dtype=np.int64)
+    allocs_direct = 1
+    for im in ims :
+        allocs_direct += new_array(add_frame(im, kind, im_sum), im_sum)
+    t_direct = time.time() - t0
+
+    print 'detector:', kind, shape, dtype, 'events:', len(ims)
+    print 'identical sums                 :', np.array_equal(sum_old, sum_buf) and np.array_equal(sum_old, im_sum)
+    print 'frame arrays allocated / event : old {0:.3f}  buffered {1:.3f}  direct {2:.3f}'.format( \
+          allocs / float(len(ims)), allocs_buf / float(len(ims)), allocs_direct / float(len(ims)))
+    print 'time / event (ms)              : old {0:.2f}  buffered {1:.2f}  direct {2:.2f}'.format( \
+          1e3 * t_old / len(ims), 1e3 * t_buf / len(ims), 1e3 * t_direct / len(ims))
@@ -0,0 +1,142 @@
+"""
+Per-pixel median and percentile darks in a single pass.
+
+The dark values of a pixel are integer adus spread over a few tens of adus,
+so rather than keeping every frame each pixel keeps a histogram of its
+values with one bin per adu, in a window around a reference frame ref (the
+same frame on every rank, e.g. the first frame of the run):
+
+    bins:  [below]  ref-half_width, ..., ref+half_width-1  [above]
+
+Values outside of the window are only counted (in 'below' and 'above').
+Any quantile of a pixel then follows from the cumulative counts, exactly
+(the nearest rank, like np.percentile(..., interpolation='lower')) as long
+as it falls inside of the window. Stray photons and cosmics only add counts
+to the tails, so the median is not biased by them the way the mean is.
+
+The memory is (2 half_width + 2) counts per pixel whatever the number of
+frames: with half_width = 32 and uint16 counts that is 300 MB for a CsPad.
+The counts are promoted to uint32 before they could overflow (more than
+65535 frames). Histograms with the same ref are merged by adding the
+counts, so the ranks are merged with one mpi Reduce.
+"""
+
+import numpy as np
+
+class QuantileHist(object):
+    """Accumulate per-pixel adu histograms in a window around ref.
+
+    Args:
+        ref (numpy.ndarray): a raw (integer) frame, the same on every rank.
+        half_width (int): the window is [ref - half_width, ref + half_width).
+        pixels_per_chunk (int): the number of pixels processed at a time.
+    """
+    def __init__(self, ref, half_width = 32, pixels_per_chunk = 1024):
+        self.shape  = ref.shape
+        self.lo     = ref.astype(np.int32).reshape(-1) - half_width
+        self.half_width = half_width
+        self.width  = 2 * half_width
+        self.n      = 0
+        # bin 0 counts the values below the window and bin width + 1 those above
+        self.counts = np.zeros((self.lo.shape[0], self.width + 2), dtype=np.uint16)
+        self.pixels_per_chunk = pixels_per_chunk
+
+    def promote(self, dtype):
+        if np.dtype(dtype).itemsize > self.counts.dtype.itemsize :
+            self.counts = self.counts.astype(dtype)
+
+    def add_buffer(self, buffer):
+        """Add a buffer of raw frames of shape (frames,) + ref.shape."""
+        if self.n + buffer.shape[0] > np.iinfo(self.counts.dtype).max :
+            self.promote(np.uint32)
+
+        frames = buffer.reshape((buffer.shape[0], -1))
+        nbins  = self.width + 2
+        npix   = self.pixels_per_chunk
+        i      = np.empty((frames.shape[0], npix), dtype=np.int32)
+        # the offset of each pixels histogram in the flat counts
+        offset = np.arange(npix, dtype=np.int32) * nbins
+        for p in range(0, frames.shape[1], npix):
+            q  = slice(p, p + npix)
+            b  = frames[:, q]
+            m  = b.shape[1]
+            iq = i[:, : m]
+            # the bin of each value, clipped to the below / above bins
+            np.subtract(b, self.lo[q] - 1, out = iq)
+            np.clip(iq, 0, nbins - 1, out = iq)
+            iq += offset[: m]
+            h  = np.bincount(iq.ravel(), minlength = m * nbins).reshape((m, nbins))
+            np.add(self.counts[q], h, out = self.counts[q], casting = 'unsafe')
+        self.n += buffer.shape[0]
+
+    def reduce(self, comm, root = 0):
+        """Add the histograms of every rank in comm onto the root rank (collective)."""
+        from mpi4py import MPI
+        self.n = comm.allreduce(self.n, op=MPI.SUM)
+        if self.n > np.iinfo(np.uint16).max :
+            self.promote(np.uint32)
+        if comm.Get_rank() == root :
+            comm.Reduce(MPI.IN_PLACE, self.counts, op=MPI.SUM, root=root)
+        else :
+            comm.Reduce(self.counts, None, op=MPI.SUM, root=root)
+        return self
+
+    def merge(self, other):
+        """Add the histograms of another QuantileHist (with the same ref and half_width) to these."""
+        if other.half_width != self.half_width or not np.array_equal(other.lo, self.lo) :
+            raise ValueError('the histogram windows differ, cannot merge the histograms')
+        self.n += other.n
+        if self.n > np.iinfo(self.counts.dtype).max :
+            self.promote(np.uint32)
+        np.add(self.counts, other.counts, out = self.counts, casting = 'unsafe')
+        return self
+
+    def quantiles(self, qs):
+        """Return the per-pixel percentiles qs (0 --> 100) and the fraction of pixels outside of the window.
+
+        Returns:
+            values (list of numpy.ndarray): one array of the detector shape
+                (float64) for each percentile.
+            outside (list of float): for each percentile, the fraction of
+                pixels whose percentile was below or above the window (their
+                value is the window edge, so increase half_width if these
+                are not small).
+        """
+        values  = [np.empty(self.lo.shape, dtype=np.float64) for q in qs]
+        outside = [0 for q in qs]
+        nbins   = self.width + 2
+        for p in range(0, self.lo.shape[0], self.pixels_per_chunk):
+            q   = slice(p, p + self.pixels_per_chunk)
+            cdf = np.cumsum(self.counts[q], axis=1, dtype=np.int64)
+            for k, quantile in enumerate(qs):
+                # the nearest rank (counting from 0)
+                rank = int(np.floor(quantile / 100. * (self.n - 1)))
+                b    = np.argmax(cdf > rank, axis=1)
+                outside[k] += np.sum(b == 0) + np.sum(b == nbins - 1)
+                values[k][q] = self.lo[q] + np.clip(b, 1, nbins - 2) - 1
+        values  = [v.reshape(self.shape) for v in values]
+        outside = [o / float(self.lo.shape[0]) for o in outside]
+        return values, outside
+
+    def write_state(self, f, h5path):
+        """Write the ref, n and counts into the h5 group f[h5path] (for checkpoints)."""
+        g = f.create_group(h5path)
+        g.attrs['n'] = self.n
+        g.attrs['half_width'] = self.half_width
+        g.create_dataset('ref', data = (self.lo + self.half_width).reshape(self.shape))
+        g.create_dataset('counts', data = self.counts)
+
+    def add_state(self, f, h5path):
+        """Add the histograms written by write_state (with the same ref and half_width) to these."""
+        g = f[h5path]
+        if g.attrs['half_width'] != self.half_width or \
+           not np.array_equal(g['ref'][()].reshape(-1) - self.half_width, self.lo) :
+            raise ValueError('the histogram window in ' + f.filename + ' differs from this one, cannot merge the histograms')
+        self.n += int(g.attrs['n'])
+        if self.n > np.iinfo(self.counts.dtype).max :
+            self.promote(np.uint32)
+        np.add(self.counts, g['counts'][()], out = self.counts, casting = 'unsafe')
+        return self
+
+    def nbytes(self):
+        return self.counts.nbytes + self.lo.nbytes
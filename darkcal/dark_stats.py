@@ -0,0 +1,149 @@
+"""
+Per-pixel dark statistics in a single pass.
+
+The sum, mean, variance, min and max of every pixel are accumulated from
+buffers of raw frames, merged over the mpi ranks and turned into a mask of
+hot, dead and noisy pixels.
+
+The variance is computed from sums of (frame - ref) and (frame - ref)**2,
+where ref is one frame that every rank has (e.g. the first frame of the
+run). The detector counts are integers, so these sums are kept in int64 and
+are exact (no rounding error builds up, unlike a running float mean), and
+the shift by ref keeps them small, so that
+
+    variance = (sum2 - sum**2 / n) / (n - 1)
+
+does not lose precision either. Exact sums can also simply be added over the
+ranks with one mpi Reduce, and sum + n * ref is the raw sum of the frames.
+
+The buffer is processed a few thousand pixels at a time (all frames of
+those pixels), so that every statistic is computed while the pixels are
+still in the cpu cache. Within a buffer the sums are taken in float64
+(quicker than int64 in numpy and still exact, the sum of the squares of a
+buffer of 16 bit deviations is far below 2**53) and then added to the int64
+sums.
+
+The statistics take 22 bytes per pixel (the int64 sums, and ref, min and
+max in the detector data type) and about 10 ms of cpu per CsPad frame,
+against 8 bytes and about 2.3 ms for the plain int64 sum (see the Readme).
+"""
+
+import numpy as np
+
+class DarkStats(object):
+    """Accumulate per-pixel dark statistics.
+
+    Args:
+        ref (numpy.ndarray): a raw (integer) frame, the same on every rank.
+        pixels_per_chunk (int): the number of pixels processed at a time.
+    """
+    def __init__(self, ref, pixels_per_chunk = 4096):
+        if ref.dtype.kind not in 'iu' :
+            raise ValueError('the dark statistics need integer frames, not ' + str(ref.dtype))
+        self.ref   = ref.copy()
+        self.n     = 0
+        self.sum   = np.zeros(ref.shape, dtype=np.int64)
+        self.sum2  = np.zeros(ref.shape, dtype=np.int64)
+        # the min and max start at the limits of the data type (not ref, which
+        # need not be one of the frames e.g. when runs are accumulated apart)
+        info       = np.iinfo(ref.dtype)
+        self.min   = np.full(ref.shape, info.max, dtype=ref.dtype)
+        self.max   = np.full(ref.shape, info.min, dtype=ref.dtype)
+        self.pixels_per_chunk = pixels_per_chunk
+
+    def add_buffer(self, buffer):
+        """Add a buffer of raw frames of shape (frames,) + ref.shape."""
+        frames = buffer.reshape((buffer.shape[0], -1))
+        ref    = self.ref.reshape(-1)
+        s, s2  = self.sum.reshape(-1), self.sum2.reshape(-1)
+        mn, mx = self.min.reshape(-1), self.max.reshape(-1)
+        d      = np.empty((frames.shape[0], self.pixels_per_chunk), dtype=np.float64)
+        for p in range(0, frames.shape[1], self.pixels_per_chunk):
+            q  = slice(p, p + self.pixels_per_chunk)
+            b  = frames[:, q]
+            dq = d[:, : b.shape[1]]
+            np.subtract(b, ref[q], out = dq, dtype = np.float64)
+            s[q]  += np.sum(dq, axis=0).astype(np.int64)
+            s2[q] += np.einsum('ij,ij->j', dq, dq).astype(np.int64)
+            np.minimum(mn[q], np.min(b, axis=0), out = mn[q])
+            np.maximum(mx[q], np.max(b, axis=0), out = mx[q])
+        self.n += buffer.shape[0]
+
+    def reduce(self, comm, root = 0):
+        """Merge the statistics of every rank in comm onto the root rank (collective)."""
+        from mpi4py import MPI
+        self.n = comm.reduce(self.n, op=MPI.SUM, root=root)
+        for name, op in [('sum', MPI.SUM), ('sum2', MPI.SUM), ('min', MPI.MIN), ('max', MPI.MAX)]:
+            a = getattr(self, name)
+            if comm.Get_rank() == root :
+                comm.Reduce(MPI.IN_PLACE, a, op=op, root=root)
+            else :
+                comm.Reduce(a, None, op=op, root=root)
+        return self
+
+    def merge(self, other):
+        """Add the statistics of another DarkStats (with the same ref) to these."""
+        if not np.array_equal(other.ref, self.ref) :
+            raise ValueError('the reference frames differ, cannot merge the statistics')
+        self.n    += other.n
+        self.sum  += other.sum
+        self.sum2 += other.sum2
+        np.minimum(self.min, other.min, out = self.min)
+        np.maximum(self.max, other.max, out = self.max)
+        return self
+
+    def total(self):
+        """The raw sum of all frames (what darkcal.py has always written)."""
+        return self.sum + self.n * self.ref.astype(np.int64)
+
+    def mean(self):
+        return self.ref + self.sum / float(max(self.n, 1))
+
+    def variance(self):
+        """The unbiased (n - 1) per-pixel variance."""
+        if self.n < 2 :
+            return np.zeros(self.sum.shape, dtype=np.float64)
+        s = self.sum.astype(np.float64)
+        v = (self.sum2 - s * s / self.n) / (self.n - 1)
+        return np.clip(v, 0, None)
+
+    def write_state(self, f, h5path):
+        """Write everything needed to carry on accumulating into the h5 group f[h5path] (for checkpoints)."""
+        g = f.create_group(h5path)
+        g.attrs['n'] = self.n
+        g.create_dataset('ref', data = self.ref)
+        for name in ['sum', 'sum2', 'min', 'max']:
+            g.create_dataset(name, data = getattr(self, name))
+
+    def add_state(self, f, h5path):
+        """Add the statistics written by write_state (with the same ref) to these."""
+        g = f[h5path]
+        if not np.array_equal(g['ref'][()], self.ref) :
+            raise ValueError('the reference frame in ' + f.filename + ' differs from this one, cannot merge the statistics')
+        self.n += int(g.attrs['n'])
+        self.sum  += g['sum'][()].astype(np.int64)
+        self.sum2 += g['sum2'][()].astype(np.int64)
+        np.minimum(self.min, g['min'][()], out = self.min)
+        np.maximum(self.max, g['max'][()], out = self.max)
+        return self
+
+def pixel_mask(mean, variance, hot_sigma = 6., noisy_factor = 4., dead_factor = 0.1):
+    """Return a mask that is True for good pixels and False for bad ones.
+
+    A pixel is bad if it is
+        hot   : its mean is more than hot_sigma (robust) standard deviations
+                above the median mean of the detector.
+        noisy : its standard deviation is more than noisy_factor times the
+                median standard deviation.
+        dead  : its standard deviation is less than dead_factor times the
+                median standard deviation (including pixels that never change).
+    """
+    sigma  = np.sqrt(variance)
+    med    = np.median(mean)
+    # median absolute deviation, scaled to a standard deviation for normal noise
+    spread = 1.4826 * np.median(np.abs(mean - med))
+    sigma_med = np.median(sigma)
+    hot    = mean > med + hot_sigma * max(spread, 1e-12)
+    noisy  = sigma > noisy_factor * sigma_med
+    dead   = sigma <= dead_factor * sigma_med
+    return ~(hot | noisy | dead)
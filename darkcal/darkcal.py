@@ -4,14 +4,30 @@ import sys
 import os
 import argparse
 import ConfigParser
+import itertools
 import numpy as np
 
+from dark_stats import DarkStats, pixel_mask
+from dark_quantiles import QuantileHist
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from prefetch import Prefetcher
+from event_source import open_source, exp_run, psana_obj_from_string, run_label, first_event
+from detector import detector_kind, frame_shape, fill_frame, add_frame
+from geometry import native_geometry
+from scheduler import SharedCounter, dynamic_chunks, report_load
+from checkpoint import Checkpoint, checkpoint_files, resume, remove_stale
+
 def parse_cmdline_args():
     parser = argparse.ArgumentParser(prog = 'mpirun -np [NUM] [OPTIONS] darkcal.py', description='calculate the raw sum of all frames in a run')
     parser.add_argument('-c', '--config', type=str, \
                         help="file name of the configuration file")
     parser.add_argument('-s', '--source', type=str, \
                 help="psana source string (e.g exp=cxi01516:run=10:idx)")
+    parser.add_argument('-r', '--resume', action='store_true', \
+                        help="carry on from the checkpoints of an earlier job with the same output file (skipping its events), e.g. to add runs")
+    parser.add_argument('-k', '--keep', action='store_true', \
+                        help="keep the merged accumulators in a checkpoint after the output is written, so that runs can be added later with --resume")
     args = parser.parse_args()
 
     # check that args.ini exists
@@ -73,23 +89,123 @@ def parse_parameters(config):
 
     return monitor_params
 
-def psana_obj_from_string(name):
-    """Converts a string into a psana object type.
-    
-    Takes a string and returns the python object type described by the string.
+class RunDark(object):
+    """The accumulators of the frames of one run (or of several, once merged).
 
     Args:
-        name (str): a string describing a python type.
-    
-    Returns:
-        mod (type): the python type described by the string.
+        ref (numpy.ndarray): the reference frame of the statistics.
+        stats (bool): accumulate DarkStats, otherwise only the int64 sum.
+        qref (numpy.ndarray): the centre of the quantile histogram windows
+            (None for no quantiles).
+        half_width (int): the half width of the quantile windows.
     """
-    
-    components = name.split('.')
-    mod = __import__(components[0])
-    for comp in components[1:]:
-        mod = getattr(mod, comp)
-    return mod
+    def __init__(self, ref, stats = False, qref = None, half_width = 32):
+        self.ref, self.stats, self.qref, self.half_width = ref, stats, qref, half_width
+        self.dark  = DarkStats(ref) if stats else None
+        self.sum   = None if stats else np.zeros(ref.shape, dtype=np.int64)
+        self.qhist = QuantileHist(qref, half_width) if qref is not None else None
+        self.n     = 0
+
+    def empty(self):
+        """A RunDark with the same references and no frames."""
+        return RunDark(self.ref, self.stats, self.qref, self.half_width)
+
+    def add_event(self, im, kind):
+        """Add the detector data of one event straight into the sum (only without stats and quantiles)."""
+        add_frame(im, kind, self.sum)
+        self.n += 1
+
+    def add_buffer(self, buffer):
+        if self.qhist is not None :
+            self.qhist.add_buffer(buffer)
+        if self.dark is not None :
+            self.dark.add_buffer(buffer)
+        else :
+            for frame in buffer :
+                self.sum += frame
+        self.n += buffer.shape[0]
+
+    def merge(self, other):
+        self.n += other.n
+        if self.dark is not None :
+            self.dark.merge(other.dark)
+        else :
+            self.sum += other.sum
+        if self.qhist is not None :
+            self.qhist.merge(other.qhist)
+        return self
+
+    def write_state(self, f, h5path):
+        """Write the accumulators into the group f[h5path] (for checkpoints)."""
+        g = f.create_group(h5path)
+        g.attrs['n'] = self.n
+        if self.dark is not None :
+            self.dark.write_state(f, h5path + '/dark')
+        else :
+            g.create_dataset('sum', data = self.sum)
+        if self.qhist is not None :
+            self.qhist.write_state(f, h5path + '/quantiles')
+
+    def add_state(self, f, h5path):
+        g = f[h5path]
+        if (self.dark is not None) != ('dark' in g) or (self.qhist is not None) != ('quantiles' in g) :
+            raise ValueError(f.filename + ' was made with other stats / quantiles settings')
+        self.n += int(g.attrs['n'])
+        if self.dark is not None :
+            self.dark.add_state(f, h5path + '/dark')
+        else :
+            self.sum += g['sum'][()]
+        if self.qhist is not None :
+            self.qhist.add_state(f, h5path + '/quantiles')
+
+    def reduce(self, comm, root = 0):
+        """Merge the accumulators of every rank in comm onto the root rank (collective)."""
+        from mpi4py import MPI
+        self.n = comm.reduce(self.n, op=MPI.SUM, root=root)
+        if self.qhist is not None :
+            self.qhist.reduce(comm, root)
+        if self.dark is not None :
+            self.dark.reduce(comm, root)
+        elif comm.Get_rank() == root :
+            comm.Reduce(MPI.IN_PLACE, self.sum, op=MPI.SUM, root=root)
+        else :
+            comm.Reduce(self.sum, None, op=MPI.SUM, root=root)
+        return self
+
+    def write(self, fnam, h5path, percentiles, mask_params, geom = None):
+        """Write the sum, the number of frames, the statistics and quantiles and the slab (if geom) to fnam."""
+        import h5py
+        f = h5py.File(fnam, 'w')
+        f.create_dataset(h5path, data = self.dark.total() if self.dark is not None else self.sum)
+        f.create_dataset('number of frames', data = self.n)
+
+        # mean, variance, min, max and mask next to the sum
+        group = os.path.dirname(h5path)
+        if self.dark is not None :
+            mean     = self.dark.mean()
+            variance = self.dark.variance()
+            mask     = pixel_mask(mean, variance, **mask_params)
+            f.create_dataset(group + '/mean',     data = mean)
+            f.create_dataset(group + '/variance', data = variance)
+            f.create_dataset(group + '/min',      data = self.dark.min)
+            f.create_dataset(group + '/max',      data = self.dark.max)
+            f.create_dataset(group + '/mask',     data = mask)
+            print 'bad pixels:', np.sum(~mask), 'of', mask.size
+
+        # median and percentile darks
+        if self.qhist is not None :
+            values, outside = self.qhist.quantiles(percentiles)
+            for p, v, o in zip(percentiles, values, outside):
+                name = group + ('/median' if p == 50 else '/percentile_' + str(p))
+                if name not in f :
+                    f.create_dataset(name, data = v)
+                    f[name].attrs['fraction outside of window'] = o
+                print name, 'fraction of pixels outside of the window:', o
+
+        # the sum as a 2D image (the CsPad slab or the pnCCD 2x2 image)
+        if geom is not None :
+            f.create_dataset('data/slab', data = geom.to_image(f[h5path][()]))
+        f.close()
 
 if __name__ == "__main__":
     args = parse_cmdline_args()
@@ -107,51 +223,41 @@ if __name__ == "__main__":
         run = params['source']['run']
     else :
         source = args.source
-        exp = source.split('=')[1].split(':')[0]
-        run = source.split('=')[2].split(':')[0]
+        exp, run = exp_run(source)
     
-    import psana
+    psana, ds = open_source(source)
     import h5py
-    ds = psana.DataSource(source)
 
     detector_psana_source = psana.Source(params['source']['detector_psana_source'])
-    detector_psana_type   = psana_obj_from_string(params['source']['detector_psana_type'])
+    detector_psana_type   = psana_obj_from_string(params['source']['detector_psana_type'], psana)
 
-    #im_sum = np.zeros((4, 512, 512), np.int64) # pnccd
-    im_sum = None
+    # all of the runs of the source (e.g. run=139-152), their events are
+    # shared by all of the processes together rather than run by run
+    runs    = list(ds.runs())
+    numbers = [r.run() for r in runs]
+    times   = dict((r.run(), r.times()[: params['params']['maxshots']]) for r in runs)
+    runs    = dict(zip(numbers, runs))
     
-    def evt_to_array(evt):
-        im    = evt.get(detector_psana_type, detector_psana_source)
-        try :
-            # cspad
-            im_np = np.array([im.quads(j).data() for j in range(im.quads_shape()[0])])
-        except :
-            try :
-                # pnccds
-                im_np = np.array([im.frame(j).data() for j in range(im.frame_shape()[0])])
-            except :
-                # opal
-                im_np = im.data16()
-
-        return im_np
-
-    def native_to_slab(im_np, slab_shape = (1480, 1552), native_shape = (4, 8, 185, 388)):
-        im_ij = np.zeros(slab_shape, dtype=im_np.dtype)
-        for i in range(im_np.shape[0]):
-            im_ij[:, i * native_shape[3]: (i+1) * native_shape[3]] = \
-                    im_np[i].reshape((native_shape[1] * native_shape[2], native_shape[3]))
-        return im_ij
+    # worked out from the first event (see utils/detector.py)
+    kind = None
 
+    def evt_to_array(evt, out):
+        """Write the detector data of an event straight into out."""
+        return fill_frame(evt.get(detector_psana_type, detector_psana_source), kind, out)
 
     # output
     import string
-    if params['output']['match'] :
-        h5name = params['output']['fnam']
-        h5name = string.replace(h5name, 'exp', exp)
-        h5name = string.replace(h5name, 'run', 'r' + str(run).zfill(4))
-    else :
+    def run_fnam(label, combined = False):
+        """The output file for the runs in label (see event_source.run_label), fnam-label.h5 if match is False."""
         h5name = params['output']['fnam']
+        if params['output']['match'] :
+            h5name = string.replace(h5name, 'exp', exp)
+            h5name = string.replace(h5name, 'run', label)
+        elif not combined :
+            h5name = os.path.splitext(h5name)[0] + '-' + label + os.path.splitext(h5name)[1]
+        return h5name
 
+    h5name = run_fnam(run_label(numbers), combined = True)
     h5path = params['output']['h5path']
     h5dir  = params['output']['h5dir']
 
@@ -162,46 +268,213 @@ if __name__ == "__main__":
 
     if rank == 0 : print '\nOutputing to :', h5dir + h5name + ':' + h5path
 
-    dropped_events = 0
-    for run in ds.runs():
-        times = run.times()[: params['params']['maxshots']]
-        mylength = len(times) / size
-        mytimes = times[rank*mylength:(rank+1)*mylength]
+    buffer_size    = params['params'].get('buffer_size', 32)
+    chunk_size     = params['params'].get('chunk_size', buffer_size)
+    stats          = params['params'].get('stats', False)
+    quantiles      = params['params'].get('quantiles', False)
+    percentiles    = [50] + list(np.atleast_1d(params['params'].get('percentiles', [])))
+    per_run        = params['params'].get('per_run', False)
+    mask_params    = {'hot_sigma'    : params['params'].get('hot_sigma', 6.), \
+                      'noisy_factor' : params['params'].get('noisy_factor', 4.), \
+                      'dead_factor'  : params['params'].get('dead_factor', 0.1)}
+
+    # checkpoints of the accumulators every checkpoint_interval seconds (see utils/checkpoint.py)
+    fnam                = h5dir + h5name
+    checkpoint_interval = params['params'].get('checkpoint_interval', None)
+    checkpoint          = None
+    if checkpoint_interval is not None or args.resume or args.keep :
+        checkpoint = Checkpoint(fnam, rank, checkpoint_interval)
+    previous    = checkpoint_files(fnam) if args.resume else []
+    done_before = set() # the (run, index) of the events of the earlier job
+    done        = []    # the (run, index) of the events in this ranks accumulators
+
+    def previous_ref(name):
+        """The reference frame of the accumulators of the earlier job (they can only be merged with the same ref)."""
+        f = h5py.File(previous[0], 'r')
+        groups = [g for g in f.keys() if g != 'done']
+        if len(groups) == 0 or name not in f[groups[0]] :
+            raise ValueError(previous[0] + ' has no ' + name + ', was it made with other stats / quantiles settings?')
+        ref = f[groups[0] + '/' + name + '/ref'][()]
+        half_width = f[groups[0] + '/' + name].attrs.get('half_width')
+        f.close()
+        return ref, half_width
+
+    # the first event (of the first run with any) sets the detector kind,
+    # frame shape and data type of the buffers
+    first, t = first_event(numbers, times)
+    run = runs[first]
+    im  = run.event(t).get(detector_psana_type, detector_psana_source)
+    kind = detector_kind(im)
+    shape, dtype = frame_shape(im, kind)
+    if rank == 0 : print 'detector:', kind, shape, dtype
+    # (and is the reference frame of the statistics, the same on every rank)
+    ref = fill_frame(im, kind, np.empty(shape, dtype=dtype))
+    if stats and previous :
+        ref = previous_ref('dark')[0]
+
+    # the histogram windows are centred on the median of the first frames
+    # of rank 0 (rather than one frame, which could have photons in it)
+    qref, half_width = None, params['params'].get('quantile_half_width', 32)
+    if quantiles and previous :
+        qref, half_width = previous_ref('quantiles')
+    elif quantiles :
         if rank == 0 :
-            print 'Number of frames to process:', len(times)
-            print 'Each slave will process ', mylength, ' frames'
-        
-        for i in range(mylength):
+            qref = np.empty((min(buffer_size, len(times[first])),) + shape, dtype=dtype)
+            for i in range(qref.shape[0]):
+                evt_to_array(run.event(times[first][i]), qref[i])
+            qref = np.rint(np.median(qref, axis=0)).astype(dtype)
+        qref = comm.bcast(qref, root=0)
+
+    # one accumulator for all of the runs, or one for each run (per_run = True)
+    # that are added together at the end
+    accs = {}
+    def acc(number):
+        key = number if per_run else 'all'
+        if key not in accs :
+            accs[key] = RunDark(ref, stats, qref, half_width)
+        return accs[key]
+
+    def group_name(key):
+        return 'all' if key == 'all' else 'r' + str(key).zfill(4)
+
+    def write_state(f):
+        f.attrs['per_run'] = per_run
+        for key in sorted(accs.keys()):
+            accs[key].write_state(f, group_name(key))
+
+    def load_state(f):
+        if f.attrs.get('per_run', True) != per_run :
+            raise ValueError(f.filename + ' was made with another per_run setting')
+        for group in f.keys():
+            if group != 'done' :
+                acc(None if group == 'all' else int(group[1:])).add_state(f, group)
+
+    # add the accumulators of the earlier job and save them as this jobs checkpoints
+    if args.resume :
+        done_before, done = resume(comm, fnam, 0, load_state)
+        comm.barrier()
+        checkpoint.save(write_state, done)
+        comm.barrier()
+        if rank == 0 :
+            remove_stale(fnam, size)
+            print 'resuming from', len(previous), 'checkpoint files with', len(done_before), 'events'
+
+    # the events of all of the runs, in order
+    events = [(number, i) for number in numbers for i in range(len(times[number])) if (number, i) not in done_before]
+    if rank == 0 :
+        print 'Number of frames to process:', len(events), 'in', len(numbers), 'runs'
+        print 'Each process takes', chunk_size, 'frames at a time'
+
+    # with only the sum every event is added straight into it (no buffers
+    # and no reader thread), the quickest way when nothing else needs the
+    # frames (see the Readme)
+    direct   = not stats and not quantiles
+
+    # otherwise the chunks are taken from the shared counter while iterating
+    # over the events, that is on the reader thread, which needs
+    # MPI_THREAD_SERIALIZED
+    threaded = MPI.Query_thread() >= MPI.THREAD_SERIALIZED
+    if rank == 0 and not threaded and not direct :
+        print '\nmpi does not allow calls from other threads, the events will be read without overlap'
+
+    # every rank takes chunks of the events not done yet until there are none left
+    counter  = SharedCounter(comm)
+    myevents = (events[i] for start, stop in dynamic_chunks(counter, len(events), chunk_size) for i in range(start, stop))
+
+    t0 = MPI.Wtime()
+    if direct :
+        processed, dropped = 0, 0
+        for e in myevents :
             try :
-                evt        = run.event(mytimes[i])
-                im_np      = evt_to_array(evt)
-                if im_sum is None :
-                    im_sum = im_np.astype(np.int64)
-                else :
-                    im_sum += im_np
-            except Exception as e:
-                print e
-                dropped_events += 1
-            
+                acc(e[0]).add_event(runs[e[0]].event(times[e[0]][e[1]]).get(detector_psana_type, detector_psana_source), kind)
+            except Exception as ex :
+                print ex
+                dropped += 1
+                continue
+            processed += 1
+            done.append(e)
+
+            if checkpoint is not None and checkpoint.due() :
+                checkpoint.save(write_state, done)
+
+            if rank == 0 and processed % buffer_size == 0 :
+                print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} \r'.format(processed, rank, dropped),
+                sys.stdout.flush()
+    else :
+        # read the next buffer on a thread while this one is summed
+        reader = Prefetcher(lambda e, out : evt_to_array(runs[e[0]].event(times[e[0]][e[1]]), out), \
+                            myevents, shape, dtype, buffer_size, threaded = threaded)
+        for buffer, buffer_events in reader:
+            # a buffer can hold the end of one run and the start of the next
+            start = 0
+            for number, group in itertools.groupby(buffer_events, lambda e : e[0]):
+                stop = start + len(list(group))
+                acc(number).add_buffer(buffer[start : stop])
+                start = stop
+            done.extend(buffer_events)
+
+            if checkpoint is not None and checkpoint.due() :
+                checkpoint.save(write_state, done)
+
             if rank == 0:
-                print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} {3} \r'.format(i, rank, dropped_events, evt.get(psana.EventId)),
+                print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} \r'.format(reader.processed + buffer.shape[0], rank, reader.dropped),
                 sys.stdout.flush()
+        processed, dropped = reader.processed, reader.dropped
+    t_busy = MPI.Wtime() - t0
 
-    im_sum_global = np.empty_like(im_sum)
-    comm.Reduce(im_sum, im_sum_global)
+    comm.barrier()
+    counter.free()
     if rank == 0:
-        print ''
-        print ''
-        print 'outputing the global sum...', h5dir, h5name, h5path
+        print '\n', reader.report() if not direct else 'dropped events (rank 0): ' + str(dropped)
 
-        f = h5py.File(h5dir + h5name, 'w')
-        f.create_dataset(h5path, data = im_sum_global)
-        f.create_dataset('number of frames', data = len(times))
-        
-        if params['output']['slab'] :
-            im_slab = native_to_slab(im_sum_global)
-            f.create_dataset('data/slab', data = im_slab)
-         
-        f.close()
+    report_load(comm, processed, t_busy)
 
+    # every rank needs the accumulators of every run for the reduction
+    # (including the runs of an earlier job)
+    for number in sorted(set(itertools.chain(*comm.allgather(accs.keys())))):
+        acc(number).reduce(comm)
+
+    # with --keep leave the merged accumulators in the rank 0 checkpoint, so
+    # that more runs can be added later with --resume
+    if checkpoint is not None and args.keep :
+        all_done = comm.gather(done, root=0)
+        if rank == 0 :
+            checkpoint.save(write_state, [e for d in all_done for e in d])
+        comm.barrier()
+        if rank != 0 :
+            checkpoint.remove()
+    if checkpoint is not None and rank == 0 :
+        print 'time spent on', checkpoint.saves, 'checkpoints: {0:.1f}s ({1:.2%} of the processing time)'.format( \
+              checkpoint.t_saving, checkpoint.t_saving / max(t_busy, 1e-9))
+    
+    if rank == 0:
+        geom = native_geometry(kind, shape) if params['output']['slab'] else None
+
+        # each run on its own (runs without any frames have no accumulators)
+        if per_run and len(accs) > 1 :
+            empty = [number for number in numbers if number not in accs]
+            if len(empty) > 0 :
+                print '\nno frames in runs', empty, '(not written)'
+            for number in numbers :
+                if number in accs :
+                    print '\noutputing run', number, '...', h5dir, run_fnam(run_label(number)), h5path
+                    accs[number].write(h5dir + run_fnam(run_label(number)), h5path, percentiles, mask_params, geom)
+
+        # and all of them together
+        keys = sorted(accs.keys())
+        if len(keys) == 1 :
+            total = accs[keys[0]]
+        else :
+            total = accs[keys[0]].empty()
+            for number in keys :
+                total.merge(accs[number])
+        
+        print ''
+        print ''
+        print 'outputing the global sum of', str(len(accs)) + ' runs...' if per_run else 'all runs...', h5dir, h5name, h5path
+        total.write(h5dir + h5name, h5path, percentiles, mask_params, geom)
 
+    # otherwise the checkpoints are not needed once the output is written
+    comm.barrier()
+    if checkpoint is not None and not args.keep :
+        checkpoint.remove()
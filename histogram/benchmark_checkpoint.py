@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Time the checkpoints of a dense makehist.py histogram (utils/checkpoint.py):
+the save of the hist of one pixel tile, as every process does every
+checkpoint_interval seconds, and the load of it with --resume, and print
+what the saves cost for a few checkpoint intervals.
+
+The hist is written without compression (as in makehist.py), so the time
+is mostly that of the disk. A save returns once the file is in the page
+cache, so the time to get it onto the disk (fsync) is shown as well. On a
+shared file system all of the processes save at about the same time, so
+expect it to be slower there.
+"""
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+from schedule import tile_rows
+from benchmark_h5_writer import synthetic_tile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from checkpoint import Checkpoint
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_checkpoint.py', description='benchmark the checkpoints of a dense histogram')
+    parser.add_argument('-s', '--shape', type=str, default = '4,8,185,388', \
+                        help="detector shape")
+    parser.add_argument('-b', '--bins', type=int, default = 500, \
+                        help="number of adu bins")
+    parser.add_argument('-t', '--pixel_tiles', type=int, default = 4, \
+                        help="number of pixel tiles")
+    parser.add_argument('-d', '--dtype', type=str, default = 'float32', \
+                        help="histogram data type (makehist.py keeps the dense hist in its buffer_dtype)")
+    parser.add_argument('-e', '--events', type=int, default = 100000, \
+                        help="number of (run, index) events in the checkpoint")
+    parser.add_argument('-i', '--intervals', type=str, default = '60,600,3600', \
+                        help="comma separated checkpoint intervals (s)")
+    parser.add_argument('-r', '--repeats', type=int, default = 3, \
+                        help="the best of this many saves is shown")
+    parser.add_argument('-o', '--output', type=str, default = 'benchmark_checkpoint.h5', \
+                        help="output file name (the checkpoint is written next to it and removed at the end)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import h5py
+    args  = parse_cmdline_args()
+    shape = tuple([int(s) for s in args.shape.split(',')])
+    dtype = np.dtype(args.dtype)
+
+    r0, r1 = tile_rows(shape, args.pixel_tiles, 0)
+    hist   = synthetic_tile(np.empty((r1 - r0, shape[-1], args.bins), dtype=dtype), r0)
+    done   = [(1, i) for i in range(args.events)]
+
+    def write_state(f):
+        f.create_dataset('all', data = hist)
+
+    checkpoint = Checkpoint(args.output, 0, None)
+    ts, ts_sync = [], []
+    for i in range(args.repeats):
+        t0 = time.time()
+        checkpoint.save(write_state, done)
+        ts.append(time.time() - t0)
+        fd = os.open(checkpoint.fnam, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+        ts_sync.append(time.time() - t0)
+    t_save, t_sync = min(ts), min(ts_sync)
+
+    # as load_state in makehist.py, a few rows at a time
+    t0 = time.time()
+    f  = h5py.File(checkpoint.fnam, 'r')
+    for i in range(0, hist.shape[0], 64):
+        hist[i : i + 64] += f['all'][i : i + 64]
+    f.close()
+    t_load = time.time() - t0
+    checkpoint.remove()
+
+    print 'dense histogram', shape + (args.bins,), args.dtype, 'in', args.pixel_tiles, \
+          'tiles, checkpoint of one tile: {0:.0f} MB'.format(hist.nbytes / 1024.**2)
+    print 'save (s)         : {0:.2f}'.format(t_save)
+    print 'save + fsync (s) : {0:.2f}'.format(t_sync)
+    print 'load (s)         : {0:.2f}'.format(t_load)
+    print '{0:>13} {1:>18} {2:>18}'.format('interval (s)', 'time saving', 'with fsync')
+    for interval in [float(i) for i in args.intervals.split(',')]:
+        print '{0:13.0f} {1:18.2%} {2:18.2%}'.format(interval, t_save / (interval + t_save), t_sync / (interval + t_sync))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Check the common mode corrections against the original np.median of the
+whole buffer and time them on a synthetic buffer. The median is np.median a
+frame at a time, so expect about the same time (less memory, not speed).
+"""
+
+import argparse
+import time
+import numpy as np
+
+from common_mode import common_mode
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_common_mode.py', description='benchmark the common mode corrections')
+    parser.add_argument('-n', '--frames', type=int, default = 100, \
+                        help="number of frames in the buffer")
+    parser.add_argument('-s', '--shape', type=str, default = '8,185,388', \
+                        help="pixel shape of the buffer (e.g. 8,185,388 for a CsPad quad)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args  = parse_cmdline_args()
+    shape = tuple([int(s) for s in args.shape.split(',')])
+
+    print 'making a synthetic buffer of shape:', (args.frames,) + shape
+    buffer  = np.random.normal(0., 5., (args.frames,) + shape).astype(np.float32)
+    buffer += np.random.normal(0., 20., (args.frames,) + shape[:-1] + (1,)).astype(np.float32)
+
+    # the original
+    b  = buffer.copy()
+    t0 = time.time()
+    medians = np.median(b, axis=-1)
+    b      -= medians[..., np.newaxis]
+    t_orig  = time.time() - t0
+    print 'np.median       : {0:8.3f} s'.format(t_orig)
+
+    mask = np.zeros(shape, dtype=np.bool)
+    mask[..., ::10] = True
+    asic_width = 194 if shape[-1] % 194 == 0 else shape[-1]
+    for method, kwargs in [('median', {}), ('asic', {'asic_width' : asic_width}), ('masked', {'mask' : mask})]:
+        c  = buffer.copy()
+        t0 = time.time()
+        common_mode(c, method, **kwargs)
+        t  = time.time() - t0
+        print '{0:15} : {1:8.3f} s'.format(method, t),
+        if method == 'median' :
+            print ' speedup: {0:5.1f} identical to np.median: {1}'.format(t_orig / t, np.array_equal(b, c))
+        else :
+            print ''
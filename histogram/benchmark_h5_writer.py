@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Time the writing of synthetic CsPad histograms and measure the peak memory
+of the writing process, for the way makehist.py used to write them (rank 0
+receives every pixel tile and writes them one after the other into a single
+gzip dataset) and for the 'vds' writer of h5_writer.py (every tile root
+writes its own tile file, rank 0 joins them with a virtual dataset).
+
+The tiles are held in buffer_dtype (float32) as in makehist.py. The old
+writer wrote them as they were, the 'vds' writer converts them to
+hist_dtype (uint16). Each writer runs in its own process (without mpi) so
+that its peak memory (ru_maxrss) can be read on its own. For 'vds' the tile roots write at the
+same time in makehist.py, so the write time is that of the slowest tile
+plus the virtual dataset.
+"""
+
+import sys
+import os
+import argparse
+import subprocess
+import resource
+import time
+import numpy as np
+import h5py
+
+from schedule import tile_rows, write_rows
+from h5_writer import write_tile, write_vds, tile_fnam
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_h5_writer.py', description='benchmark the histogram writers')
+    parser.add_argument('-s', '--shape', type=str, default = '4,8,185,388', \
+                        help="detector shape")
+    parser.add_argument('-b', '--bins', type=int, default = 500, \
+                        help="number of adu bins")
+    parser.add_argument('-t', '--pixel_tiles', type=int, default = 4, \
+                        help="number of pixel tiles")
+    parser.add_argument('-d', '--buffer_dtype', type=str, default = 'float32', \
+                        help="data type of the histograms in memory")
+    parser.add_argument('-D', '--hist_dtype', type=str, default = 'uint16', \
+                        help="data type of the 'vds' output")
+    parser.add_argument('-o', '--output', type=str, default = 'benchmark_h5_writer.h5', \
+                        help="output file (and tile files next to it), removed at the end")
+    parser.add_argument('-m', '--mode', type=str, \
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def synthetic_tile(out, row_start, events = 1000):
+    """Fill out (rows, columns, bins) with the histograms of gaussian darks (sigma 5 adus) of events frames."""
+    bins = np.arange(out.shape[-1], dtype=np.float32) - 100
+    rng  = np.random.RandomState(row_start)
+    for r in range(0, out.shape[0], 64):
+        offset = rng.normal(0., 10., out[r : r + 64].shape[:2] + (1,)).astype(np.float32)
+        pdf    = np.exp(-(bins - offset)**2 / (2. * 5.**2)) / (np.sqrt(2. * np.pi) * 5.)
+        out[r : r + 64] = np.rint(events * pdf)
+    return out
+
+def run_gather(args, shape, dtype):
+    """The old makehist.py output: rank 0 has its own tile and receives the others one at a time."""
+    tiles = [tile_rows(shape, args.pixel_tiles, i) for i in range(args.pixel_tiles)]
+    hist  = synthetic_tile(np.empty((tiles[0][1], shape[-1], args.bins), dtype=dtype), 0)
+
+    t = 0.
+    t0   = time.time()
+    f    = h5py.File(args.output, 'w')
+    dset = f.create_dataset('data/data', tuple(shape) + (args.bins,), dtype=dtype, compression='gzip')
+    write_rows(dset, hist, 0)
+    t   += time.time() - t0
+    del hist
+    for r0, r1 in tiles[1:] :
+        # (what comm.Recv would have put there)
+        hist = synthetic_tile(np.empty((r1 - r0, shape[-1], args.bins), dtype=dtype), r0)
+        t0   = time.time()
+        write_rows(dset, hist, r0)
+        t   += time.time() - t0
+        del hist
+    t0 = time.time()
+    f.close()
+    t += time.time() - t0
+    return t
+
+def run_vds(args, shape, dtype):
+    """h5_writer.py 'vds': each tile root writes its tile, rank 0 makes the virtual dataset."""
+    ts = []
+    for i in range(args.pixel_tiles):
+        r0, r1 = tile_rows(shape, args.pixel_tiles, i)
+        hist   = synthetic_tile(np.empty((r1 - r0, shape[-1], args.bins), dtype=dtype), r0)
+        t0     = time.time()
+        write_tile(args.output, i, hist, r0, dtype = args.hist_dtype)
+        ts.append(time.time() - t0)
+        del hist
+    t0 = time.time()
+    write_vds(args.output, 'data/data', shape, args.pixel_tiles, args.bins, np.dtype(args.hist_dtype))
+    return max(ts) + time.time() - t0
+
+def file_size(args):
+    fnams = [args.output] + [tile_fnam(args.output, i) for i in range(args.pixel_tiles)]
+    return sum([os.path.getsize(f) for f in fnams if os.path.exists(f)])
+
+def remove(args):
+    for f in [args.output] + [tile_fnam(args.output, i) for i in range(args.pixel_tiles)]:
+        if os.path.exists(f) :
+            os.remove(f)
+
+if __name__ == '__main__':
+    args  = parse_cmdline_args()
+    shape = tuple([int(s) for s in args.shape.split(',')])
+    dtype = np.dtype(args.buffer_dtype)
+
+    if args.mode is not None :
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t    = run_gather(args, shape, dtype) if args.mode == 'gather' else run_vds(args, shape, dtype)
+        rss  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print t, (rss - rss0) / 1024., file_size(args)
+        remove(args)
+        sys.exit()
+
+    tile_mb = np.prod(shape[:-1]) / args.pixel_tiles * shape[-1] * args.bins * dtype.itemsize / 1024.**2
+    print "histogram {0} {1} in {2} tiles of {3:.0f} MB, written as {4} by 'vds'".format( \
+          shape + (args.bins,), args.buffer_dtype, args.pixel_tiles, tile_mb, args.hist_dtype)
+    print '{0:>28} {1:>15} {2:>17} {3:>15}'.format('writer', 'write time (s)', 'peak memory (MB)', 'file size (MB)')
+    for mode, label in [('gather', 'rank 0 gathers (before)'), ('vds', 'vds (slowest tile root)')]:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--mode', mode] + sys.argv[1:])
+        t, rss, size = [float(v) for v in out.split()]
+        print '{0:>28} {1:15.1f} {2:17.0f} {3:15.0f}'.format(label, t, rss, size / 1024.**2)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Compare the vectorised histogram engine (add_buffer_to_hist) with the
+original pixel by pixel loop on synthetic CsPad quad shaped data.
+"""
+
+import argparse
+import time
+import numpy as np
+
+from hist_engine import add_buffer_to_hist, add_buffer_to_hist_loop
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_hist_engine.py', description='benchmark the per-pixel histogram engine')
+    parser.add_argument('-n', '--frames', type=int, default = 100, \
+                        help="number of frames in the buffer")
+    parser.add_argument('-s', '--shape', type=str, default = '8,185,388', \
+                        help="pixel shape of the buffer (e.g. 8,185,388 for a CsPad quad)")
+    parser.add_argument('-b', '--bins', type=str, default = '-100,400', \
+                        help="adu range of the histogram")
+    return parser.parse_args()
+
+def synthetic_buffer(frames, shape, dark_sigma = 5., photon_adu = 30., photon_rate = 0.1):
+    """gaussian dark noise plus poisson distributed single photon hits"""
+    buffer  = np.random.normal(0., dark_sigma, (frames,) + shape).astype(np.float32)
+    photons = np.random.poisson(photon_rate, (frames,) + shape).astype(np.float32)
+    buffer += photons * photon_adu
+    return buffer
+
+if __name__ == '__main__':
+    args  = parse_cmdline_args()
+    shape = tuple([int(s) for s in args.shape.split(',')])
+    b     = [int(s) for s in args.bins.split(',')]
+    bins  = np.arange(b[0], b[1] + 1, 1).astype(np.int)
+
+    print 'making a synthetic buffer of shape:', (args.frames,) + shape
+    buffer = synthetic_buffer(args.frames, shape)
+
+    hist_loop = np.zeros(shape + bins[:-1].shape, dtype=np.float32)
+    hist_vec  = np.zeros(shape + bins[:-1].shape, dtype=np.float32)
+
+    t0 = time.time()
+    add_buffer_to_hist_loop(buffer, bins, hist_loop)
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    add_buffer_to_hist(buffer, bins, hist_vec)
+    t_vec = time.time() - t0
+
+    print 'pixel loop      : {0:8.3f} s'.format(t_loop)
+    print 'vectorised      : {0:8.3f} s'.format(t_vec)
+    print 'speedup         : {0:8.1f}'.format(t_loop / t_vec)
+    print 'identical output:', np.array_equal(hist_loop, hist_vec)
@@ -0,0 +1,101 @@
+"""
+Common mode corrections for a buffer of detector frames.
+
+All methods work in place on a buffer of shape (frames, rows, columns), one
+small chunk of frames at a time, so that no temporary array is as big as the
+buffer. The method is chosen with [histogram] common_mode in the config file:
+
+    'median' : subtract the median of each row (e.g. a CsPad 2x1 row of 388
+               pixels). This is the same as the original
+                   buffer -= np.median(buffer, axis=-1)[..., np.newaxis]
+               a frame at a time (np.median is already a partial sort).
+    'asic'   : subtract the median of each row of each asic (the row is split
+               into asics of asic_width pixels, see asic_widths, 194 for a
+               CsPad 2x1). Only for the detectors in asic_widths.
+    'masked' : subtract the mean of the masked pixels of each row, e.g. the
+               unbonded pixels of a CsPad that only see the common mode.
+               Rows without masked pixels are left alone.
+    None     : do nothing.
+
+Check the method with check_common_mode when the config file is read, so
+that a wrong one fails before any events are read:
+
+    kwargs = check_common_mode(method, kind, mask)
+    ...
+    common_mode(buffer, method, mask = mask, **kwargs)
+"""
+
+import numpy as np
+
+def median(buffer, frames_per_chunk = 1, **kwargs):
+    """Subtract the median of each row from the buffer (in place)."""
+    for i in range(0, buffer.shape[0], frames_per_chunk):
+        b  = buffer[i : i + frames_per_chunk]
+        b -= np.median(b, axis=-1)[..., np.newaxis]
+    return buffer
+
+def asic(buffer, asic_width = 194, frames_per_chunk = 1, **kwargs):
+    """Subtract the median of each row of each asic from the buffer (in place)."""
+    if buffer.shape[-1] % asic_width != 0 :
+        raise ValueError('the number of columns (' + str(buffer.shape[-1]) + \
+                         ') is not a multiple of asic_width (' + str(asic_width) + ')')
+
+    for i in range(0, buffer.shape[0], frames_per_chunk):
+        # setting the shape (rather than reshape) makes sure that b is still a view
+        b  = buffer[i : i + frames_per_chunk].view()
+        b.shape = b.shape[:-1] + (b.shape[-1] / asic_width, asic_width)
+        b -= np.median(b, axis=-1)[..., np.newaxis]
+    return buffer
+
+def masked(buffer, mask = None, frames_per_chunk = 1, **kwargs):
+    """Subtract the mean of the masked pixels of each row from the buffer (in place).
+
+    mask (numpy.ndarray): boolean array of shape (rows, columns), True for
+    the pixels to estimate the common mode from.
+    """
+    if mask is None :
+        raise ValueError("common_mode = 'masked' needs a mask (common_mode_mask in the config file)")
+
+    m     = mask.reshape(buffer.shape[1:]).astype(buffer.dtype)
+    count = np.sum(m, axis=-1)
+    count[count == 0] = 1
+    m    /= count[..., np.newaxis]
+    for i in range(0, buffer.shape[0], frames_per_chunk):
+        b  = buffer[i : i + frames_per_chunk]
+        b -= np.einsum('f...j,...j->f...', b, m)[..., np.newaxis]
+    return buffer
+
+methods = {'median' : median, 'asic' : asic, 'masked' : masked}
+
+# the width of the asics along the rows of each detector kind (see utils/detector.py)
+asic_widths = {'cspad' : 194}
+
+def _is_none(method):
+    return method is None or method == 'None' or method == 'none'
+
+def check_common_mode(method, kind = None, mask = None):
+    """Raise a ValueError if method can not be used on a detector of this kind (with this mask).
+
+    Returns the extra keyword arguments of common_mode for the detector
+    (the asic_width for 'asic').
+    """
+    if _is_none(method) :
+        return {}
+    if method not in methods :
+        raise ValueError('unknown common_mode: ' + str(method) + ' (use one of ' + str(methods.keys() + [None]) + ')')
+    if method == 'asic' :
+        if kind not in asic_widths :
+            raise ValueError("common_mode = 'asic' needs the asic width of the detector, which is only known for " + \
+                             str(asic_widths.keys()) + ' (not ' + str(kind) + ')')
+        return {'asic_width' : asic_widths[kind]}
+    if method == 'masked' and mask is None :
+        raise ValueError("common_mode = 'masked' needs a mask (common_mode_mask in the config file)")
+    return {}
+
+def common_mode(buffer, method = 'median', **kwargs):
+    """Apply the common mode correction 'method' (see the module doc string) to the buffer in place."""
+    if _is_none(method) :
+        return buffer
+    if method not in methods :
+        raise ValueError('unknown common_mode: ' + str(method) + ' (use one of ' + str(methods.keys()) + ')')
+    return methods[method](buffer, **kwargs)
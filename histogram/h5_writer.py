@@ -0,0 +1,178 @@
+"""
+Write the per-pixel histograms straight from the ranks that own them.
+
+Two writers are available (set by [output] writer in the config file):
+
+    'vds'  : every pixel tile is written to its own file next to the output
+             file (e.g. exp-run-CsPad-histogram-tile001.h5) and rank 0 then
+             makes the output file with a virtual dataset that maps each
+             tile file into the full (4, 8, 185, 388, nbins) array.
+             Needs h5py >= 2.9 (hdf5 >= 1.10). Keep the tile files next to
+             the output file, the virtual dataset refers to them by name.
+
+    'mpio' : all ranks open the output file with parallel hdf5 and every
+             tile root writes its own hyperslab. Needs h5py built with mpi.
+             Parallel hdf5 only allows compression with collective writes,
+             and the tiles are written independently, so this writer does
+             not compress and the dataset is contiguous.
+
+The compressed tiles of 'vds' are chunked to follow the pixel layout: one
+chunk holds every bin of one detector row (e.g. 388 pixels x nbins). With
+compression = None the tiles are contiguous, like the 'mpio' dataset, so
+that photon_counting/pixel_pool.py can memory map them. makehist.py keeps the counts
+in its buffer_dtype (float32) and they are written as hist_dtype (promoted
+to a wider unsigned integer if they would overflow it), converted a few
+rows at a time. check_writer tells whether this h5py can do a writer at
+all, so that makehist.py can fail before it reads any events.
+"""
+
+import os
+import numpy as np
+import h5py
+
+from schedule import tile_rows, row_pieces, write_rows
+
+def tile_fnam(fnam, tile):
+    """The name of the file that holds one pixel tile of fnam."""
+    base, ext = os.path.splitext(fnam)
+    return base + '-tile' + str(tile).zfill(3) + ext
+
+def check_writer(writer):
+    """Raise a ValueError if writer is not 'vds' or 'mpio', or if this h5py cannot do it."""
+    if writer == 'vds' :
+        if not hasattr(h5py, 'VirtualLayout') or h5py.version.hdf5_version_tuple < (1, 10) :
+            raise ValueError("writer = 'vds' needs h5py >= 2.9 and hdf5 >= 1.10 (this is h5py " + h5py.version.version + \
+                             ' with hdf5 ' + h5py.version.hdf5_version + "), use writer = 'mpio'")
+    elif writer == 'mpio' :
+        if not h5py.get_config().mpi :
+            raise ValueError("writer = 'mpio' needs h5py built with mpi support, use writer = 'vds'")
+    else :
+        raise ValueError("unknown writer (should be 'vds' or 'mpio'): " + str(writer))
+
+def count_dtype(dtype, top):
+    """dtype, or a wider unsigned integer type if it cannot hold counts of up to top."""
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui' and top > np.iinfo(dtype).max :
+        dtype = np.dtype(np.uint32 if top <= np.iinfo(np.uint32).max else np.uint64)
+    return dtype
+
+def write_tile(fnam, pixel_tile, hist, row_start, compression = 'gzip', compression_opts = 4, dtype = None):
+    """Write the histogram of one pixel tile (rows, columns, nbins) into its own file (the 'vds' writer), as dtype (default hist.dtype).
+
+    The dataset is chunked by detector row if it is compressed and contiguous otherwise.
+    """
+    chunks = (1,) + hist.shape[1:]
+    dtype  = hist.dtype if dtype is None else np.dtype(dtype)
+    if compression != 'gzip' :
+        compression_opts = None
+    if compression is None :
+        chunks = None
+    f = h5py.File(tile_fnam(fnam, pixel_tile), 'w')
+    dset = f.create_dataset('data', hist.shape, dtype = dtype, chunks = chunks, \
+                            compression = compression, compression_opts = compression_opts)
+    # (converted a few rows at a time rather than copying the whole tile)
+    for i in range(0, hist.shape[0], 64):
+        dset[i : i + 64] = hist[i : i + 64].astype(dtype)
+    dset.attrs['row_start'] = row_start
+    f.close()
+
+def write_vds(fnam, h5path, shape, pixel_tiles, nbins, dtype):
+    """Make fnam:h5path a virtual dataset of shape + (nbins,) that joins the tile files of write_tile."""
+    layout = h5py.VirtualLayout(shape = tuple(shape) + (nbins,), dtype = dtype)
+    for i in range(pixel_tiles):
+        r0, r1  = tile_rows(shape, pixel_tiles, i)
+        vsource = h5py.VirtualSource(os.path.basename(tile_fnam(fnam, i)), 'data', \
+                                     shape = (r1 - r0, shape[-1], nbins))
+        for index, i0, i1 in row_pieces(shape, r0, r1 - r0):
+            layout[index] = vsource[i0 : i1]
+
+    f = h5py.File(fnam, 'w')
+    f.create_virtual_dataset(h5path, layout, fillvalue = 0)
+    f.close()
+
+def write_hist(comm, fnam, h5path, hist, pixel_tile, pixel_tiles, shape, is_writer, \
+               writer = 'vds', compression = 'gzip', compression_opts = 4, dtype = None):
+    """Write the histograms of every pixel tile into fnam:h5path.
+
+    Must be called by every rank in comm.
+
+    Args:
+        comm (mpi4py.MPI.Comm): the communicator of all ranks.
+        fnam (str): the output file name.
+        h5path (str): the dataset in the output file.
+        hist (numpy.ndarray): this ranks histogram of shape (rows, columns, nbins).
+        pixel_tile (int): the pixel tile of this rank.
+        pixel_tiles (int): the total number of pixel tiles.
+        shape (tuple): the detector shape e.g. (4, 8, 185, 388).
+        is_writer (bool): True for the one rank that writes each pixel tile.
+        writer ('vds' or 'mpio'): see the module doc string.
+        compression (str or None): h5py compression filter e.g. 'gzip' or 'lzf'.
+        compression_opts (int or None): the compression level (for gzip).
+        dtype (numpy.dtype or None): the data type of the output, promoted
+            to a wider unsigned integer if the counts of any tile would
+            overflow it (default hist.dtype).
+
+    Returns:
+        t (float): the time spent writing on this rank in seconds.
+    """
+    from mpi4py import MPI
+    rank  = comm.Get_rank()
+    full_shape = tuple(shape) + hist.shape[-1:]
+    row_start  = tile_rows(shape, pixel_tiles, pixel_tile)[0]
+    check_writer(writer)
+
+    t0 = MPI.Wtime()
+    # every tile is written with the same dtype (only the writers hold counts)
+    if dtype is None :
+        dtype = hist.dtype
+    else :
+        top   = comm.allreduce(float(hist.max()) if is_writer and hist.size > 0 else 0., op = MPI.MAX)
+        dtype = count_dtype(dtype, top)
+
+    if writer == 'vds' :
+        if is_writer :
+            write_tile(fnam, pixel_tile, hist, row_start, compression, compression_opts, dtype)
+
+        comm.barrier()
+        if rank == 0 :
+            write_vds(fnam, h5path, shape, pixel_tiles, hist.shape[-1], dtype)
+
+    else :
+        f = h5py.File(fnam, 'w', driver = 'mpio', comm = comm)
+        dset = f.create_dataset(h5path, full_shape, dtype = dtype)
+        if is_writer :
+            for i in range(0, hist.shape[0], 64):
+                write_rows(dset, hist[i : i + 64].astype(dtype), row_start + i)
+        f.close()
+
+    return MPI.Wtime() - t0
+
+def write_sparse_hist(comm, fnam, h5path, hist, pixel_tile, pixel_tiles, shape, is_writer):
+    """Write the WindowedHist of every pixel tile into the group fnam:h5path.
+
+    The windowed histograms are small so rank 0 collects them one tile at a
+    time (in tile order, which keeps the spill keys sorted) and writes them
+    into a single file. Must be called by every rank in comm.
+
+    Returns:
+        t (float): the time spent writing on this rank in seconds.
+    """
+    from mpi4py import MPI
+    rank = comm.Get_rank()
+    npix = int(np.prod(shape))
+
+    t0 = MPI.Wtime()
+    # the tile roots are the ranks 0 --> pixel_tiles-1 (see schedule.py)
+    dtypes = comm.gather(hist.window.dtype.str if is_writer else None, root=0)
+    if rank == 0 :
+        count_dtype = max([np.dtype(d) for d in dtypes if d is not None], key = lambda d : d.itemsize)
+        f = h5py.File(fnam, 'w')
+        for i in range(pixel_tiles):
+            h = hist if i == 0 else comm.recv(source = i, tag = i)
+            r0, r1 = tile_rows(shape, pixel_tiles, i)
+            h.write(f, h5path, shape = shape, pixel_offset = r0 * shape[-1], npix = npix, count_dtype = count_dtype)
+            del h
+        f.close()
+    elif is_writer :
+        comm.send(hist, dest = 0, tag = pixel_tile)
+    return MPI.Wtime() - t0
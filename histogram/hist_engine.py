@@ -0,0 +1,78 @@
+"""
+Add a buffer of detector frames to a per-pixel adu histogram.
+
+The buffer has shape (frames,) + pixel shape, e.g. (buffer_size, 8, 185, 388)
+for a CsPad quad, and the histogram has shape pixel shape + (bins-1,).
+
+Rather than looping over every pixel in python, each frame value is turned
+into a flat index into the histogram:
+    pixel_index * nbins + adu_bin
+and the whole thing is counted with np.bincount. To keep the temporary
+index arrays (and the bincount output) in cache the pixels are processed in
+tiles of 'pixels_per_chunk', which is still one vectorised pass per tile
+rather than one per pixel.
+"""
+
+import numpy as np
+
+def add_buffer_to_hist(buffer, bins, hist, pixels_per_chunk = 512):
+    """Add the rounded adu values of every frame in buffer to hist.
+
+    Args:
+        buffer (numpy.ndarray): frames to histogram, shape (N,) + pixel shape.
+        bins (numpy.ndarray): the integer bin edges (the adu range is bins[0] --> bins[-1]).
+        hist (numpy.ndarray): the histogram to add to (in place), shape pixel shape + (len(bins)-1,).
+        pixels_per_chunk (int): number of pixels to count in each bincount pass.
+
+    Returns:
+        hist (numpy.ndarray): the same array that was passed in.
+    """
+    nbins   = bins.shape[0] - 1
+    frames  = buffer.reshape((buffer.shape[0], -1))
+    hist_2d = hist.reshape((-1, nbins))
+    if hist_2d.shape[0] != frames.shape[1]:
+        raise ValueError('buffer and hist have a different number of pixels: ' + \
+                         str(frames.shape[1]) + ' ' + str(hist_2d.shape[0]))
+
+    # every pixel gets nbins + 1 slots, out of range values go in the last one
+    stride  = nbins + 1
+    offsets = np.arange(pixels_per_chunk, dtype=np.intp) * stride
+    N       = frames.shape[0]
+    temp_f  = np.empty((N * pixels_per_chunk,), dtype=frames.dtype)
+    temp_i  = np.empty((N * pixels_per_chunk,), dtype=np.intp)
+
+    for start in range(0, frames.shape[1], pixels_per_chunk):
+        stop = min(start + pixels_per_chunk, frames.shape[1])
+        n    = stop - start
+        f    = temp_f[: N * n].reshape((N, n))
+        a    = temp_i[: N * n].reshape((N, n))
+
+        np.rint(frames[:, start : stop], out=f)
+        a[...] = f
+        a     -= bins[0]
+
+        # negative values wrap to huge unsigned values so one minimum
+        # sends everything outside 0 --> nbins-1 to the overflow slot
+        u = a.view(np.uintp)
+        np.minimum(u, nbins, out=u)
+
+        a += offsets[:n]
+        h  = np.bincount(temp_i[: N * n], minlength = n * stride)
+        hist_2d[start : stop] += h.reshape((n, stride))[:, :nbins]
+    return hist
+
+def add_buffer_to_hist_loop(buffer, bins, hist):
+    """The original pixel by pixel histogram loop of makehist.py.
+
+    Kept as a reference for add_buffer_to_hist (see benchmark_hist_engine.py).
+    """
+    buffer_T = buffer.T.reshape((-1, buffer.shape[0]), order='F')
+
+    for ii in range(buffer_T.shape[0]):
+        a             = np.rint(buffer_T[ii]).astype(np.int)
+        a             = a[np.where(a < bins[-1])]
+        a            -= bins[0]
+        a             = a[np.where(a >= 0)]
+        h             = np.bincount( a, minlength=bins.shape[0]-1)
+        hist[np.unravel_index(ii, (hist.shape[:-1]))] += h
+    return hist
@@ -1,24 +1,43 @@
 #!/usr/bin/env python
 """
-Designed to be run with 4 cores
-everyone computes their own histograms 
-for each quadrant then we collect them
-at the end. I do not know if 2 cores 
-trying to access the same event is slow...
+Every rank computes the histograms for a tile of detector
+rows over a subset of the events (see schedule.py), the
+partial histograms of each tile are summed with an mpi
+reduction and then written by one rank per tile (see
+h5_writer.py). By default there
+are 4 pixel tiles (one per quadrant) so any multiple of 4
+cores will do.
 """
 
 import sys
 import os
 import argparse
 import ConfigParser
+import itertools
+import resource
 import numpy as np
 
+from hist_engine import add_buffer_to_hist
+from schedule import rank_to_work, tile_rows, even_split, fill_rows
+from sparse_hist import WindowedHist, tree_reduce
+from common_mode import common_mode, check_common_mode
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from prefetch import Prefetcher
+from event_source import open_source, exp_run, psana_obj_from_string, run_label, first_event
+from detector import detector_kind, panels
+from checkpoint import Checkpoint, checkpoint_files, resume, remove_stale
+
 def parse_cmdline_args():
-    parser = argparse.ArgumentParser(prog = 'mpirun -np 4 [OPTIONS] makehist.py', description='calculate the adu histogram of a run')
+    parser = argparse.ArgumentParser(prog = 'mpirun -np [NUM] [OPTIONS] makehist.py', description='calculate the adu histogram of a run')
     parser.add_argument('-c', '--config', type=str, \
                         help="file name of the configuration file")
     parser.add_argument('-s', '--source', type=str, \
                 help="psana source string (e.g exp=cxi01516:run=10:idx)")
+    parser.add_argument('-r', '--resume', action='store_true', \
+                        help="carry on from the checkpoints of an earlier job with the same output file (skipping its events), e.g. to add runs")
+    parser.add_argument('-k', '--keep', action='store_true', \
+                        help="keep the merged histograms in checkpoints after the output is written, so that runs can be added later with --resume")
     args = parser.parse_args()
 
     # check that args.ini exists
@@ -80,24 +99,6 @@ def parse_parameters(config):
 
     return monitor_params
 
-def psana_obj_from_string(name):
-    """Converts a string into a psana object type.
-    
-    Takes a string and returns the python object type described by the string.
-
-    Args:
-        name (str): a string describing a python type.
-    
-    Returns:
-        mod (type): the python type described by the string.
-    """
-    
-    components = name.split('.')
-    mod = __import__(components[0])
-    for comp in components[1:]:
-        mod = getattr(mod, comp)
-    return mod
-
 if __name__ == "__main__":
     #-----------------------------
     # Input parsing and allocation
@@ -117,32 +118,44 @@ if __name__ == "__main__":
         run = params['source']['run']
     else :
         source = args.source
-        exp = source.split('=')[1].split(':')[0]
-        run = source.split('=')[2].split(':')[0]
+        exp, run = exp_run(source)
     
-    import psana
+    psana, ds = open_source(source)
     import h5py
-    ds = psana.DataSource(source)
+    from h5_writer import write_hist, write_sparse_hist, check_writer
 
     detector_psana_source = psana.Source(params['source']['detector_psana_source'])
-    detector_psana_type   = psana_obj_from_string(params['source']['detector_psana_type'])
+    detector_psana_type   = psana_obj_from_string(params['source']['detector_psana_type'], psana)
+
+    # all of the runs of the source (e.g. run=139-152), their events are
+    # shared by all of the processes together rather than run by run
+    runs    = list(ds.runs())
+    numbers = [r.run() for r in runs]
+    times   = dict((r.run(), r.times()) for r in runs)
+    runs    = dict(zip(numbers, runs))
 
-    def evt_to_array(evt, rank):
+    # worked out once from the first event of the first run with any (see utils/detector.py)
+    first, t = first_event(numbers, times)
+    kind = detector_kind(runs[first].event(t).get(detector_psana_type, detector_psana_source))
+
+    def evt_to_array(evt, out):
         im    = evt.get(detector_psana_type, detector_psana_source)
-        try :
-            im_np = im.quads(rank).data()
-        except :
-            im_np = im.frame(rank).data()
-        return im_np
+        fill_rows(panels(im, kind), out, row_start, rows_per_frame)
+        return out
 
     # output
     import string
-    if params['output']['match'] :
-        h5name = params['output']['fnam']
-        h5name = string.replace(h5name, 'exp', exp)
-        h5name = string.replace(h5name, 'run', 'r' + str(run).zfill(4))
-    else :
+    def run_fnam(label, combined = False):
+        """The output file for the runs in label (see event_source.run_label), fnam-label.h5 if match is False."""
         h5name = params['output']['fnam']
+        if params['output']['match'] :
+            h5name = string.replace(h5name, 'exp', exp)
+            h5name = string.replace(h5name, 'run', label)
+        elif not combined :
+            h5name = os.path.splitext(h5name)[0] + '-' + label + os.path.splitext(h5name)[1]
+        return h5name
+
+    h5name = run_fnam(run_label(numbers), combined = True)
 
     h5path = params['output']['h5path']
     h5dir  = params['output']['h5dir']
@@ -159,8 +172,47 @@ if __name__ == "__main__":
     cspad_shape  = tuple(params['histogram']['shape'])
     bins         = np.arange(params['histogram']['bins'][0], params['histogram']['bins'][1] + 1, 1).astype(np.int)
     buffersize   = params['histogram']['buffer_size']
-    buffer  = np.empty( (buffersize,) + cspad_shape[1:], dtype=buffer_dtype)
-    hist    = np.zeros( cspad_shape[1:] + bins[:-1].shape,    dtype=buffer_dtype)
+
+    # work out which pixels and events are ours
+    pixel_tiles  = int(params['histogram'].get('pixel_tiles', cspad_shape[0]))
+    pixel_tile, event_group, event_groups = rank_to_work(rank, size, pixel_tiles)
+    row_start, row_stop = tile_rows(cspad_shape, pixel_tiles, pixel_tile)
+    rows_per_frame      = int(np.prod(cspad_shape[1:-1]))
+    tile_shape   = (row_stop - row_start, cspad_shape[-1])
+
+    # dense or windowed (sparse_hist.py) histograms
+    storage = params['histogram'].get('storage', 'dense')
+    if storage not in ['dense', 'windowed'] :
+        raise ValueError("[histogram] storage should be 'dense' or 'windowed': " + str(storage))
+    # check that this h5py can write the output before hours of histogramming
+    if storage == 'dense' :
+        check_writer(params['output'].get('writer', 'vds'))
+
+    def new_hist():
+        if storage == 'dense' :
+            return np.zeros( tile_shape + bins[:-1].shape,    dtype=buffer_dtype)
+        else :
+            return WindowedHist(tile_shape, bins, params['histogram'].get('window', (-25, 95)), hist_dtype)
+
+    # one hist for all of the runs, or one for each run (per_run = True) that
+    # are added together at the end
+    per_run = params['histogram'].get('per_run', False)
+    hists   = {}
+    def hist_of(number):
+        key = number if per_run else 'all'
+        if key not in hists :
+            hists[key] = new_hist()
+        return hists[key]
+
+    def group_name(key):
+        return 'all' if key == 'all' else 'r' + str(key).zfill(4)
+
+    if rank == 0 : 
+        print '\n pixel tiles, event groups:', pixel_tiles, event_groups
+        if storage == 'dense' :
+            hist_mb = np.prod(tile_shape) * (len(bins) - 1) * buffer_dtype.itemsize / 1024.**2
+            print '\n dense histogram of each process (MB): {0:.0f}'.format(hist_mb), \
+                  '(x {0} runs = {1:.0f} MB with per_run)'.format(len(numbers), len(numbers) * hist_mb) if per_run else ''
 
     # darkcal
     if rank == 0:
@@ -169,98 +221,222 @@ if __name__ == "__main__":
         f = h5py.File(darkSumFnam, 'r')
         darkcal = f['data/data'].value.astype(np.float64) / float(f['number of frames'].value)
         f.close()
-        darkcals = [darkcal[i] for i in range(darkcal.shape[0])]
-        darkcal  = darkcals
     else :
         darkcal = None
 
     comm.barrier()
-    if rank == 0 : print '\n scattering the darkcal to everyone...'
-    darkcal = comm.scatter(darkcal, root=0)
-    #print rank, darkcal.shape, buffer.shape, cspad_shape
+    if rank == 0 : print '\n broadcasting the darkcal to everyone...'
+    darkcal = comm.bcast(darkcal, root=0)
+    darkcal = darkcal.reshape((-1, cspad_shape[-1]))[row_start : row_stop].copy()
+
+    # pixels to estimate the common mode from (for common_mode = masked)
+    common_mode_mask = None
+    if params['histogram'].get('common_mode_mask') is not None :
+        f = h5py.File(params['histogram']['common_mode_mask'], 'r')
+        common_mode_mask = f['data/data'][()].astype(np.bool)
+        f.close()
+        common_mode_mask = common_mode_mask.reshape((-1, cspad_shape[-1]))[row_start : row_stop]
+    common_mode_kwargs = check_common_mode(params['histogram']['common_mode'], kind, common_mode_mask)
+
+    def flush(buffer, hist):
+        # darkcal
+        buffer -= darkcal
+        
+        # common mode
+        common_mode(buffer, params['histogram']['common_mode'], mask = common_mode_mask, **common_mode_kwargs)
+
+        # add the histogram of the buffer to the histogram
+        if storage == 'dense' :
+            add_buffer_to_hist(buffer, bins, hist)
+        else :
+            hist.add_buffer(buffer)
+
+    #-----------------------------
+    # Checkpoints (see utils/checkpoint.py)
+    #-----------------------------
+    # the ranks of each pixel tile share (and resume) the tile's checkpoints
+    tile_comm = comm.Split(pixel_tile, event_group)
+    fnam      = h5dir + h5name
+    checkpoint_interval = params['histogram'].get('checkpoint_interval', None)
+    checkpoint = None
+    if checkpoint_interval is not None or args.resume or args.keep :
+        checkpoint = Checkpoint(fnam, rank, checkpoint_interval, key = pixel_tile)
+    done_before = set() # the (run, index) of the events of the earlier job (for this tile)
+    done        = []    # the (run, index) of the events in this ranks hist
+
+    def write_state(f):
+        f.attrs['pixel_tiles'] = pixel_tiles
+        f.attrs['storage']     = storage
+        f.attrs['per_run']     = per_run
+        for key, hist in hists.items():
+            if storage == 'dense' :
+                f.create_dataset(group_name(key), data = hist)
+            elif hist.window_start is not None :
+                hist.write(f, group_name(key))
+
+    def load_state(f):
+        if f.attrs['pixel_tiles'] != pixel_tiles or f.attrs['storage'] != storage or f.attrs['per_run'] != per_run :
+            raise ValueError(f.filename + ' was made with other pixel_tiles / storage / per_run settings')
+        for name in f.keys():
+            if name == 'done' :
+                continue
+            hist = hist_of(None if name == 'all' else int(name[1:]))
+            if storage == 'dense' :
+                # a few rows at a time (rather than a second copy of the hist)
+                for i in range(0, hist.shape[0], 64):
+                    hist[i : i + 64] += f[name][i : i + 64]
+            else :
+                hist.add_state(f, name)
+
+    if args.resume :
+        done_before, done = resume(tile_comm, fnam, pixel_tile, load_state)
+        comm.barrier()
+        checkpoint.save(write_state, done)
+        comm.barrier()
+        if rank == 0 :
+            remove_stale(fnam, size)
+            print '\n resuming from', len(done_before), 'events (pixel tile 0)'
 
     #-----------------------------
     # Actual meat
     #-----------------------------
-    dropped_events = 0
-    j = 0
-    for run in ds.runs():
-        times    = run.times()
+    # the events of all of the runs, in order, split between the event groups
+    events      = [(number, i) for number in numbers for i in range(len(times[number])) if (number, i) not in done_before]
+    start, stop = even_split(len(events), event_groups, event_group)
+    if rank == 0 :
+        print 'detector:', kind
+        print 'Number of frames to process:', len(events), 'in', len(numbers), 'runs'
+        print 'Each pixel tile will process ', stop - start, ' frames'
+
+    t_start = MPI.Wtime()
+
+    # read the next buffer on a thread while this one is histogrammed
+    reader = Prefetcher(lambda e, out : evt_to_array(runs[e[0]].event(times[e[0]][e[1]]), out), \
+                        events[start : stop], tile_shape, buffer_dtype, buffersize)
+    for buffer, buffer_events in reader:
+        if per_run :
+            # a buffer can hold the end of one run and the start of the next
+            i = 0
+            for number, group in itertools.groupby(buffer_events, lambda e : e[0]):
+                n = len(list(group))
+                flush(buffer[i : i + n], hist_of(number))
+                i += n
+        else :
+            flush(buffer, hist_of(None))
+        done.extend(buffer_events)
+
+        if checkpoint is not None and checkpoint.due() :
+            checkpoint.save(write_state, done)
+
+        if rank == 0:
+            print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} \r'.format(reader.processed + buffer.shape[0], rank, reader.dropped),
+            sys.stdout.flush()
+
+    processed_events = reader.processed
+    if rank == 0:
+        print '\n', reader.report()
+
+    t_hist = MPI.Wtime() - t_start
+    del reader
+
+    #---------------------------------------------------
+    # Sum the hists of each pixel tile over event groups
+    #---------------------------------------------------
+    # every rank needs the hist of every run for the reduction (including the
+    # runs of an earlier job) and for the collective writes below
+    keys = sorted(set(itertools.chain(*comm.allgather(hists.keys()))))
+    for key in keys :
+        hist = hist_of(None if key == 'all' else key)
+        # mpi does the reduction as a tree so this is log(event_groups) steps
+        if storage == 'windowed' :
+            hists[key] = tree_reduce(tile_comm, hist, lambda a, b : a.merge(b))
+        elif event_group == 0 :
+            tile_comm.Reduce(MPI.IN_PLACE, hist, op=MPI.SUM, root=0)
+        else :
+            tile_comm.Reduce(hist, None, op=MPI.SUM, root=0)
+
+    # with --keep leave the merged hist of each tile in the checkpoint of its
+    # root, so that more runs can be added later with --resume
+    if checkpoint is not None and args.keep :
+        tile_done = tile_comm.gather(done, root=0)
+        if event_group == 0 :
+            checkpoint.save(write_state, [e for d in tile_done for e in d])
+        comm.barrier()
+        if event_group != 0 :
+            checkpoint.remove()
+    if checkpoint is not None :
         if rank == 0 :
-            print 'Number of frames to process:', len(times)
-        
-        for i in range(len(times)):
-            try :
-                evt = run.event(times[i])
-                
-                # add to buffer
-                #temp = evt_to_array(evt, rank)
-                #print rank, buffer.shape, temp.shape
-                #buffer[j] = temp
-                buffer[j] = evt_to_array(evt, rank)
-                j += 1
-
-                if j == buffersize  :
-                    j = 0
-
-                    # darkcal
-                    buffer -= darkcal
-                    
-                    # common mode
-                    if params['histogram']['common_mode'] == 'median':
-                        medians  = np.median(buffer, axis=-1)
-                        buffer  -= medians[..., np.newaxis]
-                    else :
-                        medians = None
-
-                    # add the histogram of the buffer to the histogram
-                    # ------------------------------------------------
-                    # loop over each pixel
-                    buffer_T = buffer.T.reshape((-1, buffer.shape[0]), order='F')
-                    
-                    for ii in range(buffer_T.shape[0]):
-                        #h, b          = np.histogram(buffer[:, ii, jj], bins=bins)
-                        a             = np.rint(buffer_T[ii]).astype(np.int)
-                        a             = a[np.where(a < bins[-1])]
-                        a            -= bins[0]
-                        a             = a[np.where(a >= 0)]
-                        h             = np.bincount( a, minlength=bins.shape[0]-1)
-                        hist[np.unravel_index(ii, (hist.shape[:-1]))] += h
-            except Exception as e :
-                print e
-                dropped_events += 1
-
-            if rank == 0:
-                print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} {3} \r'.format(i, rank, dropped_events, evt.get(psana.EventId)),
-                sys.stdout.flush()
-    del buffer
-    del medians
+            print '\n time spent on', checkpoint.saves, 'checkpoints: {0:.1f}s ({1:.2%} of the histogramming time)'.format( \
+                  checkpoint.t_saving, checkpoint.t_saving / max(t_hist, 1e-9))
+    tile_comm.Free()
+
+    # throughput in pixel-events per second
+    rate = comm.reduce(processed_events * np.prod(tile_shape) / t_hist, op=MPI.SUM, root=0)
 
     #--------------------------------------------------
-    # Get everyones's hists and put them into a h5 file
+    # Every tile root writes its own hists to the h5 file
     #--------------------------------------------------
+    def write_output(h5name, hist):
+        """Write the hist of every pixel tile to h5dir + h5name (collective), return the write time."""
+        if rank == 0:
+            print '\n outputing histograms to:', h5dir, h5name, h5path
+
+        if storage == 'windowed' :
+            if event_group == 0 :
+                print '\n rank', rank, 'windowed histogram size (MB):', hist.nbytes() / 1024.**2
+            t_write = write_sparse_hist(comm, h5dir + h5name, h5path, hist, pixel_tile, pixel_tiles, cspad_shape, event_group == 0)
+        else :
+            t_write = write_hist(comm, h5dir + h5name, h5path, hist, pixel_tile, pixel_tiles, cspad_shape, event_group == 0, \
+                                 writer           = params['output'].get('writer', 'vds'), \
+                                 compression      = params['output'].get('compression', 'gzip'), \
+                                 compression_opts = params['output'].get('compression_opts', 4), \
+                                 dtype            = hist_dtype)
+
+        if rank == 0:
+            # so that the histograms can be read without the config file
+            f = h5py.File(h5dir + h5name, 'a')
+            f[h5path].attrs['bins'] = bins
+            f.close()
+        return t_write
+
     comm.barrier()
     if rank == 0:
         print ''
         print ''
-        print '\n outputing histograms to:', h5dir, h5name, h5path
-        f    = h5py.File(h5dir + h5name, 'w')
-        dset = f.create_dataset(h5path, (cspad_shape + bins[:-1].shape), compression='gzip')
-
-        # output 0's hist
-        print '\n outputing rank', 0
-        dset[0, ...] = hist.copy()
-        del hist
-
-        # and everyone elses
-        for i in range(1, size):
-            print '\n outputing rank', i
-            hist = comm.recv(source = i, tag = i)
-            dset[i, ...] = hist.copy()
-            del hist
-        
-        f.close()
-        print '\n done!!'
+        print '\n throughput: {0:.3e} pixels per second ({1:.1f} full frames per second)'.format(rate, rate / np.prod(cspad_shape))
 
+    # each run on its own (runs without any events have no hist)
+    t_write = 0.
+    if per_run and len(keys) > 1 :
+        empty = [number for number in numbers if number not in keys]
+        if rank == 0 and len(empty) > 0 :
+            print '\n no events in runs', empty, '(not written)'
+        for number in numbers :
+            if number in keys :
+                t_write += write_output(run_fnam(run_label(number)), hists[number])
+
+    # and all of them together (the per run hists are added into the first)
+    if event_group == 0 :
+        total = None
+        for key in keys :
+            if total is None :
+                total = hists[key]
+            elif storage == 'windowed' :
+                total = total.merge(hists[key])
+            else :
+                total += hists[key]
     else :
-        comm.send(hist, dest=0, tag=rank)
+        # (only the shape of a dense hist is used)
+        total = hists[keys[0]]
+    t_write += write_output(h5name, total)
+    t_write = comm.reduce(t_write, op=MPI.MAX, root=0)
+
+    # otherwise the checkpoints are not needed once the output is written
+    comm.barrier()
+    if checkpoint is not None and not args.keep :
+        checkpoint.remove()
+
+    if rank == 0:
+        print '\n write time (s)       :', t_write
+        print '\n rank 0 peak rss (MB) :', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        print '\n done!!'
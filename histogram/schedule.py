@@ -0,0 +1,83 @@
+"""
+Split the histogram work between mpi ranks.
+
+The detector is viewed as a stack of rows, e.g. a CsPad of shape
+(4, 8, 185, 388) has 4 * 8 * 185 = 5920 rows of 388 pixels. The rows are
+cut into 'pixel_tiles' tiles and the events into size / pixel_tiles groups,
+so that every rank owns one (event group, pixel tile) pair:
+
+    pixel_tile  = rank % pixel_tiles
+    event_group = rank / pixel_tiles
+
+Rows are never split so the common mode (along the last axis) still sees
+whole rows. With 4 ranks and pixel_tiles = 4 this is the same as the
+original one-quadrant-per-rank scheme.
+"""
+
+import numpy as np
+
+def even_split(n, parts, part):
+    """Return the (start, stop) of 'part' when range(n) is split into 'parts' pieces.
+
+    The first n % parts pieces get one extra element so nothing is dropped.
+    """
+    base, extra = divmod(n, parts)
+    start = part * base + min(part, extra)
+    stop  = start + base + (part < extra)
+    return start, stop
+
+def rank_to_work(rank, size, pixel_tiles):
+    """Return (pixel_tile, event_group, event_groups) for this rank."""
+    if pixel_tiles < 1 or size % pixel_tiles != 0 :
+        raise ValueError('the number of mpi processes (' + str(size) + \
+                         ') must be a multiple of pixel_tiles (' + str(pixel_tiles) + ')')
+    return rank % pixel_tiles, rank / pixel_tiles, size / pixel_tiles
+
+def tile_rows(shape, pixel_tiles, pixel_tile):
+    """Return the (start, stop) flat row range of a pixel tile of a detector of this shape."""
+    nrows = int(np.prod(shape[:-1]))
+    if pixel_tiles > nrows :
+        raise ValueError('pixel_tiles (' + str(pixel_tiles) + ') is larger than the number of rows (' + str(nrows) + ')')
+    return even_split(nrows, pixel_tiles, pixel_tile)
+
+def fill_rows(frames, out, row_start, rows_per_frame):
+    """Copy the rows [row_start, row_start + len(out)) of a detector into out.
+
+    Args:
+        frames (callable): frames(k) returns the k'th quad / frame of the detector.
+        out (numpy.ndarray): output array of shape (rows, columns).
+        row_start (int): the first flat detector row to copy.
+        rows_per_frame (int): the number of rows in each quad / frame.
+    """
+    row_stop = row_start + out.shape[0]
+    for k in range(row_start / rows_per_frame, (row_stop - 1) / rows_per_frame + 1):
+        r0 = max(row_start, k * rows_per_frame)
+        r1 = min(row_stop, (k + 1) * rows_per_frame)
+        data = frames(k).reshape((rows_per_frame, out.shape[1]))
+        out[r0 - row_start : r1 - row_start] = data[r0 - k * rows_per_frame : r1 - k * rows_per_frame]
+    return out
+
+def row_pieces(shape, row_start, nrows):
+    """Split a flat row range of a detector of this shape into one hyperslab per panel.
+
+    Yields (index, i0, i1) where index selects the rows in an array of this
+    shape and i0:i1 are the corresponding rows counted from row_start.
+    """
+    shape = tuple(shape[:-1])
+    i = 0
+    r = row_start
+    while i < nrows :
+        index = np.unravel_index(r, shape)
+        n     = min(shape[-1] - index[-1], nrows - i)
+        yield tuple(index[:-1]) + (slice(index[-1], index[-1] + n),), i, i + n
+        i += n
+        r += n
+
+def write_rows(dset, data, row_start):
+    """Write data of shape (rows,) + dset.shape[-2:] into dset starting at a flat row.
+
+    The rows may span more than one quad / asic so they are written as one
+    hyperslab per panel.
+    """
+    for index, i0, i1 in row_pieces(dset.shape[:-1], row_start, data.shape[0]):
+        dset[index] = data[i0 : i1]
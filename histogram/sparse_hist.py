@@ -0,0 +1,308 @@
+"""
+Compact storage for per-pixel adu histograms.
+
+Most of the bins of a dense (pixels, nbins) histogram are zero: only the
+dark peak and the first few photon peaks get filled. WindowedHist keeps, for
+every pixel, a window of 'width' bins starting at a per-pixel bin
+(window_start) chosen from the first buffer of frames, so that the window
+sits on that pixels dark peak:
+
+    window_start = median bin of the pixel + window[0]
+    width        = window[1] - window[0]
+
+The counts inside the window are stored densely as (pixels, width) unsigned
+integers (uint16 by default, promoted to uint32 if they would overflow) and
+the rare counts outside of the window (cosmics, many photon events) are
+'spilled' into a sorted list of (pixel * nbins + bin, count) pairs, so no
+counts are lost.
+
+For a CsPad with bins = -100, 400 and window = -25, 95 this is 120 uint16
+bins per pixel rather than 500 float32 bins, i.e. about 8 times less memory
+and disk space.
+
+In a h5 file the histogram is a group with:
+    window       (pixels, width)    counts inside the window
+    window_start (pixels,)          the first bin of each window
+    spill_keys   (nspill,)          pixel * nbins + bin outside the windows
+    spill_counts (nspill,)          and their counts
+and attributes 'shape' (the pixel shape e.g. 4, 8, 185, 388) and 'bins'
+(the bin edges). Use read_pixels to expand any pixels of either this or the
+dense makehist.py output into a dense array.
+"""
+
+import numpy as np
+
+def merge_sorted(keys, counts, new_keys, new_counts):
+    """Add (new_keys, new_counts) to the sorted (keys, counts) pairs.
+
+    new_keys must be sorted and unique. Returns the merged (keys, counts).
+    """
+    if new_keys.shape[0] == 0 :
+        return keys, counts
+
+    pos   = np.searchsorted(keys, new_keys)
+    found = pos < keys.shape[0]
+    found[found] = keys[pos[found]] == new_keys[found]
+
+    counts[pos[found]] += new_counts[found].astype(counts.dtype)
+
+    if not np.all(found) :
+        missing = ~found
+        keys    = np.insert(keys,   pos[missing], new_keys[missing])
+        counts  = np.insert(counts, pos[missing], new_counts[missing].astype(counts.dtype))
+    return keys, counts
+
+def tree_reduce(comm, obj, merge):
+    """Reduce python objects to rank 0 of comm with a binary tree.
+
+    merge(a, b) must return the combination of a and b. Returns the
+    reduced object on rank 0 and None everywhere else.
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    step = 1
+    while step < size :
+        if rank % (2 * step) == 0 :
+            if rank + step < size :
+                obj = merge(obj, comm.recv(source = rank + step, tag = step))
+        else :
+            comm.send(obj, dest = rank - step, tag = step)
+            return None
+        step *= 2
+    return obj
+
+class WindowedHist(object):
+    """Per-pixel adu histogram with a dense window around each pixel's dark peak.
+
+    Args:
+        pixel_shape (tuple): the shape of the pixels e.g. (1480, 388).
+        bins (numpy.ndarray): the integer bin edges (as in makehist.py).
+        window (tuple): the window in adus relative to the median of the
+            first frames of each pixel, e.g. (-25, 95).
+        count_dtype (numpy.dtype): unsigned integer type of the window counts.
+    """
+    def __init__(self, pixel_shape, bins, window = (-25, 95), count_dtype = np.uint16):
+        self.pixel_shape = tuple(pixel_shape)
+        self.bins   = np.asarray(bins)
+        self.nbins  = self.bins.shape[0] - 1
+        self.npix   = int(np.prod(self.pixel_shape))
+        self.width  = min(int(window[1] - window[0]), self.nbins)
+        self.offset = int(window[0])
+
+        self.window       = np.zeros((self.npix, self.width), dtype = count_dtype)
+        self.window_start = None
+        self.spill_keys   = np.zeros((0,), dtype = np.int64)
+        self.spill_counts = np.zeros((0,), dtype = np.uint32)
+
+    def _set_window_start(self, a):
+        """Centre the windows on the median bin of the first frames (a: frames x pixels)."""
+        start = np.median(a, axis=0).astype(np.int64) + self.offset
+        return np.clip(start, 0, self.nbins - self.width)
+
+    def _promote(self, n):
+        """Make sure that the window counts can grow by n without overflowing."""
+        if self.window.size and int(self.window.max()) + n > np.iinfo(self.window.dtype).max :
+            self.window = self.window.astype(np.uint32 if self.window.dtype.itemsize < 4 else np.uint64)
+
+    def add_buffer(self, buffer, pixels_per_chunk = 512):
+        """Add the rounded adu values of every frame in buffer (frames,) + pixel_shape."""
+        frames = buffer.reshape((buffer.shape[0], -1))
+        N      = frames.shape[0]
+        if frames.shape[1] != self.npix :
+            raise ValueError('buffer and hist have a different number of pixels: ' + \
+                             str(frames.shape[1]) + ' ' + str(self.npix))
+        if self.window_start is None :
+            self.window_start = np.zeros((self.npix,), dtype = np.int64)
+            first = True
+        else :
+            first = False
+        self._promote(N)
+
+        # every pixel gets width + 1 slots, values outside the window go in the last one
+        stride  = self.width + 1
+        offsets = np.arange(pixels_per_chunk, dtype=np.intp) * stride
+        spill   = []
+        for start in range(0, self.npix, pixels_per_chunk):
+            stop = min(start + pixels_per_chunk, self.npix)
+            n    = stop - start
+
+            a  = np.rint(frames[:, start : stop]).astype(np.intp)
+            a -= self.bins[0]
+            if first :
+                self.window_start[start : stop] = self._set_window_start(a)
+
+            w  = a - self.window_start[start : stop]
+            u  = w.view(np.uintp)
+            np.minimum(u, self.width, out=u)
+
+            # outside of the window but inside the bins
+            out = (w == self.width) * (a >= 0) * (a < self.nbins)
+            if np.any(out) :
+                p = np.nonzero(out)[1]
+                spill.append((p + start).astype(np.int64) * self.nbins + a[out])
+
+            w += offsets[:n]
+            h  = np.bincount(w.ravel(), minlength = n * stride)
+            self.window[start : stop] += h.reshape((n, stride))[:, :self.width].astype(self.window.dtype)
+
+        if len(spill) > 0 :
+            keys, counts = np.unique(np.concatenate(spill), return_counts = True)
+            self.add_spill(keys, counts)
+        return self
+
+    def add_spill(self, keys, counts):
+        """Add (pixel * nbins + bin, count) pairs that are outside of the windows."""
+        self.spill_keys, self.spill_counts = merge_sorted(self.spill_keys, self.spill_counts, keys, counts)
+
+    def add_counts(self, keys, counts):
+        """Add (pixel * nbins + bin, count) pairs, inside or outside of the windows."""
+        pix = keys / self.nbins
+        w   = keys - pix * self.nbins - self.window_start[pix]
+        inside = (w >= 0) * (w < self.width)
+        if np.any(inside) :
+            self._promote(int(counts[inside].max()))
+            h = np.bincount(pix[inside] * self.width + w[inside], weights = counts[inside], \
+                            minlength = self.window.size)
+            self.window += h.reshape(self.window.shape).astype(self.window.dtype)
+        if not np.all(inside) :
+            self.add_spill(keys[~inside], counts[~inside])
+
+    def merge(self, other):
+        """Add the counts of another WindowedHist (of the same pixels and bins) to this one."""
+        if other.window_start is None :
+            return self
+        if self.window_start is None :
+            return other
+
+        w      = other.window.ravel()
+        nz     = np.nonzero(w)[0]
+        pix    = nz / other.width
+        keys   = pix.astype(np.int64) * self.nbins + other.window_start[pix] + nz % other.width
+        self.add_counts(keys, w[nz].astype(np.uint64))
+        self.add_counts(other.spill_keys, other.spill_counts)
+        return self
+
+    def add_state(self, f, h5path):
+        """Add the counts of a histogram written with write (of the same pixels and bins, e.g. a checkpoint) to this one."""
+        g = f[h5path]
+        if self.window_start is None :
+            self.window       = g['window'][()]
+            self.window_start = g['window_start'][()].astype(np.int64)
+            self.spill_keys   = g['spill_keys'][()]
+            self.spill_counts = g['spill_counts'][()]
+            return self
+        w      = g['window'][()].ravel()
+        nz     = np.nonzero(w)[0]
+        pix    = nz / self.width
+        keys   = pix.astype(np.int64) * self.nbins + g['window_start'][()][pix] + nz % self.width
+        self.add_counts(keys, w[nz].astype(np.uint64))
+        self.add_counts(g['spill_keys'][()], g['spill_counts'][()])
+        return self
+
+    def to_dense(self, pixels = None, dtype = np.float64):
+        """Expand the histograms of pixels (flat indices, default all) to a (len(pixels), nbins) array."""
+        if pixels is None :
+            pixels = np.arange(self.npix)
+        return expand(self.window[pixels], self.window_start[pixels], pixels, \
+                      self.spill_keys, self.spill_counts, self.nbins, dtype)
+
+    def nbytes(self):
+        return self.window.nbytes + self.window_start.nbytes + self.spill_keys.nbytes + self.spill_counts.nbytes
+
+    def write(self, f, h5path, shape = None, pixel_offset = 0, npix = None, count_dtype = None):
+        """Write this histogram into a (new or existing) group of an open h5py.File.
+
+        To write several WindowedHists into one group (one for each pixel
+        tile) pass the full pixel shape, the total number of pixels, the
+        flat pixel offset of this one and the largest count dtype of them all.
+        """
+        if shape is None :
+            shape = self.pixel_shape
+        if npix is None :
+            npix = self.npix
+        if count_dtype is None :
+            count_dtype = self.window.dtype
+
+        if h5path not in f :
+            g = f.create_group(h5path)
+            g.attrs['format'] = 'windowed'
+            g.attrs['shape']  = np.array(shape)
+            g.attrs['bins']   = self.bins
+            g.create_dataset('window', (npix, self.width), dtype = count_dtype, \
+                             chunks = (min(npix, 1024), self.width), compression = 'gzip')
+            g.create_dataset('window_start', (npix,), dtype = np.int16, compression = 'gzip')
+            for k, dtype in [('spill_keys', np.int64), ('spill_counts', np.uint32)]:
+                g.create_dataset(k, (0,), maxshape = (None,), dtype = dtype, chunks = (65536,), compression = 'gzip')
+        g = f[h5path]
+
+        if g['window'].dtype.itemsize < self.window.dtype.itemsize :
+            raise ValueError('window counts need a bigger dtype than the file has: ' + str(self.window.dtype))
+        g['window'][pixel_offset : pixel_offset + self.npix]       = self.window
+        g['window_start'][pixel_offset : pixel_offset + self.npix] = self.window_start
+
+        # the spill keys are kept sorted so the tiles should be written in order
+        n = g['spill_keys'].shape[0]
+        for k, v in [('spill_keys', self.spill_keys + pixel_offset * self.nbins), ('spill_counts', self.spill_counts)]:
+            g[k].resize((n + v.shape[0],))
+            g[k][n :] = v
+
+def expand(window, window_start, pixels, spill_keys, spill_counts, nbins, dtype = np.float64):
+    """Expand windowed histograms of the given (sorted flat) pixels into a dense array."""
+    pixels = np.asarray(pixels)
+    out    = np.zeros((pixels.shape[0], nbins), dtype = dtype)
+    width  = window.shape[1]
+
+    i = np.arange(pixels.shape[0])[:, np.newaxis]
+    j = window_start[:, np.newaxis] + np.arange(width)
+    out[i, j] = window
+
+    # the spilled counts of these pixels
+    lo = np.searchsorted(spill_keys, pixels.astype(np.int64) * nbins)
+    hi = np.searchsorted(spill_keys, (pixels.astype(np.int64) + 1) * nbins)
+    for k in np.nonzero(hi > lo)[0]:
+        out[k, spill_keys[lo[k] : hi[k]] - pixels[k] * nbins] += spill_counts[lo[k] : hi[k]]
+    return out
+
+def read_pixels(fnam, h5path, pixels, dtype = np.float64):
+    """Read the histograms of some pixels from a makehist.py output file as a dense array.
+
+    Works for both the dense (dataset) and the windowed (group) outputs.
+
+    Args:
+        fnam (str): the h5 file name.
+        h5path (str): the dataset or group of the histogram (e.g. 'data/data').
+        pixels (array like): flat pixel indices (into e.g. 4 x 8 x 185 x 388).
+
+    Returns:
+        hist (numpy.ndarray): (len(pixels), nbins) histograms.
+        bins (numpy.ndarray or None): the bin edges if they were stored.
+    """
+    import h5py
+    pixels = np.asarray(pixels, dtype=np.int64)
+    order  = np.argsort(pixels)
+    spix   = pixels[order]
+
+    f    = h5py.File(fnam, 'r')
+    node = f[h5path]
+    bins = node.attrs['bins'] if 'bins' in node.attrs else None
+
+    if isinstance(node, h5py.Dataset) :
+        # dense, read one detector row at a time
+        shape = node.shape[:-1]
+        out   = np.zeros((spix.shape[0], node.shape[-1]), dtype = dtype)
+        rows  = spix / shape[-1]
+        for r in np.unique(rows):
+            row = node[np.unravel_index(r, shape[:-1])]
+            sel = np.nonzero(rows == r)[0]
+            out[sel] = row[spix[sel] - r * shape[-1]]
+    else :
+        u, inv = np.unique(spix, return_inverse = True)
+        window = node['window'][u.tolist()]
+        start  = node['window_start'][u.tolist()].astype(np.int64)
+        nbins  = node.attrs['bins'].shape[0] - 1
+        out    = expand(window, start, u, node['spill_keys'][()], node['spill_counts'][()], nbins, dtype)[inv]
+    f.close()
+
+    hist = np.empty_like(out)
+    hist[order] = out
+    return hist, bins
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Time the batched forward model (hist_model_batch) against calling hist_model
+for every pixel, for 1e3 to 1e6 synthetic pixels, and check that they agree.
+
+hist_model is only timed on the first --check pixels and the time for all of
+them is extrapolated from that.
+"""
+
+import argparse
+import time
+import numpy as np
+
+from forward_pixel_hist import hist_model, hist_model_batch
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_hist_model.py', description='benchmark the batched pixel histogram forward model')
+    parser.add_argument('-p', '--pixels', type=str, default = '1000,10000,100000,1000000', \
+                        help="comma separated numbers of pixels")
+    parser.add_argument('-a', '--adus', type=str, default = '-100,401', \
+                        help="the adu range of the histograms (start,stop)")
+    parser.add_argument('-n', '--photons', type=int, default = 3, \
+                        help="number of photon orders in the model")
+    parser.add_argument('-c', '--check', type=int, default = 100, \
+                        help="number of pixels to run hist_model on")
+    return parser.parse_args()
+
+def synthetic_pixels(npix, adus, rng):
+    """Gaussian dark histograms with a spread of offsets and widths, photon adus and photon rates."""
+    offset = rng.normal(0., 2., (npix, 1))
+    sigma  = rng.uniform(3., 6., (npix, 1))
+    s0     = np.exp( -(adus - offset)**2 / (2. * sigma**2))
+    s0    /= np.sum(s0, axis=1, keepdims=True)
+    return s0, rng.normal(30., 2., npix), rng.uniform(0.01, 1., npix)
+
+if __name__ == '__main__':
+    args   = parse_cmdline_args()
+    start, stop = [int(a) for a in args.adus.split(',')]
+    adus   = np.arange(start, stop, 1).astype(np.float64)
+    rng    = np.random.RandomState(0)
+    kwargs = {'sigma_to_pix' : 0.1, 'photon_sig' : 1.5, 'pix_per_pix' : 256, 'pix_pad' : 3, \
+              'model' : 'gaus', 'photons' : args.photons}
+
+    print '{0:>9} {1:>14} {2:>14} {3:>9} {4:>12}'.format('pixels', 'hist_model (s)', 'batch (s)', 'speedup', 'max diff')
+    for npix in [int(float(p)) for p in args.pixels.split(',')]:
+        s0, photon_adu, lamb = synthetic_pixels(npix, adus, rng)
+
+        t0    = time.time()
+        batch = hist_model_batch(s0, photon_adu = photon_adu, ns = lamb, **kwargs)
+        t_batch = time.time() - t0
+
+        m  = min(npix, args.check)
+        t0 = time.time()
+        single = np.array([hist_model(s0[i], photon_adu = photon_adu[i], ns = lamb[i], **kwargs) for i in range(m)])
+        t_single = (time.time() - t0) * npix / float(m)
+
+        diff = np.max(np.abs(single - batch[:m]))
+        print '{0:9d} {1:14.2f} {2:14.2f} {3:9.1f} {4:12.2e}'.format(npix, t_single, t_batch, t_single / t_batch, diff)
+        del s0, batch
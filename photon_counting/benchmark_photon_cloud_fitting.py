@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Time the per-pixel fit (fit_pixels) on synthetic pixel histograms drawn
+from the forward model, and report how well it recovers the gains and
+photon rates, with the true dark histograms and with the mirrored dark peaks.
+
+sigma_to_pix and photon_sig are kept at their true values (fit_global is
+much slower, run it with --global on a few hundred pixels).
+"""
+
+import argparse
+import time
+import numpy as np
+
+from forward_pixel_hist import hist_model_batch
+from photon_cloud_fitting import fit_pixels, fit_global
+from benchmark_hist_model import synthetic_pixels
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_photon_cloud_fitting.py', description='benchmark the per-pixel photon cloud fit')
+    parser.add_argument('-p', '--pixels', type=str, default = '1000,10000', \
+                        help="comma separated numbers of pixels")
+    parser.add_argument('-a', '--adus', type=str, default = '-30,150', \
+                        help="the adu range of the histograms (start,stop)")
+    parser.add_argument('-f', '--frames', type=int, default = 20000, \
+                        help="number of frames in each pixel histogram")
+    parser.add_argument('-g', '--global', dest='fit_global', type=int, default = 0, \
+                        help="also fit sigma_to_pix and photon_sig to this many pixels")
+    return parser.parse_args()
+
+def draw(model, frames, rng):
+    """A histogram of frames events for each row of model."""
+    return np.array([rng.multinomial(frames, m / np.sum(m)) for m in model]).astype(np.float64)
+
+def report(label, npix, seconds, fit, photon_adu, lamb):
+    gain = np.median(np.abs(fit['photon_adu'] - photon_adu))
+    rate = np.median(fit['rate'] / lamb - 1.)
+    print '{0:>9d} {1:>9} {2:10.2f} {3:12.0f} {4:10.3f} {5:11.4f} {6:10.3f}'.format(\
+          npix, label, seconds, npix / seconds, gain, rate, np.mean(fit['converged']))
+
+if __name__ == '__main__':
+    args   = parse_cmdline_args()
+    start, stop = [int(a) for a in args.adus.split(',')]
+    adus   = np.arange(start, stop, 1).astype(np.float64)
+    rng    = np.random.RandomState(0)
+    sigma_to_pix, photon_sig = 0.15, 2.
+
+    print '{0:>9} {1:>9} {2:>10} {3:>12} {4:>10} {5:>11} {6:>10}'.format(\
+          'pixels', 'dark', 'time (s)', 'pixels/s', '|gain err|', 'rate bias', 'converged')
+    for npix in [int(float(p)) for p in args.pixels.split(',')]:
+        s0, photon_adu, lamb = synthetic_pixels(npix, adus, rng)
+        hist = draw(hist_model_batch(s0, sigma_to_pix, photon_sig, photon_adu, ns = lamb), args.frames, rng)
+
+        for label, dark in [('true', s0), ('mirrored', None)]:
+            t0  = time.time()
+            fit = fit_pixels(hist, sigma_to_pix, photon_sig, 30., s0 = dark)
+            report(label, npix, time.time() - t0, fit, photon_adu, lamb)
+
+    if args.fit_global > 0 :
+        s0, photon_adu, lamb = synthetic_pixels(args.fit_global, adus, rng)
+        hist = draw(hist_model_batch(s0, sigma_to_pix, photon_sig, photon_adu, ns = lamb), args.frames, rng)
+        t0 = time.time()
+        s, p, fit = fit_global(hist, 0.1, 1.5, 30., s0 = s0)
+        print '\nfit_global on {0} pixels: sigma_to_pix {1:.4f} (true {2}) photon_sig {3:.3f} (true {4}) in {5:.1f}s'.format(\
+              args.fit_global, s, sigma_to_pix, p, photon_sig, time.time() - t0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Time each step of photon_convert.py on a buffer of synthetic CsPad frames
+(see utils/event_source.py) in one process, and the frames per second of
+the whole conversion, to work out how many processes a rate needs. The
+lists step includes appending them to the lists file (flushed every buffer),
+which is removed at the end.
+"""
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+from photon_convert import count_photons, count_droplets, droplet_structure, PhotonLists
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import synthetic_frames
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'histogram'))
+from common_mode import common_mode, check_common_mode
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_photon_convert.py', description='time the steps of the photon conversion')
+    parser.add_argument('-n', '--frames', type=int, default = 32, \
+                        help="number of frames in the buffer")
+    parser.add_argument('-m', '--common_mode', type=str, default = 'median', \
+                        help="common mode correction (median, asic or None)")
+    parser.add_argument('-r', '--rate', type=float, default = 120., \
+                        help="the frame rate to work out the processes for")
+    parser.add_argument('-o', '--output', type=str, default = 'benchmark_photon_convert-lists.h5', \
+                        help="the file the photon lists are appended to (removed at the end)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args   = parse_cmdline_args()
+    shape  = (4, 8, 185, 388)
+    frames = synthetic_frames(shape, np.int16)
+    buffer = np.array([frames[i % len(frames)] for i in range(args.frames)])
+    method = None if args.common_mode == 'None' else args.common_mode
+    cm_kwargs = check_common_mode(method, 'cspad')
+
+    # (the synthetic frames have an offset for every pixel)
+    darkcal  = np.mean(frames, axis=0, dtype=np.float64).astype(np.float32)
+    inv_gain = np.full(shape, 1. / 30., dtype=np.float32)
+    work     = np.empty(buffer.shape, dtype=np.float32)
+    counts   = np.empty(buffer.shape, dtype=np.uint8)
+    total    = np.zeros(shape, dtype=np.int64)
+    lists    = PhotonLists(args.output, np.uint8, flush_buffers = 1)
+    structure = droplet_structure(len(shape))
+
+    def droplets():
+        for i in range(work.shape[0]):
+            count_droplets(work[i], 0.5, 0.3, structure, counts[i])
+
+    def add():
+        total[:] += counts.sum(axis=0, dtype=np.int64)
+
+    steps = [('copy', lambda : work.__setitem__(Ellipsis, buffer)), \
+             ('darkcal', lambda : np.subtract(work, darkcal, out = work)), \
+             ('common mode', lambda : common_mode(work, method, **cm_kwargs)), \
+             ('gain', lambda : np.multiply(work, inv_gain, out = work)), \
+             ('droplets', droplets), \
+             ('count', lambda : count_photons(work, 0.5, counts)), \
+             ('sum', add), \
+             ('lists', lambda : lists.add_buffer(counts, np.arange(args.frames), [(0, i) for i in range(args.frames)]))]
+
+    print '{0:>12} {1:>10}'.format('step', 'ms/frame')
+    times = {}
+    for name, step in steps :
+        t0 = time.time()
+        step()
+        times[name] = (time.time() - t0) / args.frames
+        print '{0:>12} {1:10.2f}'.format(name, 1e3 * times[name])
+    if os.path.exists(args.output) :
+        os.remove(args.output)
+
+    for label, skip in [('counting', 'droplets'), ('droplets', 'count')]:
+        t = sum([v for k, v in times.items() if k != skip])
+        print '{0}: {1:.1f} frames/s per process, {2} processes for {3:.0f} Hz'.format( \
+              label, 1. / t, int(np.ceil(args.rate * t)), args.rate)
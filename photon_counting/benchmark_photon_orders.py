@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Time the photon order convolutions of the forward model (photon_orders,
+float64 and float32) against the np.convolve chain that hist_model used
+before, for photons = 1 to 6, and print the largest difference of the
+normalised photon orders from the np.convolve chain.
+"""
+
+import argparse
+import time
+import numpy as np
+import scipy.ndimage.filters
+
+from forward_pixel_hist import single_photon_model, photon_orders, hist_model_batch
+from benchmark_hist_model import synthetic_pixels
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_photon_orders.py', description='benchmark the photon order convolutions')
+    parser.add_argument('-a', '--adus', type=str, default = '-30,150;-100,401', \
+                        help="semicolon separated adu ranges of the histograms (start,stop)")
+    parser.add_argument('-n', '--photons', type=str, default = '1,2,3,4,5,6', \
+                        help="comma separated numbers of photon orders")
+    parser.add_argument('-r', '--repeats', type=int, default = 200, \
+                        help="number of times to time each chain")
+    parser.add_argument('-p', '--pixels', type=int, default = 4096, \
+                        help="number of pixels for hist_model_batch")
+    return parser.parse_args()
+
+def convolve_orders(s0, s1, photons):
+    """The np.convolve chain of hist_model (each order from the one before)."""
+    ss    = np.zeros((photons + 1, s1.shape[0]), dtype=s1.dtype)
+    ss[0] = s0
+    ss[1] = s1
+    for i in range(2, ss.shape[0], 1):
+        ss[i] = np.convolve(ss[i-1], s1, mode='full')[:s0.shape[0]]
+    for i in range(1, ss.shape[0], 1):
+        ss[i] = np.convolve(ss[i], s0, mode='full')[:s0.shape[0]]
+        ss[i] = ss[i] / np.sum(ss[i])
+    return ss
+
+def timed(f, repeats, best_of = 3):
+    """The time of one call to f (the best of best_of runs of repeats calls) and its output."""
+    ts = []
+    for j in range(best_of):
+        t0 = time.time()
+        for i in range(repeats):
+            out = f()
+        ts.append((time.time() - t0) / repeats)
+    return min(ts), out
+
+if __name__ == '__main__':
+    args    = parse_cmdline_args()
+    rng     = np.random.RandomState(0)
+    photons = [int(n) for n in args.photons.split(',')]
+
+    print 'one pixel, time (us) and max difference from np.convolve'
+    print '{0:>10} {1:>7} {2:>12} {3:>10} {4:>10} {5:>9} {6:>10} {7:>9}'.format( \
+          'adus', 'photons', 'np.convolve', 'float64', 'diff', 'speedup', 'float32', 'diff')
+    for adu_range in args.adus.split(';'):
+        start, stop = [int(a) for a in adu_range.split(',')]
+        adus = np.arange(start, stop, 1).astype(np.float64)
+        s0   = synthetic_pixels(1, adus, rng)[0][0]
+        s1   = scipy.ndimage.filters.gaussian_filter(single_photon_model(len(adus), 0.1, 30., 256, 3, 'gaus'), 1.5)
+        for n in photons :
+            t_ref, ref = timed(lambda : convolve_orders(s0, s1, n), args.repeats)
+            t_64, ss64 = timed(lambda : photon_orders(s0, s1, n), args.repeats)
+            t_32, ss32 = timed(lambda : photon_orders(s0, s1, n, np.float32), args.repeats)
+            print '{0:>10} {1:7d} {2:12.1f} {3:10.1f} {4:10.1e} {5:9.1f} {6:10.1f} {7:9.1e}'.format( \
+                  adu_range, n, 1e6 * t_ref, 1e6 * t_64, np.max(np.abs(ss64 - ref)), t_ref / t_64, \
+                  1e6 * t_32, np.max(np.abs(ss32 - ref)))
+
+    # the whole batched forward model in each precision
+    start, stop = [int(a) for a in args.adus.split(';')[0].split(',')]
+    adus = np.arange(start, stop, 1).astype(np.float64)
+    s0, photon_adu, lamb = synthetic_pixels(args.pixels, adus, rng)
+    print '\nhist_model_batch of {0} pixels ({1} adus), time (s) and max difference from float64'.format(args.pixels, len(adus))
+    print '{0:>7} {1:>10} {2:>10} {3:>10}'.format('photons', 'float64', 'float32', 'diff')
+    for n in photons :
+        t_64, h64 = timed(lambda : hist_model_batch(s0, photon_adu = photon_adu, ns = lamb, photons = n), 1)
+        t_32, h32 = timed(lambda : hist_model_batch(s0, photon_adu = photon_adu, ns = lamb, photons = n, dtype = np.float32), 1)
+        print '{0:7d} {1:10.3f} {2:10.3f} {3:10.1e}'.format(n, t_64, t_32, np.max(np.abs(h32 - h64)))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Time pixel_pool.fit_all on synthetic pixel histograms (in shared memory)
+with 1, 2, 4 ... processes up to the number of cores, and print the speedup
+and parallel efficiency over one process. Run it with OMP_NUM_THREADS=1.
+"""
+
+import argparse
+import time
+import multiprocessing
+import numpy as np
+
+from forward_pixel_hist import hist_model_batch
+from benchmark_hist_model import synthetic_pixels
+from pixel_pool import shared_array, fit_all
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_pixel_pool.py', description='benchmark the process pool pixel fit')
+    parser.add_argument('-p', '--pixels', type=int, default = 20000, \
+                        help="number of pixels")
+    parser.add_argument('-j', '--processes', type=str, \
+                        help="comma separated numbers of processes (default 1, 2, 4 ... cores)")
+    parser.add_argument('-t', '--tile', type=int, default = 1024, \
+                        help="pixels per task")
+    parser.add_argument('-a', '--adus', type=str, default = '-30,150', \
+                        help="the adu range of the histograms (start,stop)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args  = parse_cmdline_args()
+    start, stop = [int(a) for a in args.adus.split(',')]
+    adus  = np.arange(start, stop, 1).astype(np.float64)
+    rng   = np.random.RandomState(0)
+    cores = multiprocessing.cpu_count()
+    if args.processes is None :
+        processes = [2**i for i in range(int(np.log2(cores)) + 1)]
+        if processes[-1] != cores :
+            processes.append(cores)
+    else :
+        processes = [int(p) for p in args.processes.split(',')]
+
+    s0, photon_adu, lamb = synthetic_pixels(args.pixels, adus, rng)
+    hist = shared_array((args.pixels, len(adus)), np.uint16)
+    for p in range(0, args.pixels, 4096):
+        m = hist_model_batch(s0[p : p + 4096], 0.15, 2., photon_adu[p : p + 4096], ns = lamb[p : p + 4096])
+        hist[p : p + 4096] = [rng.multinomial(20000, mi / np.sum(mi)) for mi in m]
+    fit_kwargs = {'sigma_to_pix' : 0.15, 'photon_sig' : 2., 'photon_adu' : 30.}
+
+    print args.pixels, 'pixels,', cores, 'cores'
+    print '{0:>9} {1:>10} {2:>12} {3:>9} {4:>11}'.format('processes', 'time (s)', 'pixels/s', 'speedup', 'efficiency')
+    t1 = None
+    for j in processes :
+        t0   = time.time()
+        maps = fit_all(hist, slice(None), fit_kwargs, processes = j, tile = args.tile, progress = False)
+        t    = time.time() - t0
+        t1   = t if t1 is None else t1
+        print '{0:9d} {1:10.2f} {2:12.0f} {3:9.2f} {4:10.0f}%'.format(j, t, args.pixels / t, t1 / t, 100. * t1 / (t * j))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Compare the tabulated single photon distribution of the gaussian cloud
+('gaus_table', see forward_pixel_hist.SinglePhotonTable) with the sampled
+one ('gaus') for a few pix_per_pix:
+
+    accuracy : the total variation distance (half the sum of the absolute
+               differences) of the single photon histograms, before and
+               after the photon_sig blur, against a finely sampled
+               (--reference pix_per_pix) model
+    kernel   : the time to make one single photon histogram
+    fit      : the time of fit_pixels on synthetic pixels with each model
+"""
+
+import argparse
+import time
+import numpy as np
+import scipy.ndimage.filters
+
+import forward_pixel_hist
+from forward_pixel_hist import single_photon_model_gaus, photon_table, hist_model_batch
+from photon_cloud_fitting import fit_pixels
+from benchmark_hist_model import synthetic_pixels
+from benchmark_photon_cloud_fitting import draw
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'benchmark_single_photon_table.py', description='benchmark the tabulated single photon model')
+    parser.add_argument('-s', '--sigma_to_pix', type=str, default = '0.03,0.1,0.15,0.3,0.6', \
+                        help="comma separated sigma_to_pix values")
+    parser.add_argument('-g', '--photon_adu', type=str, default = '20,30.5,45', \
+                        help="comma separated photon_adu values")
+    parser.add_argument('-p', '--pix_per_pix', type=str, default = '256,300,1024', \
+                        help="comma separated pix_per_pix of the sampled model")
+    parser.add_argument('-r', '--reference', type=int, default = 4096, \
+                        help="pix_per_pix of the reference model")
+    parser.add_argument('-n', '--pixels', type=int, default = 2000, \
+                        help="number of pixels to fit")
+    return parser.parse_args()
+
+def tv(a, b):
+    return 0.5 * np.sum(np.abs(a - b))
+
+if __name__ == '__main__':
+    args   = parse_cmdline_args()
+    adus   = 180
+    sigmas = [float(s) for s in args.sigma_to_pix.split(',')]
+    gains  = [float(g) for g in args.photon_adu.split(',')]
+    ppps   = [int(p) for p in args.pix_per_pix.split(',')]
+    blur   = lambda s : scipy.ndimage.filters.gaussian_filter1d(s, 1.5)
+
+    print 'total variation distance to pix_per_pix =', args.reference, '(blurred with photon_sig = 1.5)'
+    print '{0:>12} {1:>10}'.format('sigma_to_pix', 'photon_adu') + \
+          ''.join(['{0:>18}'.format('gaus ' + str(p)) for p in ppps]) + '{0:>18}'.format('gaus_table')
+    for sig in sigmas :
+        for g in gains :
+            ref  = single_photon_model_gaus(adus, sig, g, args.reference, 3, 'gaus')
+            hs   = [single_photon_model_gaus(adus, sig, g, p, 3, 'gaus') for p in ppps] + [photon_table.hists(adus, sig, [g])[0]]
+            print '{0:12.3f} {1:10.1f}'.format(sig, g) + \
+                  ''.join(['{0:>18}'.format('{0:.4f} ({1:.4f})'.format(tv(h, ref), tv(blur(h), blur(ref)))) for h in hs])
+
+    # the time for one kernel (the table rows of these sigma_to_pix are made above)
+    print '\n{0:>16} {1:>14}'.format('kernel', 'time (ms)')
+    reps = 50
+    for p in ppps :
+        t0 = time.time()
+        for i in range(reps):
+            single_photon_model_gaus(adus, sigmas[0], gains[0] + 1e-3 * i, p, 3, 'gaus')
+        print '{0:>16} {1:14.3f}'.format('gaus ' + str(p), 1e3 * (time.time() - t0) / reps)
+    t0 = time.time()
+    for i in range(reps):
+        photon_table.hists(adus, sigmas[0], [gains[0] + 1e-3 * i])
+    print '{0:>16} {1:14.3f}'.format('gaus_table', 1e3 * (time.time() - t0) / reps)
+
+    # fit_pixels on synthetic pixels with each model (a new photon_adu for
+    # every pixel and iteration, so the kernels are made every time)
+    rng = np.random.RandomState(0)
+    x   = np.arange(-30, 150).astype(np.float64)
+    s0, photon_adu, lamb = synthetic_pixels(args.pixels, x, rng)
+    hist = draw(hist_model_batch(s0, 0.15, 2., photon_adu, ns = lamb, pix_per_pix = args.reference), 20000, rng)
+    print '\nfit_pixels of {0} pixels'.format(args.pixels)
+    print '{0:>16} {1:>10} {2:>12} {3:>11}'.format('model', 'time (s)', 'pixels/s', '|gain err|')
+    for model, p in [('gaus', p) for p in ppps] + [('gaus_table', ppps[0])]:
+        forward_pixel_hist.kernel_cache.clear()
+        t0  = time.time()
+        fit = fit_pixels(hist, 0.15, 2., 30., pix_per_pix = p, model = model, s0 = s0)
+        t   = time.time() - t0
+        print '{0:>16} {1:10.2f} {2:12.0f} {3:11.3f}'.format(model + ('' if model == 'gaus_table' else ' ' + str(p)), \
+              t, args.pixels / t, np.median(np.abs(fit['photon_adu'] - photon_adu)))
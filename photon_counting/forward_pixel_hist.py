@@ -13,7 +13,7 @@ with the following paramters:
     pix_pad    
     model     
 
-see hist_model for details.
+see hist_model for details, or hist_model_batch for many pixels at once.
 """
 
 import numpy as np
@@ -21,20 +21,119 @@ import scipy.ndimage.filters
 import functools
 import scipy.optimize
 import scipy.special
+from collections import OrderedDict
+
+class KernelCache(object):
+    """A least recently used cache of single photon models, at most maxsize of them.
+
+    The single photon model only depends on (adus, sigma_to_pix, photon_adu,
+    pix_per_pix, pix_pad, model), so when a fit only changes ns (or
+    photon_sig) the photon cloud is not simulated again. The cached arrays
+    are read-only.
+    """
+    def __init__(self, maxsize = 256):
+        self.maxsize = maxsize
+        self.kernels = OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    def get(self, key, make):
+        """The kernel of key, make() (and cache) it if it is not in the cache."""
+        if key in self.kernels :
+            self.hits += 1
+            kernel = self.kernels.pop(key)
+        else :
+            self.misses += 1
+            kernel = make()
+            kernel.setflags(write = False)
+            if len(self.kernels) >= self.maxsize :
+                self.kernels.popitem(last = False)
+        # the most recently used are at the end
+        self.kernels[key] = kernel
+        return kernel
+
+    def clear(self):
+        self.kernels.clear()
+
+kernel_cache = KernelCache()
+
+class SinglePhotonTable(object):
+    """The single photon distribution of the gaussian cloud model ('gaus_table') from a table of its cdf.
+
+    The charge on the pixel is photon_adu * y(u) * y(v), where y(u) is the
+    fraction of a gaussian (sigma_to_pix) that falls on a pixel whose centre
+    is u pixels away, for u and v uniform on [0.5, pix_pad / 2).
+    single_photon_model_gaus histograms this for u, v on a pix_per_pix grid,
+    here the cdf of y(u) * y(v) is worked out once for each node of a grid
+    in log(sigma_to_pix) (as a function of the fraction t of the largest
+    charge, y(0.5)**2), when it is first needed. Since the charge scales with
+    photon_adu, the histogram of any (sigma_to_pix, photon_adu) is then the
+    difference of the cdf at the bin edges, interpolated between the two
+    nearest nodes at the same t. That is O(adus) for each pixel and does not
+    depend on pix_per_pix (it is the pix_per_pix --> infinity limit).
+    """
+    def __init__(self, step = 0.01, points = 2048, quad = 1024, fine = 8192):
+        self.step   = step
+        self.t      = np.linspace(0., 1., points)
+        self.quad   = quad
+        self.fine   = fine
+        self.rows   = {}
+
+    def fraction(self, u, sigma_to_pix):
+        """y(u), the fraction of the photon cloud on a pixel u pixels from its centre."""
+        s = np.sqrt(2.) * sigma_to_pix
+        return 0.5 * (scipy.special.erfc((u - 1.) / s) - scipy.special.erfc(u / s))
+
+    def row(self, node, pix_pad):
+        """The cdf over self.t of the node (sigma_to_pix = exp(node * step)), made if it is not there yet."""
+        key = (int(node), int(pix_pad))
+        if key not in self.rows :
+            sig = np.exp(node * self.step)
+            W   = (pix_pad - 1) / 2.
+            # P(y(u) * y(v) < z) is the mean over v of P(y(u) < z / y(v)),
+            # the latter counted on a fine grid of u (y is 1 to rounding
+            # over much of the pixel for small clouds, so it is not inverted)
+            yf  = np.sort(self.fraction(0.5 + (np.arange(self.fine) + 0.5) * W / self.fine, sig))
+            yq  = self.fraction(0.5 + (np.arange(self.quad) + 0.5) * W / self.quad, sig)
+            z   = self.t * self.fraction(0.5, sig)**2
+            below = np.searchsorted(yf, z[:, np.newaxis] / yq, side='left')
+            self.rows[key] = np.mean(below, axis=1) / float(self.fine)
+        return self.rows[key]
+
+    def hists(self, adus, sigma_to_pix, photon_adu, pix_pad = 3):
+        """single_photon_model for one sigma_to_pix and an array of photon_adu (npix,), returns (npix, adus)."""
+        photon_adu = np.asarray(photon_adu, dtype=np.float64).reshape((-1,))
+        x    = np.log(sigma_to_pix) / self.step
+        node = int(np.floor(x))
+        w    = x - node
+        t    = np.arange(adus + 1, dtype=np.float64) / (photon_adu[:, np.newaxis] * self.fraction(0.5, sigma_to_pix)**2)
+        # (for small clouds much of the charge is at t = 1, the cdf is only 1 above that)
+        cdf  = (1. - w) * np.interp(t, self.t, self.row(node, pix_pad), right = 1.) + \
+               w * np.interp(t, self.t, self.row(node + 1, pix_pad), right = 1.)
+        s01  = np.diff(cdf, axis=1)
+        s01[:, 0] = 0
+        norm = np.sum(s01, axis=1, keepdims=True)
+        s01 /= np.where(norm > 0, norm, 1.)
+        return s01
+
+photon_table = SinglePhotonTable()
 
 def single_photon_model(adus, sigma_to_pix, photon_adu, pix_per_pix, pix_pad, model):
+    key = (int(adus), float(sigma_to_pix), float(photon_adu), int(pix_per_pix), int(pix_pad), model)
     if model=='gaus':
-        return single_photon_model_gaus(adus, sigma_to_pix, photon_adu, pix_per_pix, pix_pad, model)
-    
+        make = single_photon_model_gaus
+    elif model=='gaus_table':
+        make = lambda *a : photon_table.hists(adus, sigma_to_pix, photon_adu, pix_pad)[0]
+    else :
+        make = single_photon_model_circle
+    return kernel_cache.get(key, lambda : make(adus, sigma_to_pix, photon_adu, pix_per_pix, pix_pad, model))
+
+def single_photon_model_circle(adus, sigma_to_pix, photon_adu, pix_per_pix, pix_pad, model):
     N = pix_per_pix * pix_pad
     
     i, j   = np.mgrid[0: N: 1, 0: N: 1]
-    if model=='gaus':
-        photon_cloud = np.exp( - ((i - N/2).astype(np.float64)**2 + (j - N/2).astype(np.float64)**2) \
-                              / (2. * float(sigma_to_pix*pix_per_pix)**2 ))
-    if model=='circle':
-        r = np.sqrt( (i-N/2).astype(np.float64)**2 + (j-N/2).astype(np.float64)**2)
-        photon_cloud = (r < float(sigma_to_pix*pix_per_pix)).astype(np.float64)
+    r = np.sqrt( (i-N/2).astype(np.float64)**2 + (j-N/2).astype(np.float64)**2)
+    photon_cloud = (r < float(sigma_to_pix*pix_per_pix)).astype(np.float64)
     
     photon_cloud = photon_cloud / np.sum(photon_cloud)
     
@@ -63,20 +162,57 @@ def single_photon_model_gaus(adus, sigma_to_pix, photon_adu, pix_per_pix, pix_pa
     sig = sigma_to_pix * pix_per_pix
     y   = 0.5 * (scipy.special.erfc((i-pix_per_pix) / (np.sqrt(2.) * sig)) - scipy.special.erfc(i / (np.sqrt(2.) * sig)))
     
-    yx, yy = np.meshgrid(y, y, indexing='ij', copy=False)
-    y_xy = yx * yy * photon_adu
-    
-    hist, bins = np.histogram(y_xy.ravel(), bins=np.arange(adus + 1)) 
+    hist = separable_hist(y, photon_adu, adus)
     
     s01    = hist.astype(np.float64)
     s01[0] = 0
     s01    = s01 / np.sum(s01)
     return s01
 
+def separable_hist(y, photon_adu, adus):
+    """np.histogram((y_i * y_j) * photon_adu for all i, j, bins = np.arange(adus + 1)) without the 2D grid.
+
+    For each y_i the number of y_j below each bin edge is a searchsorted of
+    the sorted y, nudged by the rounding of the products so that the counts
+    are exactly those of np.histogram. Only the edges up to the largest
+    product are searched (a few tens rather than adus), so this takes
+    len(y) * photon_adu operations rather than len(y)**2.
+    """
+    ys  = np.sort(np.asarray(y, dtype=np.float64))
+    M   = ys.shape[0]
+    yi  = ys[:, np.newaxis]
+    top = (ys[-1] * ys[-1]) * photon_adu
+
+    def below(edges, inclusive = False):
+        """The number of products < edges (<= if inclusive), summed over i."""
+        edges = edges[np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            guess = edges / (yi * photon_adu)
+        guess[np.isnan(guess)] = 0.
+        k = np.searchsorted(ys, guess, side = 'right' if inclusive else 'left')
+        # the products of (y_i * y_j) * photon_adu are sorted along j, so k is
+        # off by at most a few from the rounding of the division
+        lt = (lambda a, b : a <= b) if inclusive else (lambda a, b : a < b)
+        while True :
+            down = (k > 0) & ~lt((yi * ys[np.maximum(k - 1, 0)]) * photon_adu, edges)
+            up   = (k < M) & lt((yi * ys[np.minimum(k, M - 1)]) * photon_adu, edges)
+            if not (np.any(down) or np.any(up)) :
+                break
+            k = k - down + up
+        return np.sum(k, axis=0)
+
+    # the edges above the largest product have every product below them
+    counts = np.full((adus + 1,), M * M, dtype=np.int64)
+    n      = min(adus + 1, int(np.floor(top)) + 1)
+    counts[: n] = below(np.arange(n, dtype=np.float64))
+    # the last bin includes its right edge
+    if adus <= top :
+        counts[adus] = below(np.array([float(adus)]), inclusive = True)[0]
+    return np.diff(counts)
 
 def hist_model(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
                pix_per_pix = 256, pix_pad = 3, model = 'gaus', photons = 3, \
-               ns = 0.2, poisson = True, full_output=False):
+               ns = 0.2, poisson = True, full_output=False, dtype = np.float64):
     """
     Forward simulate a pixel histogram
     
@@ -111,8 +247,10 @@ def hist_model(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
         The number of pixels around the central pixel in the simulation along each dimension. 
         You should probably stick to 3 unless the photon cloud is huge (large sigma_to_pix).
 
-    model : 'gaus' or 'circle'
-        The shape of the photon cloud on the detector.
+    model : 'gaus', 'gaus_table' or 'circle'
+        The shape of the photon cloud on the detector. 'gaus_table' is the
+        gaussian cloud from a table (see SinglePhotonTable), without the
+        pix_per_pix sampling.
 
     poisson : True or False, optional, default (True)
         If True then poisson counting statistics is used to estimate the expectation value
@@ -121,10 +259,13 @@ def hist_model(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
     full_output : True or False, optional, default (True)
         If True then return a python dictionary with extra diagnostics.
 
+    dtype : np.float64 or np.float32, optional, default (np.float64)
+        The precision of the photon order convolutions (see photon_orders).
+
     Returns
     -------
 
-    hist : numpy.ndarray, float64, (N,)
+    hist : numpy.ndarray, dtype, (N,)
         The forward model of the pixel histogram.
 
     info : dictionary (only returned if full_output is True)
@@ -154,18 +295,9 @@ def hist_model(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
     
     s1  = scipy.ndimage.filters.gaussian_filter(s01, photon_sig)
     
-    ss    = np.zeros((photons + 1, s1.shape[0]), dtype=s1.dtype)
-    ss[0] = s0
-    ss[1] = s1
-    
-    for i in range(2, ss.shape[0], 1):
-        ss[i] = np.convolve(ss[i-1], s1, mode='full')[:s0.shape[0]]
+    ss   = photon_orders(s0, s1, photons, dtype)
 
-    for i in range(1, ss.shape[0], 1):
-        ss[i] = np.convolve(ss[i], s0, mode='full')[:s0.shape[0]]
-        ss[i] = ss[i] / np.sum(ss[i])
-
-    fits = ss * ns[:, np.newaxis]
+    fits = ss * ns[:, np.newaxis].astype(ss.dtype)
     fit  = np.sum(fits, axis=0)
     if full_output :
         info = {
@@ -178,8 +310,225 @@ def hist_model(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
     else :
         return fit
 
-from pylab import *
+def photon_values(sigma_to_pix, pix_per_pix, pix_pad, model):
+    """The sorted adu values (per adu of photon_adu) of the simulated pixel for single_photon_model.
+
+    The values scale with photon_adu, so the single photon histogram of any
+    photon_adu follows from these with a searchsorted (see single_photon_hists).
+    """
+    if model == 'gaus':
+        i   = np.arange(int(pix_per_pix/2), int(pix_pad*pix_per_pix/2.), 1.)
+        sig = sigma_to_pix * pix_per_pix
+        y   = 0.5 * (scipy.special.erfc((i-pix_per_pix) / (np.sqrt(2.) * sig)) - scipy.special.erfc(i / (np.sqrt(2.) * sig)))
+        values = np.multiply.outer(y, y).ravel()
+    else :
+        N = pix_per_pix * pix_pad
+        i, j = np.mgrid[0: N: 1, 0: N: 1]
+        r = np.sqrt( (i-N/2).astype(np.float64)**2 + (j-N/2).astype(np.float64)**2)
+        photon_cloud = (r < float(sigma_to_pix*pix_per_pix)).astype(np.float64)
+        photon_cloud = photon_cloud / np.sum(photon_cloud)
+        pixel = np.zeros_like(photon_cloud)
+        pixel[:pix_per_pix, :pix_per_pix] = 1.
+        values = np.abs(np.fft.ifft2( np.fft.fft2(pixel) * np.conj(np.fft.fft2(photon_cloud)) )).ravel()
+    return np.sort(values)
+
+def single_photon_hists(adus, values, photon_adu):
+    """single_photon_model for an array of photon_adu (npix,), given the photon_values, returns (npix, adus)."""
+    photon_adu = np.asarray(photon_adu, dtype=np.float64)
+
+    # the number of values below each bin edge (the last bin includes its right edge, like np.histogram)
+    edges  = np.arange(adus + 1, dtype=np.float64) / photon_adu[:, np.newaxis]
+    below  = np.searchsorted(values, edges[:, :-1], side='left')
+    last   = np.searchsorted(values, edges[:, -1:], side='right')
+    s01    = np.diff(np.concatenate((below, last), axis=1), axis=1).astype(np.float64)
+    s01[:, 0] = 0
+    norm   = np.sum(s01, axis=1, keepdims=True)
+    s01   /= np.where(norm > 0, norm, 1.)
+    return s01
+
+def _by_value(x):
+    """(value, rows) for each of the distinct values of the array x."""
+    u, inverse = np.unique(x, return_inverse=True)
+    if len(u) == 1 :
+        return [(u[0], slice(None))]
+    return [(v, np.where(inverse == k)[0]) for k, v in enumerate(u)]
+
+def photon_weights(ns, photons, npix, poisson = True):
+    """The (npix, photons+1) expectation values of 0, 1, ... photons events (see hist_model)."""
+    import math
+    if poisson :
+        lamb = np.asarray(ns, dtype=np.float64).reshape((-1, 1)) * np.ones((npix, 1))
+        k    = np.arange(photons+1)
+        w    = lamb**k * np.exp(-lamb) / np.array([float(math.factorial(i)) for i in k])
+        return w / np.sum(w, axis=1, keepdims=True)
+    return np.asarray(ns, dtype=np.float64) * np.ones((npix, photons+1))
+
+def next_fft_len(n):
+    try :
+        from scipy.fftpack import next_fast_len
+        return next_fast_len(n)
+    except ImportError :
+        return 2**int(np.ceil(np.log2(n)))
+
+def photon_orders(s0, s1, photons, dtype = np.float64):
+    """
+    The dark, single photon, double photon ... adu distributions of hist_model.
+
+    Order i is s1 convolved with itself i times and then with s0, truncated
+    to the N adus of s0 and normalised. s0 and s1 are fourier transformed
+    once and order i is the inverse transform of S0 * S1**i, with the
+    transforms just long enough, (photons + 1) * (N - 1) + 1, that the first
+    N values do not wrap around. The values come out the same as the
+    np.convolve chain up to the rounding of the ffts, about 1e-16 of the
+    peak in float64 and 1e-7 in float32 (negative values are set to 0).
+
+    Parameters
+    ----------
+    s0, s1 : numpy.ndarray, (..., N)
+        The dark and the (blurred) single photon histograms, of one pixel
+        or a stack of them.
+
+    photons : int
+        The number of photon orders.
+
+    dtype : np.float64 or np.float32
+        The precision of the ffts (scipy.fftpack keeps float32).
+
+    Returns
+    -------
+
+    ss : numpy.ndarray, dtype, (..., photons+1, N)
+        ss[..., 0, :] is s0.
+    """
+    from scipy.fftpack import rfft, irfft
+    s0 = np.asarray(s0, dtype=dtype)
+    N  = s0.shape[-1]
+    # even, so the packed rfft (y0, re1, im1, ..., re(L/2)) is L/2 + 1 complex values
+    L  = 2 * next_fft_len(((photons + 1) * (N - 1) + 2) // 2)
+    ss = np.empty(s0.shape[:-1] + (photons + 1, N), dtype=dtype)
+    ss[..., 0, :] = s0
+
+    ctype = np.result_type(dtype, np.complex64)
+    def to_complex(y):
+        c  = np.zeros(y.shape[:-1] + (L // 2 + 1,), dtype=ctype)
+        cv = c.view(dtype)
+        cv[..., 0]         = y[..., 0]
+        cv[..., 2 : L + 1] = y[..., 1:]
+        return c
+
+    S1 = to_complex(rfft(np.asarray(s1, dtype=dtype), L, axis=-1))
+    S  = to_complex(rfft(s0, L, axis=-1))
+    Sv = S.view(dtype)
+    packed = np.empty(s0.shape[:-1] + (L,), dtype=dtype)
+    for i in range(1, photons + 1, 1):
+        S *= S1
+        packed[..., 0]  = Sv[..., 0]
+        packed[..., 1:] = Sv[..., 2 : L + 1]
+        ss[..., i, :] = irfft(packed, axis=-1, overwrite_x=True)[..., :N]
+
+    si = ss[..., 1:, :]
+    np.maximum(si, 0, out=si)
+    norm = np.sum(si, axis=-1)
+    norm[norm <= 0] = 1.
+    si  /= norm[..., np.newaxis]
+    return ss
+
+def hist_model_batch(s0, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30, \
+                     pix_per_pix = 256, pix_pad = 3, model = 'gaus', photons = 3, \
+                     ns = 0.2, poisson = True, full_output = False, pixels_per_chunk = 4096, \
+                     dtype = np.float64):
+    """
+    Forward simulate the histograms of many pixels at once, see hist_model.
+
+    The same as hist_model for every row of s0, but the photon orders are
+    convolved (see photon_orders) for a chunk of pixels at a time rather
+    than for each pixel.
+
+    Parameters
+    ----------
+    s0 : numpy.ndarray, (npix, N)
+        The (normalised) dark histograms of the pixels.
+
+    sigma_to_pix, photon_sig, photon_adu : float or numpy.ndarray, (npix,)
+        As in hist_model, one for all of the pixels or one for each. The
+        photon cloud is simulated once for each distinct sigma_to_pix (so
+        keep the number of distinct values small) and the single photon
+        histograms of all of the photon_adu follow from it.
+
+    ns : float or numpy.ndarray, (npix,) if poisson, else (photons+1,) or (npix, photons+1)
+        As in hist_model, for all of the pixels or for each.
+
+    pix_per_pix, pix_pad, model, photons, poisson :
+        As in hist_model (the same for all of the pixels).
+
+    pixels_per_chunk : int
+        The number of pixels convolved at a time, the fft buffers take
+        about 32 * (photons + 1) * pixels_per_chunk * N bytes (half that
+        in float32).
+
+    dtype : np.float64 or np.float32
+        The precision of the convolutions and of the output, as in
+        hist_model.
+
+    Returns
+    -------
+
+    hist : numpy.ndarray, dtype, (npix, N)
+        The forward models of the pixel histograms.
+
+    info : dictionary (only returned if full_output is True)
+        As in hist_model with an extra first axis for the pixels
+        (ss and fits are (npix, photons+1, N)).
+    """
+    s0   = np.asarray(s0, dtype=dtype)
+    npix, N = s0.shape
+    ns   = photon_weights(ns, photons, npix, poisson).astype(dtype)
+    photon_adu = np.asarray(photon_adu, dtype=np.float64) * np.ones((npix,))
+    sigma_to_pix = np.asarray(sigma_to_pix, dtype=np.float64) * np.ones((npix,))
+    photon_sig   = np.asarray(photon_sig, dtype=np.float64) * np.ones((npix,))
+
+    # the sorted photon values of each sigma_to_pix are made once
+    values = {}
+    def single_photon(sig, pixels):
+        if model == 'gaus_table' :
+            return photon_table.hists(N, sig, photon_adu[pixels], pix_pad)
+        if sig not in values :
+            values[sig] = photon_values(sig, pix_per_pix, pix_pad, model)
+        return single_photon_hists(N, values[sig], photon_adu[pixels])
+
+    fit  = np.empty_like(s0)
+    if full_output :
+        s01 = np.empty((npix, N), dtype=np.float64)
+        s1  = np.empty((npix, N), dtype=np.float64)
+        ss  = np.empty((npix, photons + 1, N), dtype=dtype)
+    for p in range(0, npix, pixels_per_chunk):
+        q   = slice(p, p + pixels_per_chunk)
+        m   = s0[q].shape[0]
+        s01q = np.empty((m, N), dtype=np.float64)
+        for sig, rows in _by_value(sigma_to_pix[q]):
+            s01q[rows] = single_photon(sig, np.arange(p, p + m)[rows])
+        s1q = np.empty((m, N), dtype=np.float64)
+        for sig, rows in _by_value(photon_sig[q]):
+            s1q[rows] = scipy.ndimage.filters.gaussian_filter1d(s01q[rows], sig, axis=-1)
+
+        ssq    = photon_orders(s0[q], s1q, photons, dtype)
+        fit[q] = np.einsum('ijk,ij->ik', ssq, ns[q])
+        if full_output :
+            s01[q], s1[q], ss[q] = s01q, s1q, ssq
+
+    if full_output :
+        info = {
+                's01': s01,
+                's1' : s1,
+                'ss' : ss,
+                'fits' : ss * ns[:, :, np.newaxis],
+                }
+        return fit, info
+    else :
+        return fit
+
 def figures(sigma_to_pix, pix_per_pix, photon_adu, photon_sig, ss, adus):
+    from pylab import GridSpec, subplot, gcf
     def gaus(sig, N=900):
         i, j   = np.mgrid[0: N: 1, 0: N: 1]
         photon_cloud = np.exp( - ((i - N/2).astype(np.float64)**2 + (j - N/2).astype(np.float64)**2) \
@@ -330,7 +679,8 @@ if __name__ == '__main__':
     # Define the pixel parameters
     adus = np.arange(-100, 401, 1).astype(np.float64)
     dark_sigma = 5. 
-    dark_peak  = np.exp( -adus**2 / (2. * dark_sigma**2)) dark_peak  = dark_peak / np.sum(dark_peak)
+    dark_peak  = np.exp( -adus**2 / (2. * dark_sigma**2))
+    dark_peak  = dark_peak / np.sum(dark_peak)
 
     sigma_to_pix = 0.1
     photon_sig   = 1.5
@@ -341,7 +691,8 @@ if __name__ == '__main__':
     pix_pad      = 3
     model        = 'gaus'
     
-    hist, info = hist_model(dark_peak, sigma_to_pix, photon_sig, photons, ns, photon_adu, pix_per_pix, pix_pad, model, True)
+    hist, info = hist_model(dark_peak, sigma_to_pix, photon_sig, photon_adu, pix_per_pix, pix_pad, model, \
+                            photons, ns, poisson = False, full_output = True)
 
     figures(sigma_to_pix, pix_per_pix, photon_adu, photon_sig, info['ss'], adus)
     
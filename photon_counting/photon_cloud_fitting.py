@@ -1,18 +1,436 @@
+#!/usr/bin/env python
 """
 Fit the following variables to a pixel histogram:
-    sigma_to_pix 
-    photon_sig   
-    ns         
+    sigma_to_pix
+    photon_sig
+    ns
     photon_adu
 
 with the following paramters:
-    adus       
-    dark_peak  
-    photons     
-    pix_per_pix 
-    pix_pad    
-    model     
+    adus
+    dark_peak
+    photons
+    pix_per_pix
+    pix_pad
+    model
 
+for every pixel of a makehist.py histogram, thousands of pixels at a time
+(see forward_pixel_hist.hist_model_batch for the model).
+
+sigma_to_pix (the size of the photon cloud) and photon_sig (the spread of
+the gain) are shared by all of the pixels, photon_adu (the gain) and ns
+(the poisson photon rate) are fitted for each pixel. The dark peak of each
+pixel (dark_peak) is taken from its own histogram: the half below the peak
+only has zero photon events in it, so it is mirrored about the peak.
+
+The per-pixel fit is batched (no loop over pixels), each iteration:
+    ns         : a few EM updates, the expected number of photons of every
+                 event given the photon order distributions and the rates,
+                 then the rate of the (cut at photons) poisson distribution
+                 with that mean, with photon_adu fixed
+    photon_adu : one Newton step on the negative log likelihood from finite
+                 differences, keeping the best of the step and the stencil
+                 points, so the likelihood never goes up
+
+The shared parameters are fitted first on a random sample of pixels, by
+Nelder-Mead on the likelihood with the per-pixel parameters fitted at every
+point (they are too correlated with the gains to fit one after the other),
+and then kept fixed for the per-pixel fit of every pixel.
+
+Every pixel is then fitted by a pool of processes (see pixel_pool.py), a
+tile of pixels_per_chunk pixels per task.
+
+If [input] dark is given (a makehist.py histogram of a dark run with the
+same bins) the dark histograms are used rather than the mirrored peaks.
+
+    $ OMP_NUM_THREADS=1 python photon_cloud_fitting.py -c config.ini -j 16
 """
 
+import sys
+import os
+import argparse
+import ConfigParser
+import string
+import time
+import numpy as np
+import scipy.optimize
+
+from forward_pixel_hist import hist_model_batch, photon_weights
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'histogram'))
+from sparse_hist import read_pixels
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'photon_cloud_fitting.py', description='fit the gain and photon rate of every pixel of a makehist.py histogram')
+    parser.add_argument('-c', '--config', type=str, \
+                        help="file name of the configuration file")
+    parser.add_argument('-i', '--input', type=str, \
+                        help="the histogram file, overrides the config file")
+    parser.add_argument('-o', '--output', type=str, \
+                        help="the output file, overrides the config file")
+    parser.add_argument('-j', '--processes', type=int, \
+                        help="number of processes to fit the pixels with, overrides the config file (default all cores)")
+    args = parser.parse_args()
+
+    # check that args.ini exists
+    if args.config is None :
+        args.config = 'config.ini'
+    if not os.path.exists(args.config):
+        raise NameError('config file does not exist: ' + args.config)
+    return args
+
+def parse_parameters(config):
+    """
+    Parse values from the configuration file and sets internal parameter accordingly
+    The parameter dictionary is made available to both the workers and the master nodes
+    The parser tries to interpret an entry in the configuration file as follows:
+    - If the entry starts and ends with a single quote, it is interpreted as a string
+    - If the entry is the word None, without quotes, then the entry is interpreted as NoneType
+    - If the entry is the word False, without quotes, then the entry is interpreted as a boolean False
+    - If the entry is the word True, without quotes, then the entry is interpreted as a boolean True
+    - If non of the previous options match the content of the entry, the parser tries to interpret the entry in order as:
+        - An integer number
+        - A float number
+        - A string
+      The first choice that succeeds determines the entry type
+    """
+
+    monitor_params = {}
+
+    for sect in config.sections():
+        monitor_params[sect]={}
+        for op in config.options(sect):
+            monitor_params[sect][op] = config.get(sect, op)
+            if monitor_params[sect][op].startswith("'") and monitor_params[sect][op].endswith("'"):
+                monitor_params[sect][op] = monitor_params[sect][op][1:-1]
+                continue
+            if monitor_params[sect][op] == 'None':
+                monitor_params[sect][op] = None
+                continue
+            if monitor_params[sect][op] == 'False':
+                monitor_params[sect][op] = False
+                continue
+            if monitor_params[sect][op] == 'True':
+                monitor_params[sect][op] = True
+                continue
+            try:
+                monitor_params[sect][op] = int(monitor_params[sect][op])
+                continue
+            except :
+                try :
+                    monitor_params[sect][op] = float(monitor_params[sect][op])
+                    continue
+                except :
+                    # attempt to pass as an array of ints e.g. '1, 2, 3'
+                    try :
+                        l = monitor_params[sect][op].split(',')
+                        monitor_params[sect][op] = np.array(l, dtype=np.int)
+                        continue
+                    except :
+                        pass
+
+    return monitor_params
+
+def mirrored_dark(hist):
+    """The (normalised) dark peaks of the histograms (npix, N): the part up to the peak mirrored about it.
+
+    The centre of each peak is found to a fraction of a bin from a parabola
+    through the log of the three bins around the largest one, and the
+    mirrored values are interpolated between bins.
+
+    Returns:
+        s0 (numpy.ndarray): (npix, N) float64.
+        peak (numpy.ndarray): (npix,) the centre of each peak (in bins).
+        n0 (numpy.ndarray): (npix,) the counts under each dark peak.
+    """
+    npix, N = hist.shape
+    rows = np.arange(npix)[:, np.newaxis]
+    peak = np.argmax(hist, axis=1)
+    l    = np.log(np.maximum(hist[rows, np.clip(peak[:, np.newaxis] + np.arange(-1, 2), 0, N - 1)], 0.5))
+    curv = l[:, 0] - 2. * l[:, 1] + l[:, 2]
+    c    = peak + np.clip(0.5 * (l[:, 0] - l[:, 2]) / np.where(curv < 0, curv, -1.), -0.5, 0.5)
+
+    k    = np.arange(N)
+    x    = np.where(k <= c[:, np.newaxis], k, 2. * c[:, np.newaxis] - k)
+    j    = np.floor(x).astype(np.int64)
+    t    = x - j
+    def at(i):
+        return np.where((i >= 0) & (i < N), hist[rows, np.clip(i, 0, N - 1)], 0.)
+    s0   = (1. - t) * at(j) + t * at(j + 1)
+    n0   = np.sum(s0, axis=1)
+    s0  /= np.where(n0 > 0, n0, 1.)[:, np.newaxis]
+    return s0, c, n0
+
+def truncated_poisson_rate(mean, photons, rate = None, steps = 10):
+    """The rate whose poisson distribution, cut at photons, has this mean (Newton, vectorised)."""
+    mean = np.clip(np.asarray(mean, dtype=np.float64), 1e-6, photons * (1. - 1e-6))
+    rate = mean.copy() if rate is None else np.asarray(rate, dtype=np.float64).copy()
+    k    = np.arange(photons + 1)
+    for i in range(steps):
+        w  = photon_weights(rate, photons, rate.shape[0])
+        m  = np.sum(w * k, axis=1)
+        v  = np.sum(w * k**2, axis=1) - m**2
+        # d mean / d rate = variance / rate
+        rate += (mean - m) * rate / np.maximum(v, 1e-12)
+        rate  = np.clip(rate, 1e-6, 10. * photons)
+    return rate
+
+def neg_log_likelihood(hist, model, floor = 1e-12):
+    """-sum hist * log(model) for each row (the multinomial likelihood without the constant)."""
+    return -np.sum(hist * np.log(np.maximum(model, floor)), axis=-1)
+
+def fit_pixels(hist, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30., photons = 3, \
+               pix_per_pix = 256, pix_pad = 3, model = 'gaus', iterations = 20, em_steps = 3, \
+               delta = 0.25, max_step = 2., tol = 1e-3, pixels_per_chunk = 4096, s0 = None, rate = None):
+    """
+    Fit photon_adu and the photon rate of many pixels, with sigma_to_pix and photon_sig fixed.
+
+    Parameters
+    ----------
+    hist : numpy.ndarray, (npix, N)
+        The adu histograms of the pixels (one adu per bin).
+
+    s0 : numpy.ndarray, (npix, N), optional
+        The dark histograms of the pixels (e.g. makehist.py of a dark run,
+        with the same bins). If None the dark peak of each histogram is
+        mirrored, but that includes the photon events that left (almost) no
+        charge on the pixel, so the rates come out a few percent low.
+
+    photon_adu : float or numpy.ndarray, (npix,)
+        The starting gains.
+
+    rate : numpy.ndarray, (npix,), optional
+        The starting rates, if None from the zero photon fraction.
+
+    iterations : int
+        The maximum number of (EM, Newton) iterations, pixels stop when the
+        gain moves less than tol adus and the rate less than tol.
+
+    delta, max_step : float
+        The finite difference step and the largest Newton step in adus.
+
+    sigma_to_pix, photon_sig, photons, pix_per_pix, pix_pad, model, pixels_per_chunk :
+        See forward_pixel_hist.hist_model_batch.
+
+    Returns
+    -------
+    fit : dictionary
+        {'photon_adu' : (npix,), 'rate' : (npix,), 'dark_peak' : (npix,) the
+        bin of the dark peak, 'nll' : (npix,) the negative log likelihood per
+        count, 'converged' : (npix,) bool, 'iterations' : (npix,)}
+        Pixels without counts get NaN.
+    """
+    hist  = np.asarray(hist, dtype=np.float64)
+    npix  = hist.shape[0]
+    total = np.sum(hist, axis=1)
+    s0m, peak, n0 = mirrored_dark(hist)
+    if s0 is None :
+        s0 = s0m
+    else :
+        s0 = np.asarray(s0, dtype=np.float64)
+        s0 = s0 / np.maximum(np.sum(s0, axis=1, keepdims=True), 1e-300)
+
+    gain = np.asarray(photon_adu, dtype=np.float64) * np.ones((npix,))
+    # the zero photon fraction is exp(-rate)
+    if rate is None :
+        rate = -np.log(np.clip(n0 / np.where(total > 0, total, 1.), 1e-6, 1.))
+    rate = np.clip(np.asarray(rate, dtype=np.float64) * np.ones((npix,)), 1e-4, photons)
+
+    kwargs = {'sigma_to_pix' : sigma_to_pix, 'photon_sig' : photon_sig, 'pix_per_pix' : pix_per_pix, \
+              'pix_pad' : pix_pad, 'model' : model, 'photons' : photons, 'pixels_per_chunk' : pixels_per_chunk}
+    k = np.arange(photons + 1)
+
+    def nll(rows, g, r):
+        return neg_log_likelihood(hist[rows], hist_model_batch(s0[rows], photon_adu = g, ns = r, **kwargs))
+
+    converged = total <= 0
+    its       = np.zeros((npix,), dtype=np.int64)
+    f         = np.zeros((npix,))
+    for it in range(iterations):
+        rows = np.nonzero(~converged)[0]
+        if len(rows) == 0 :
+            break
+        its[rows] += 1
+        h = hist[rows]
+
+        # EM for the rate: the expected photon number of each event
+        fit, info = hist_model_batch(s0[rows], photon_adu = gain[rows], ns = rate[rows], full_output = True, **kwargs)
+        ss = info['ss']
+        r  = rate[rows]
+        for e in range(em_steps):
+            comp  = ss * photon_weights(r, photons, len(rows))[:, :, np.newaxis]
+            tot   = np.sum(comp, axis=1)
+            tot   = np.where(tot > 0, tot, 1.)
+            mean  = np.sum(h * np.sum(comp * k[:, np.newaxis], axis=1) / tot, axis=1) / total[rows]
+            r     = truncated_poisson_rate(mean, photons, r)
+
+        # Newton for the gain, keep the best of the stencil and the step
+        g   = gain[rows]
+        f0  = nll(rows, g, r)
+        fm  = nll(rows, g - delta, r)
+        fp  = nll(rows, g + delta, r)
+        d1  = (fp - fm) / (2. * delta)
+        d2  = (fp - 2. * f0 + fm) / delta**2
+        step = np.where(d2 > 0, -d1 / np.where(d2 > 0, d2, 1.), -np.sign(d1) * max_step)
+        step = np.clip(step, -max_step, max_step)
+        fs   = nll(rows, g + step, r)
+
+        cands = np.array([g, g - delta, g + delta, g + step])
+        fc    = np.array([f0, fm, fp, fs])
+        best  = np.argmin(fc, axis=0)
+        g_new = cands[best, np.arange(len(rows))]
+
+        converged[rows] = (np.abs(g_new - g) < tol) & (np.abs(r - rate[rows]) < tol)
+        gain[rows] = g_new
+        rate[rows] = r
+        f[rows]    = fc[best, np.arange(len(rows))]
+
+    empty = total <= 0
+    out = {'photon_adu' : gain, 'rate' : rate, 'dark_peak' : peak.astype(np.float64), \
+           'nll' : f / np.where(total > 0, total, 1.), 'converged' : converged & ~empty, 'iterations' : its}
+    for key in ['photon_adu', 'rate', 'dark_peak', 'nll'] :
+        out[key][empty] = np.nan
+    return out
+
+def fit_global(hist, sigma_to_pix = 0.1, photon_sig = 1.5, photon_adu = 30., rounds = 3, **kwargs):
+    """
+    Fit sigma_to_pix and photon_sig (shared by all of the pixels) to a sample of pixel histograms.
+
+    The gains of the pixels and sigma_to_pix, photon_sig are strongly
+    correlated, so they can not be fitted one after the other. Instead
+    Nelder-Mead minimises the profile likelihood of (log sigma_to_pix, log
+    photon_sig): the summed likelihood with the per-pixel gains and rates
+    fitted (a few iterations from the last ones). The simplex is restarted
+    'rounds' times from the last best point. kwargs are passed to fit_pixels
+    (including s0, the dark histograms, if there are any). Pixels without
+    counts are left out.
+
+    With mirrored dark peaks (no s0) the photon events near 0 adu are missing
+    from the model, and photon_sig comes out too large to make up for them,
+    so give s0 if there is a dark run.
+
+    Returns
+    -------
+    sigma_to_pix, photon_sig : float
+    fit : dictionary, the per-pixel fit of the sample (see fit_pixels)
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    good = np.sum(hist, axis=1) > 0
+    hist = hist[good]
+    if kwargs.get('s0') is None :
+        kwargs['s0'] = mirrored_dark(hist)[0]
+    else :
+        kwargs['s0'] = np.asarray(kwargs['s0'], dtype=np.float64)[good]
+    inner = dict(kwargs, iterations = min(kwargs.get('iterations', 20), 4))
+
+    fit   = fit_pixels(hist, sigma_to_pix, photon_sig, photon_adu, **kwargs)
+    start = {'photon_adu' : fit['photon_adu'], 'rate' : fit['rate']}
+
+    def f(x):
+        fx = fit_pixels(hist, np.exp(x[0]), np.exp(x[1]), start['photon_adu'], rate = start['rate'], **inner)
+        return np.sum(fx['nll'] * np.sum(hist, axis=1))
+
+    x = np.log([sigma_to_pix, photon_sig])
+    for r in range(rounds):
+        res = scipy.optimize.minimize(f, x, method = 'Nelder-Mead', options = {'xatol' : 1e-2, 'fatol' : 1e-1})
+        if np.allclose(res.x, x, atol = 1e-2) :
+            break
+        x = res.x
+        # warm start from the best point so far
+        fit   = fit_pixels(hist, np.exp(x[0]), np.exp(x[1]), start['photon_adu'], rate = start['rate'], **kwargs)
+        start = {'photon_adu' : fit['photon_adu'], 'rate' : fit['rate']}
+
+    sigma_to_pix, photon_sig = np.exp(x)
+    fit = fit_pixels(hist, sigma_to_pix, photon_sig, start['photon_adu'], rate = start['rate'], **kwargs)
+    return sigma_to_pix, photon_sig, fit
+
+def hist_pixels(fnam, h5path):
+    """The pixel shape of the histogram in a makehist.py output (dense or windowed)."""
+    import h5py
+    f    = h5py.File(fnam, 'r')
+    node = f[h5path]
+    if isinstance(node, h5py.Dataset) :
+        shape = node.shape[:-1]
+    else :
+        shape = tuple(node.attrs['shape'])
+    f.close()
+    return shape
+
+
+if __name__ == '__main__':
+    args = parse_cmdline_args()
+    from pixel_pool import load_histograms, fit_all
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config)
+    params = parse_parameters(config)
+    fparams = params['fit']
+
+    def fnam_of(section):
+        h5name = params[section]['fnam']
+        if params[section].get('match', True) :
+            h5name = string.replace(h5name, 'exp', params['source']['exp'])
+            h5name = string.replace(h5name, 'run', 'r' + str(params['source']['run']).zfill(4))
+        return params[section]['h5dir'] + h5name
+
+    fnam   = args.input  or fnam_of('input')
+    output = args.output or fnam_of('output')
+    h5path = params['input']['h5path']
+    shape  = hist_pixels(fnam, h5path)
+    npix   = int(np.prod(shape))
+    print 'fitting', npix, 'pixels of', fnam + ':' + h5path
+
+    kwargs = {'photons' : fparams.get('photons', 3), 'pix_per_pix' : fparams.get('pix_per_pix', 256), \
+              'pix_pad' : fparams.get('pix_pad', 3), 'model' : fparams.get('model', 'gaus'), \
+              'iterations' : fparams.get('iterations', 20), 'pixels_per_chunk' : fparams.get('pixels_per_chunk', 4096)}
+
+    # only fit the bins in adu_range (the dark peak and the first few photon peaks)
+    hist, bins = read_pixels(fnam, h5path, [0])
+    adus = np.arange(hist.shape[1]) if bins is None else np.asarray(bins[:-1], dtype=np.float64)
+    if bins is not None and np.any(np.diff(bins) != 1) :
+        raise ValueError('the histogram bins must be one adu wide')
+    lo, hi = fparams.get('adu_range', (adus[0], adus[-1] + 1))
+    cols   = np.nonzero((adus >= lo) & (adus < hi))[0]
+    cols   = slice(cols[0], cols[-1] + 1)
+
+    # read once, the processes that fit the pixels share them
+    t0 = time.time()
+    hist, hist_cols = load_histograms(fnam, h5path, cols)
+    dark, dark_cols = None, None
+    if params['input'].get('dark') is not None :
+        if read_pixels(params['input']['dark'], h5path, [0])[0].shape[1] != len(adus) :
+            raise ValueError('the dark histogram must have the same bins as ' + fnam)
+        dark, dark_cols = load_histograms(params['input']['dark'], h5path, cols)
+        print 'dark histograms from', params['input']['dark']
+    print 'histograms', 'memory mapped' if isinstance(hist, np.memmap) else 'loaded', 'in {0:.1f}s'.format(time.time() - t0)
+
+    # the shared parameters from a random sample of pixels
+    rng    = np.random.RandomState(0)
+    sample = np.sort(rng.choice(npix, min(npix, fparams.get('global_pixels', 500)), replace = False))
+    t0     = time.time()
+    sigma_to_pix, photon_sig, fit = fit_global(hist[sample, hist_cols], \
+                                               fparams.get('sigma_to_pix', 0.1), fparams.get('photon_sig', 1.5), \
+                                               fparams.get('photon_adu', 30.), fparams.get('global_rounds', 3), \
+                                               s0 = None if dark is None else dark[sample, dark_cols], **kwargs)
+    print 'sigma_to_pix: {0:.4f} photon_sig: {1:.3f} (from {2} pixels in {3:.1f}s)'.format(sigma_to_pix, photon_sig, len(sample), time.time() - t0)
+    photon_adu = np.nanmedian(fit['photon_adu'])
+
+    # then every pixel, a tile of pixels_per_chunk pixels per task
+    processes = args.processes or fparams.get('processes')
+    maps = fit_all(hist, hist_cols, dict(kwargs, sigma_to_pix = sigma_to_pix, photon_sig = photon_sig, photon_adu = photon_adu), \
+                   dark, dark_cols, processes, kwargs['pixels_per_chunk'], fparams.get('retries', 2))
+    maps['dark_peak'] = adus[cols][0] + maps['dark_peak']
 
+    print 'converged:', np.sum(maps['converged']), 'of', npix, 'pixels'
+    print 'outputing to', output
+    import h5py
+    f = h5py.File(output, 'w')
+    f.create_dataset('gain', data = maps['photon_adu'].reshape(shape))
+    f.create_dataset('photon_rate', data = maps['rate'].reshape(shape))
+    f.create_dataset('dark_peak', data = maps['dark_peak'].reshape(shape))
+    f.create_dataset('nll', data = maps['nll'].reshape(shape))
+    f.create_dataset('converged', data = maps['converged'].reshape(shape))
+    f.create_dataset('iterations', data = maps['iterations'].reshape(shape))
+    for k, v in [('sigma_to_pix', sigma_to_pix), ('photon_sig', photon_sig), ('histogram', fnam + ':' + h5path)] + kwargs.items():
+        f.attrs[k] = v
+    f.close()
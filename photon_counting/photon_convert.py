@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+Convert every frame of a run into photon counts, with the darkcal and the
+gain map from photon_cloud_fitting.py, and output the photon sum of every
+pixel and a sparse list of the photons of every frame.
+
+Each frame is dark (and common mode) corrected, divided by the gain of each
+pixel and then counted:
+
+    photons = floor(adu / gain + 1 - threshold)     (0 if negative)
+
+so with threshold = 0.5 this is the nearest whole number of photons. With
+droplets = True the pixels above droplet_threshold (in photons) that touch
+(along the rows and columns of a panel) are grouped into droplets first,
+the photons of each droplet are counted from its summed signal and all put
+on its brightest pixel, so that a photon shared by two pixels is counted
+once.
+
+The frames are shared by the mpi processes in chunks, as in darkcal.py.
+Every flush_buffers buffers each process appends its photon lists to a file
+of its own next to the output (e.g. exp-run-CsPad-photons-lists-rank003.h5),
+at the end rank 0 copies them into the output in event order and they are
+removed. The output has:
+
+    data/data          the photon sum of every pixel (int64)
+    number of frames
+    photons/event      (frames, 2) the (run, index) of every frame, in order
+    photons/start      (frames + 1,) the photons of frame i are in [start[i], start[i+1])
+    photons/pixel      the flat pixel index of each entry
+    photons/count      the number of photons on it
+
+    $ mpirun -np 16 python photon_convert.py -c config.ini
+"""
+
+import sys
+import os
+import argparse
+import ConfigParser
+import string
+import numpy as np
+import scipy.ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from prefetch import Prefetcher
+from event_source import open_source, exp_run, psana_obj_from_string, run_label, first_event
+from detector import detector_kind, frame_shape, fill_frame
+from scheduler import SharedCounter, dynamic_chunks, report_load
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'histogram'))
+from common_mode import common_mode, check_common_mode
+
+from photon_cloud_fitting import parse_parameters
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'mpirun -np [NUM] [OPTIONS] photon_convert.py', description='convert the frames of a run into photon counts')
+    parser.add_argument('-c', '--config', type=str, \
+                        help="file name of the configuration file")
+    parser.add_argument('-s', '--source', type=str, \
+                help="psana source string (e.g exp=cxi01516:run=10:idx)")
+    args = parser.parse_args()
+
+    # check that args.ini exists
+    if args.config is None :
+        args.config = 'config.ini'
+    if not os.path.exists(args.config):
+        raise NameError('config file does not exist: ' + args.config)
+    return args
+
+def read_map(value, shape, h5path, dtype = np.float32):
+    """A per-pixel map: value everywhere if it is a number, or fnam:h5path if it is a file name (None stays None)."""
+    if value is None :
+        return None
+    if isinstance(value, str) :
+        import h5py
+        f = h5py.File(value, 'r')
+        value = f[h5path][()]
+        f.close()
+        return np.asarray(value, dtype = dtype).reshape(shape)
+    return np.full(shape, value, dtype = dtype)
+
+def count_photons(buffer, threshold, out):
+    """Write floor(buffer + 1 - threshold) (buffer in photons, negatives as 0) into the integer array out.
+
+    buffer is overwritten. The cast to integers truncates, which is the
+    floor once the negatives are clipped.
+    """
+    np.subtract(buffer, threshold - 1., out = buffer)
+    np.maximum(buffer, 0, out = buffer)
+    np.minimum(buffer, np.iinfo(out.dtype).max, out = buffer)
+    out[:] = buffer
+    return out
+
+def droplet_structure(ndim):
+    """Pixels touch along the last two axes only (the rows and columns of a panel)."""
+    s = np.zeros((3,) * ndim, dtype=np.bool)
+    s[(1,) * (ndim - 2)] = [[False, True, False], [True, True, True], [False, True, False]]
+    return s
+
+def count_droplets(frame, threshold, droplet_threshold, structure, out):
+    """Count the photons of one frame (in photons) by droplets into the integer array out.
+
+    The photons of each droplet, floor(sum + 1 - threshold) with the
+    threshold of its brightest pixel, are all put on that pixel.
+    """
+    out[:] = 0
+    labels, n = scipy.ndimage.label(frame > droplet_threshold, structure)
+    if n == 0 :
+        return out
+    lab   = labels.ravel()
+    pix   = np.nonzero(lab)[0]
+    lab   = lab[pix]
+    value = frame.ravel()[pix]
+    sums  = np.bincount(lab, weights = value, minlength = n + 1)
+    # the brightest pixel of each droplet is the last of its label when sorted by (label, value)
+    order = np.lexsort((value, lab))
+    last  = np.nonzero(np.diff(np.append(lab[order], n + 1)))[0]
+    top   = pix[order[last]]
+    t     = threshold.ravel()[top] if np.ndim(threshold) > 0 else threshold
+    counts = np.floor(sums[lab[order[last]]] + 1. - t)
+    out.ravel()[top] = np.clip(counts, 0, np.iinfo(out.dtype).max)
+    return out
+
+def lists_fnam(fnam, rank):
+    """The file that a rank appends its photon lists to for the output file fnam."""
+    base, ext = os.path.splitext(fnam)
+    return base + '-lists-rank' + str(rank).zfill(3) + ext
+
+class PhotonLists(object):
+    """The sparse photons of the frames of one rank, a block of arrays per run of consecutive events.
+
+    Each block is (position of its first event in the list of all events,
+    (frames, 2) events, (frames + 1,) start, pixel, count). The blocks are
+    kept until flush_buffers buffers have been added and then appended to
+    the datasets 'event', 'photons' (per frame), 'pixel' and 'count' of the
+    file fnam, and index gets the (first event, first frame, frames, first
+    photon, photons) of each block in the file.
+    """
+    def __init__(self, fnam, count_dtype, flush_buffers = 16):
+        self.fnam   = fnam
+        self.count_dtype   = np.dtype(count_dtype)
+        self.flush_buffers = flush_buffers
+        self.blocks  = []
+        self.index   = []
+        self.buffers = 0
+        self.frames  = 0
+        self.photons = 0
+        if os.path.exists(fnam) :
+            os.remove(fnam)
+
+    def add_buffer(self, counts, positions, events):
+        """Add the (frames,) + shape counts of the events at these positions in the list of all events."""
+        npix  = counts[0].size
+        # a buffer can hold the end of one chunk and the start of the next
+        cuts  = [0] + list(np.nonzero(np.diff(positions) != 1)[0] + 1) + [len(positions)]
+        for a, b in zip(cuts[:-1], cuts[1:]):
+            index = np.flatnonzero(counts[a : b])
+            frame = index // npix
+            start = np.zeros((b - a + 1,), dtype=np.int64)
+            start[1 :] = np.cumsum(np.bincount(frame, minlength = b - a))
+            self.blocks.append((positions[a], np.array(events[a : b], dtype=np.int64).reshape((-1, 2)), start, \
+                                (index - frame * npix).astype(np.int32), counts[a : b].ravel()[index]))
+        self.buffers += 1
+        if self.buffers % self.flush_buffers == 0 :
+            self.flush()
+
+    def flush(self):
+        """Append the blocks to the file and forget them."""
+        if len(self.blocks) == 0 :
+            return
+        import h5py
+        frames  = sum([len(b[1]) for b in self.blocks])
+        photons = sum([len(b[3]) for b in self.blocks])
+        f = h5py.File(self.fnam, 'a')
+        if 'event' not in f :
+            f.create_dataset('event', (0, 2), dtype = np.int64, maxshape = (None, 2), chunks = (4096, 2))
+            f.create_dataset('photons', (0,), dtype = np.int64, maxshape = (None,), chunks = (4096,))
+            f.create_dataset('pixel', (0,), dtype = np.int32, maxshape = (None,), chunks = (2**18,))
+            f.create_dataset('count', (0,), dtype = self.count_dtype, maxshape = (None,), chunks = (2**18,))
+        for k in ['event', 'photons'] :
+            f[k].resize(self.frames + frames, axis = 0)
+        for k in ['pixel', 'count'] :
+            f[k].resize((self.photons + photons,))
+        i, p = self.frames, self.photons
+        for first, events, start, pixel, count in self.blocks :
+            n, m = len(events), len(pixel)
+            f['event'][i : i + n]   = events
+            f['photons'][i : i + n] = np.diff(start)
+            f['pixel'][p : p + m]   = pixel
+            f['count'][p : p + m]   = count
+            self.index.append((first, i, n, p, m))
+            i += n
+            p += m
+        f.close()
+        self.frames, self.photons = i, p
+        self.blocks = []
+
+def write_lists(comm, fnam, lists, count_dtype):
+    """Write the PhotonLists of every rank into the group 'photons' of fnam (collective).
+
+    Every rank flushes its lists into its file and sends the index of its
+    blocks to rank 0, which copies the blocks from the files of all ranks
+    in event order: the blocks do not overlap, so sorting them by their
+    first event sorts all of the frames. Only the index is sent, the lists
+    files must be on a file system that rank 0 can read. They are removed
+    once they have been copied.
+    """
+    import h5py
+    rank  = comm.Get_rank()
+    lists.flush()
+    index = [(b[0], rank) + b[1 :] for b in lists.index]
+    index = comm.gather(index, root=0)
+    fnams = comm.gather(lists.fnam, root=0)
+    if rank == 0 :
+        index  = sorted([i for r in index for i in r])
+        frames = sum([i[3] for i in index])
+        total  = sum([i[5] for i in index])
+        f = h5py.File(fnam, 'a')
+        g = f.create_group('photons')
+        events = g.create_dataset('event', (frames, 2), dtype = np.int64)
+        start  = g.create_dataset('start', (frames + 1,), dtype = np.int64)
+        pixel  = g.create_dataset('pixel', (total,), dtype = np.int32, chunks = (min(max(total, 1), 2**20),))
+        count  = g.create_dataset('count', (total,), dtype = count_dtype, chunks = (min(max(total, 1), 2**20),))
+        start[0] = 0
+        files  = {}
+        i, p = 0, 0
+        for first, r, i0, n, p0, m in index :
+            if r not in files :
+                files[r] = h5py.File(fnams[r], 'r')
+            lf = files[r]
+            events[i : i + n]        = lf['event'][i0 : i0 + n]
+            start[i + 1 : i + n + 1] = p + np.cumsum(lf['photons'][i0 : i0 + n])
+            pixel[p : p + m]         = lf['pixel'][p0 : p0 + m]
+            count[p : p + m]         = lf['count'][p0 : p0 + m]
+            i += n
+            p += m
+        for lf in files.values():
+            lf.close()
+        f.close()
+    comm.barrier()
+    if os.path.exists(lists.fnam) :
+        os.remove(lists.fnam)
+
+
+if __name__ == "__main__":
+    args = parse_cmdline_args()
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config)
+    params  = parse_parameters(config)
+    cparams = params['convert']
+
+    if args.source is None :
+        source = 'exp='+params['source']['exp']+':'+'run='+str(params['source']['run'])+':idx'
+    else :
+        source = args.source
+    exp, run = exp_run(source)
+
+    psana, ds = open_source(source)
+    import h5py
+
+    detector_psana_source = psana.Source(params['source']['detector_psana_source'])
+    detector_psana_type   = psana_obj_from_string(params['source']['detector_psana_type'], psana)
+
+    # all of the runs of the source (e.g. run=139-152), their events are
+    # shared by all of the processes together rather than run by run
+    runs    = list(ds.runs())
+    numbers = [r.run() for r in runs]
+    times   = dict((r.run(), r.times()) for r in runs)
+    runs    = dict(zip(numbers, runs))
+
+    h5name = cparams['fnam']
+    if cparams.get('match', True) :
+        h5name = string.replace(h5name, 'exp', exp)
+        h5name = string.replace(h5name, 'run', run_label(numbers))
+    h5name = cparams['h5dir'] + h5name
+
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    if rank == 0 : print '\nOutputing to :', h5name
+
+    # the first event (of the first run with any) sets the detector kind,
+    # frame shape and data type of the buffers
+    first, t = first_event(numbers, times)
+    im    = runs[first].event(t).get(detector_psana_type, detector_psana_source)
+    kind  = detector_kind(im)
+    shape, dtype = frame_shape(im, kind)
+    if rank == 0 : print 'detector:', kind, shape, dtype
+
+    def evt_to_array(evt, out):
+        """Write the detector data of an event straight into out."""
+        return fill_frame(evt.get(detector_psana_type, detector_psana_source), kind, out)
+
+    # the darkcal, gains, thresholds and mask (read on rank 0 and broadcast)
+    if rank == 0 :
+        f = h5py.File(cparams['darkcal'], 'r')
+        darkcal = (f['data/data'][()].astype(np.float64) / float(f['number of frames'][()])).astype(np.float32).reshape(shape)
+        f.close()
+        gain      = read_map(cparams.get('gain', 30.), shape, cparams.get('gain_h5path', 'gain'))
+        threshold = read_map(cparams.get('threshold', 0.5), shape, cparams.get('threshold_h5path', 'data/data'))
+        mask      = read_map(cparams.get('mask'), shape, cparams.get('mask_h5path', 'data/mask'), np.bool)
+        # bad and unfitted pixels never count photons
+        good = np.isfinite(gain) & (gain > 0)
+        if mask is not None :
+            good &= mask
+        inv_gain = np.where(good, 1. / np.where(good, gain, 1.), 0.).astype(np.float32)
+        if not np.any(threshold != threshold.flat[0]) :
+            threshold = threshold.flat[0]
+        print 'pixels that count photons:', np.sum(good), 'of', good.size
+    else :
+        darkcal, inv_gain, threshold = None, None, None
+    darkcal   = comm.bcast(darkcal, root=0)
+    inv_gain  = comm.bcast(inv_gain, root=0)
+    threshold = comm.bcast(threshold, root=0)
+
+    # pixels to estimate the common mode from (for common_mode = masked)
+    common_mode_mask = None
+    if cparams.get('common_mode_mask') is not None :
+        f = h5py.File(cparams['common_mode_mask'], 'r')
+        common_mode_mask = f['data/data'][()].astype(np.bool)
+        f.close()
+    common_mode_method = cparams.get('common_mode', 'median')
+    common_mode_kwargs = check_common_mode(common_mode_method, kind, common_mode_mask)
+
+    buffer_size = cparams.get('buffer_size', 32)
+    chunk_size  = cparams.get('chunk_size', buffer_size)
+    droplets    = cparams.get('droplets', False)
+    droplet_threshold = cparams.get('droplet_threshold', 0.3)
+    sparse      = cparams.get('sparse', True)
+    count_dtype = np.dtype(cparams.get('count_dtype', 'uint8'))
+    structure   = droplet_structure(len(shape))
+
+    work   = np.empty((buffer_size,) + shape, dtype=np.float32)
+    counts = np.empty((buffer_size,) + shape, dtype=count_dtype)
+    total  = np.zeros(shape, dtype=np.int64)
+    lists  = PhotonLists(lists_fnam(h5name, rank), count_dtype, cparams.get('flush_buffers', 16))
+
+    def convert(buffer, counts):
+        w  = work[: buffer.shape[0]]
+        w[:] = buffer
+        w -= darkcal
+        common_mode(w, common_mode_method, mask = common_mode_mask, **common_mode_kwargs)
+        w *= inv_gain
+        if droplets :
+            for i in range(w.shape[0]):
+                count_droplets(w[i], threshold, droplet_threshold, structure, counts[i])
+        else :
+            count_photons(w, threshold, counts)
+        return counts
+
+    events = [(number, i) for number in numbers for i in range(len(times[number]))]
+    if rank == 0 :
+        print 'Number of frames to process:', len(events), 'in', len(numbers), 'runs'
+        print 'Each process takes', chunk_size, 'frames at a time'
+
+    # the chunks are taken from the shared counter on the reader thread,
+    # which needs MPI_THREAD_SERIALIZED (see darkcal.py)
+    threaded = MPI.Query_thread() >= MPI.THREAD_SERIALIZED
+    counter  = SharedCounter(comm)
+    # (the positions of the events in events, for the order of the photon lists)
+    mine   = (i for start, stop in dynamic_chunks(counter, len(events), chunk_size) for i in range(start, stop))
+
+    def read_event(i, out):
+        number, index = events[i]
+        return evt_to_array(runs[number].event(times[number][index]), out)
+
+    t0     = MPI.Wtime()
+    reader = Prefetcher(read_event, mine, shape, dtype, buffer_size, threaded = threaded)
+    for buffer, positions in reader:
+        c = convert(buffer, counts[: buffer.shape[0]])
+        total += c.sum(axis=0, dtype=np.int64)
+        if sparse :
+            lists.add_buffer(c, positions, [events[i] for i in positions])
+
+        if rank == 0:
+            print 'no. of evnts, rank, dropped: {0:5d} {1:3} {2:3} \r'.format(reader.processed + buffer.shape[0], rank, reader.dropped),
+            sys.stdout.flush()
+    t_busy = MPI.Wtime() - t0
+
+    comm.barrier()
+    counter.free()
+    if rank == 0:
+        print '\n', reader.report()
+    report_load(comm, reader.processed, t_busy)
+
+    frames = comm.reduce(reader.processed, op=MPI.SUM, root=0)
+    if rank == 0 :
+        comm.Reduce(MPI.IN_PLACE, total, op=MPI.SUM, root=0)
+        print 'photons: {0:d} ({1:.1f} per frame)'.format(int(np.sum(total)), np.sum(total) / float(max(frames, 1)))
+        f = h5py.File(h5name, 'w')
+        f.create_dataset('data/data', data = total)
+        f.create_dataset('number of frames', data = frames)
+        f.attrs['source'] = source
+        f.attrs['droplets'] = droplets
+        f.close()
+    else :
+        comm.Reduce(total, None, op=MPI.SUM, root=0)
+
+    if sparse :
+        t0 = MPI.Wtime()
+        write_lists(comm, h5name, lists, count_dtype)
+        if rank == 0 :
+            print 'photon lists written in {0:.1f}s'.format(MPI.Wtime() - t0)
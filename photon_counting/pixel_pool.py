@@ -0,0 +1,265 @@
+"""
+Fit the pixels of a makehist.py histogram with a pool of processes.
+
+The histogram is read once: a contiguous (not chunked or compressed) dense
+dataset is memory mapped straight from the h5 file, as are the tile files
+behind a virtual dataset (makehist.py with writer = 'vds' and
+compression = None) if they are all contiguous. Anything else (chunked,
+compressed or windowed) is loaded into shared memory. The processes are
+forked after that, so they all see the same histogram (and dark histogram)
+and the same preallocated output maps. A task is only a (start, stop) tile
+of pixels, the histograms are never pickled and every process writes its
+fit straight into the maps:
+
+    hist, cols = load_histograms(fnam, 'data/data', slice(70, 250))
+    maps = fit_all(hist, cols, {'sigma_to_pix' : 0.15, 'photon_sig' : 2., 'photon_adu' : 30.}, processes = 16)
+    gain = maps['photon_adu']
+
+The tiles whose pixels did not all converge are fitted again (only the
+pixels that did not converge, from where they got to and with more
+iterations) up to 'retries' times.
+
+numpy should not start threads of its own in the processes (e.g. set
+OMP_NUM_THREADS=1), one process per core is faster.
+"""
+
+import sys
+import os
+import time
+import itertools
+import multiprocessing
+import numpy as np
+
+from photon_cloud_fitting import fit_pixels
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'histogram'))
+from sparse_hist import read_pixels
+
+# (name, dtype) of the output maps, the keys of photon_cloud_fitting.fit_pixels
+map_dtypes = [('photon_adu', np.float64), ('rate', np.float64), ('dark_peak', np.float64), \
+              ('nll', np.float64), ('converged', np.bool), ('iterations', np.int64)]
+
+def shared_array(shape, dtype):
+    """A numpy array in shared memory, forked processes write into the same memory."""
+    dtype = np.dtype(dtype)
+    raw   = multiprocessing.RawArray('b', max(1, int(np.prod(shape)) * dtype.itemsize))
+    return np.frombuffer(raw, dtype = dtype, count = int(np.prod(shape))).reshape(shape)
+
+class TileMemmap(object):
+    """
+    The (pixels, bins) memory maps of the tile files of a virtual dataset,
+    read as one array with hist[pixels, cols] (pixels an array, cols a slice).
+    """
+    def __init__(self, tiles):
+        # [(first pixel, (pixels, bins) np.memmap)] in pixel order
+        self.tiles  = tiles
+        self.starts = np.array([p for p, m in tiles])
+        self.shape  = (tiles[-1][0] + tiles[-1][1].shape[0], tiles[0][1].shape[1])
+        self.dtype  = tiles[0][1].dtype
+
+    def __getitem__(self, index):
+        pixels, cols = index
+        pixels = np.asarray(pixels)
+        out    = np.empty((len(pixels), len(range(*cols.indices(self.shape[1])))), dtype = self.dtype)
+        tile   = np.searchsorted(self.starts, pixels, side = 'right') - 1
+        for t in np.unique(tile):
+            i = tile == t
+            out[i] = self.tiles[t][1][pixels[i] - self.starts[t], cols]
+        return out
+
+def _dataset_memmap(fnam, node):
+    """A read only (pixels, bins) np.memmap of the h5py dataset node of file fnam, None if it is not contiguous."""
+    if node.chunks is not None or getattr(node, 'is_virtual', False) :
+        return None
+    offset = node.id.get_offset()
+    if offset is None :
+        return None
+    return np.memmap(fnam, dtype = node.dtype, mode = 'r', offset = offset, \
+                     shape = (int(np.prod(node.shape[:-1])), node.shape[-1]))
+
+def _tile_memmap(fnam, node):
+    """
+    A TileMemmap of the tile files of the virtual dataset node (h5_writer.write_tile),
+    None if a tile is not contiguous or the tiles do not cover every pixel.
+    """
+    import h5py
+    ncols = node.shape[-2]
+    tiles = []
+    for name in sorted(set([s.file_name for s in node.virtual_sources()])):
+        tnam = os.path.join(os.path.dirname(os.path.abspath(fnam)), name)
+        if not os.path.exists(tnam) :
+            return None
+        f     = h5py.File(tnam, 'r')
+        dset  = f['data']
+        hist  = _dataset_memmap(tnam, dset)
+        start = int(dset.attrs.get('row_start', -1)) * ncols
+        f.close()
+        if hist is None or start < 0 or hist.shape[1] != node.shape[-1] :
+            return None
+        tiles.append((start, hist))
+
+    tiles.sort(key = lambda t : t[0])
+    stop = 0
+    for start, hist in tiles :
+        if start != stop :
+            return None
+        stop += hist.shape[0]
+    if len(tiles) == 0 or stop != int(np.prod(node.shape[:-1])) :
+        return None
+    return TileMemmap(tiles)
+
+def h5_memmap(fnam, h5path):
+    """
+    A read only (pixels, bins) np.memmap of an h5 dataset, or a TileMemmap of
+    the tile files of a virtual dataset, None if it is not contiguous in the file(s).
+    """
+    import h5py
+    f    = h5py.File(fnam, 'r')
+    node = f[h5path]
+    out  = None
+    if isinstance(node, h5py.Dataset) :
+        if getattr(node, 'is_virtual', False) :
+            out = _tile_memmap(fnam, node)
+        else :
+            out = _dataset_memmap(fnam, node)
+    f.close()
+    return out
+
+def load_histograms(fnam, h5path, cols, pixels_per_read = 65536):
+    """
+    The (pixels, bins) histograms of a makehist.py output for a pool of processes.
+
+    Returns
+    -------
+    hist : numpy.ndarray or TileMemmap, (pixels, bins)
+        The memory mapped dataset (or tile files), or (if it can not be
+        mapped) the bins in cols of every pixel in shared memory.
+
+    cols : slice
+        The columns of hist to fit (cols, or all of them if hist is already
+        cut down to cols).
+    """
+    hist = h5_memmap(fnam, h5path)
+    if hist is not None :
+        return hist, cols
+
+    import h5py
+    f    = h5py.File(fnam, 'r')
+    node = f[h5path]
+    if isinstance(node, h5py.Dataset) :
+        npix, dtype = int(np.prod(node.shape[:-1])), node.dtype
+    else :
+        # windowed counts plus the spill list can overflow the window dtype
+        npix, dtype = int(np.prod(node.attrs['shape'])), np.uint32
+    f.close()
+
+    ncols = len(range(*cols.indices(read_pixels(fnam, h5path, [0])[0].shape[1])))
+    hist  = shared_array((npix, ncols), dtype)
+    for p in range(0, npix, pixels_per_read):
+        pixels  = np.arange(p, min(p + pixels_per_read, npix))
+        hist[pixels] = read_pixels(fnam, h5path, pixels, dtype = dtype)[0][:, cols]
+    return hist, slice(None)
+
+# what the processes of the pool share, set by init before the first task
+_pool = {}
+
+def init(hist, cols, dark, dark_cols, maps, fit_kwargs):
+    _pool.update({'hist' : hist, 'cols' : cols, 'dark' : dark, 'dark_cols' : dark_cols, 'maps' : maps, 'kwargs' : fit_kwargs})
+
+def fit_tile(task):
+    """
+    Fit the pixels [start, stop) into the shared maps.
+
+    task is (start, stop, attempt), for attempt > 0 only the pixels that have
+    not converged are fitted, from their last fit with (attempt + 1) times
+    the iterations. Returns (start, stop, pixels fitted, pixels that did not
+    converge, seconds).
+    """
+    start, stop, attempt = task
+    t0     = time.time()
+    maps   = _pool['maps']
+    kwargs = dict(_pool['kwargs'])
+    pixels = np.arange(start, stop)
+    if attempt > 0 :
+        # empty pixels are never converged (their gain is NaN)
+        pixels = pixels[~maps['converged'][pixels] & np.isfinite(maps['photon_adu'][pixels])]
+        kwargs['photon_adu'] = maps['photon_adu'][pixels]
+        kwargs['rate']       = maps['rate'][pixels]
+        kwargs['iterations'] = kwargs.get('iterations', 20) * (attempt + 1)
+    if len(pixels) == 0 :
+        return start, stop, 0, 0, time.time() - t0
+
+    hist = _pool['hist'][pixels, _pool['cols']]
+    if _pool['dark'] is not None :
+        kwargs['s0'] = _pool['dark'][pixels, _pool['dark_cols']]
+    fit = fit_pixels(hist, **kwargs)
+
+    for k, dtype in map_dtypes :
+        if k == 'iterations' :
+            maps[k][pixels] += fit[k]
+        else :
+            maps[k][pixels] = fit[k]
+    failed = np.sum(~fit['converged'] & np.isfinite(fit['photon_adu']))
+    return start, stop, len(pixels), failed, time.time() - t0
+
+def fit_all(hist, cols, fit_kwargs, dark = None, dark_cols = None, processes = None, tile = 4096, retries = 2, \
+            progress = True):
+    """
+    Fit every pixel of hist with fit_pixels(hist[:, cols], **fit_kwargs), a tile of pixels per task.
+
+    dark (the dark histograms, with the same bins as hist) and dark_cols
+    (cols if None) are optional, as they come from load_histograms.
+    processes defaults to the number of cores, with 1 the tiles are fitted
+    in this process. Returns the maps, a dictionary of (pixels,) arrays (see
+    map_dtypes), and prints the progress if progress is True.
+    """
+    npix = hist.shape[0]
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, (npix + tile - 1) // tile))
+
+    maps = dict([(k, shared_array((npix,), dtype)) for k, dtype in map_dtypes])
+    maps['iterations'][:] = 0
+    if dark_cols is None :
+        dark_cols = cols
+    if processes > 1 :
+        pool = multiprocessing.Pool(processes, init, (hist, cols, dark, dark_cols, maps, fit_kwargs))
+        imap = pool.imap_unordered
+    else :
+        pool = None
+        init(hist, cols, dark, dark_cols, maps, fit_kwargs)
+        imap = itertools.imap
+
+    tasks = [(p, min(p + tile, npix), 0) for p in range(0, npix, tile)]
+    done  = 0
+    busy  = 0.
+    t0    = time.time()
+    for attempt in range(retries + 1):
+        retry = []
+        for start, stop, fitted, failed, seconds in imap(fit_tile, tasks):
+            busy += seconds
+            if failed > 0 and attempt < retries :
+                retry.append((start, stop, attempt + 1))
+            if attempt == 0 :
+                done += stop - start
+                if progress :
+                    t = time.time() - t0
+                    print 'pixels: {0:8d} of {1:8d} ({2:.0f} pixels/s, {3:.0f}s to go)\r'.format(\
+                          done, npix, done / max(t, 1e-12), (npix - done) * t / done),
+                    sys.stdout.flush()
+        if progress and attempt == 0 :
+            print
+        if progress and len(retry) > 0 :
+            print 'fitting the pixels that did not converge in', len(retry), 'tiles again'
+        tasks = retry
+        if len(tasks) == 0 :
+            break
+
+    if pool is not None :
+        pool.close()
+        pool.join()
+    if progress :
+        t = time.time() - t0
+        print '{0} processes: {1:.1f}s, {2:.0f} pixels/s, {3:.0f}% busy'.format(\
+              processes, t, npix / max(t, 1e-12), 100. * busy / max(processes * t, 1e-12))
+    return maps
@@ -0,0 +1,75 @@
+"""
+A persistent index of run summaries, so that run_stats.py only reads the
+runs it has not seen before (or that have changed since).
+
+The index is an sqlite file with one row per (exp, run):
+
+    signature      the names, sizes and modification times of the xtc files
+                   of the run (see run_signature), the row is made again
+                   when these change (e.g. a run that was still being taken)
+    error          why no events could be read from the run (or NULL)
+    id             the event id of the first event (str(evt.get(psana.EventId)))
+    events         the number of events
+    start, stop    the seconds of the first and last event
+    photon_energy  the photon energy in keV (NULL if there was no EBeam)
+    z_stage        the epics values of the z stage and the pulse length
+    pulse_length   (NULL if they are not in the epics store)
+    updated        when the row was made (seconds since the epoch)
+
+e.g.
+    index = RunIndex('run_stats.sqlite')
+    row   = index.get('cxi01516', 14)         # None if the run is not indexed
+    index.put('cxi01516', 14, row)
+
+A row is only used while it is current (see is_stale): rows with an error
+and rows of runs whose xtc files cannot be seen are read again.
+"""
+
+import sys
+import os
+import time
+import sqlite3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import run_signature
+
+columns = [('signature', 'TEXT'), ('error', 'TEXT'), ('id', 'TEXT'), ('events', 'INTEGER'), \
+           ('start', 'INTEGER'), ('stop', 'INTEGER'), ('photon_energy', 'REAL'), \
+           ('z_stage', 'REAL'), ('pulse_length', 'REAL'), ('updated', 'REAL')]
+
+def is_stale(row, signature):
+    """True if the run should be read again: not indexed, no events could be read, or the xtc files (signature) changed or cannot be seen."""
+    return row is None or row['error'] is not None or signature is None or row['signature'] != signature
+
+class RunIndex(object):
+    """The sqlite run index in fnam (made if it does not exist)."""
+    def __init__(self, fnam):
+        self.fnam = fnam
+        self.db   = sqlite3.connect(fnam)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (exp TEXT, run INTEGER, ' + \
+                        ', '.join([c + ' ' + t for c, t in columns]) + ', PRIMARY KEY (exp, run))')
+        self.db.commit()
+
+    def get(self, exp, run):
+        """The row of a run as a dictionary, None if the run is not in the index."""
+        cur = self.db.execute('SELECT ' + ', '.join([c for c, t in columns]) + ' FROM runs WHERE exp = ? AND run = ?', \
+                              (exp, int(run)))
+        row = cur.fetchone()
+        if row is None :
+            return None
+        return dict(zip([c for c, t in columns], row))
+
+    def put(self, exp, run, row):
+        """Add or replace the row of a run (missing columns are NULL)."""
+        row = dict(row)
+        row.setdefault('updated', time.time())
+        self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ' + ', '.join(['?' for c in columns]) + ')', \
+                        [exp, int(run)] + [row.get(c) for c, t in columns])
+        self.db.commit()
+
+    def runs(self, exp):
+        """The run numbers of exp in the index."""
+        return [r[0] for r in self.db.execute('SELECT run FROM runs WHERE exp = ? ORDER BY run', (exp,))]
+
+    def close(self):
+        self.db.close()
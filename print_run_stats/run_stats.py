@@ -5,14 +5,30 @@ import os
 import argparse
 import ConfigParser
 import numpy as np
-import psana
 import time
 import datetime
+import csv
+import multiprocessing
+import Queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import open_source, exp_run, run_numbers, run_source
+from run_index import RunIndex, run_signature, is_stale
 
 def parse_cmdline_args():
     parser = argparse.ArgumentParser(prog = 'run_stats.py', description='print slac run statistics (e.g. to put into a spreadsheet)')
     parser.add_argument('config', type=str, \
                         help="file name of the configuration file")
+    parser.add_argument('-s', '--source', type=str, \
+                help="psana source string, overrides the config file (e.g exp=cxi01516:run=10:idx)")
+    parser.add_argument('-i', '--index', type=str, \
+                help="the run index file, overrides the config file (default run_stats.sqlite)")
+    parser.add_argument('-r', '--rebuild', action='store_true', \
+                help="read every run again, even if it is in the index and has not changed")
+    parser.add_argument('-j', '--processes', type=int, \
+                help="the number of runs read at once, overrides the config file (default 4)")
+    parser.add_argument('-o', '--output', type=str, \
+                help="also write the table to this csv file (tab separated if it ends in .tsv, - for stdout)")
     args = parser.parse_args()
 
     # check that args.ini exists
@@ -72,6 +88,108 @@ def parse_parameters(config):
 
     return monitor_params
 
+def summarise_run(psana, ds, run, params):
+    """Read the summary of a run (a row of the run index, see run_index.py) from its first events."""
+    times = run.times()
+    row   = {'events' : len(times)}
+    try :
+        evt = run.event(times[0])
+    except Exception as e :
+        row['error'] = 'could not extract any events: ' + str(e)
+        return row
+    row['id']    = str(evt.get(psana.EventId))
+    row['start'] = times[0].seconds()
+    row['stop']  = times[-1].seconds()
+
+    epics = ds.env().epicsStore()
+    for name in ['z_stage', 'pulse_length']:
+        try :
+            row[name] = float(epics.value(params['epics'][name]))
+        except Exception :
+            row[name] = None
+
+    # the first event with an EBeam (looking at no more than 100)
+    for t in times[:100]:
+        try :
+            beam = run.event(t).get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
+            row['photon_energy'] = beam.ebeamPhotonEnergy() * 1.0e-3
+            break
+        except Exception :
+            pass
+    return row
+
+def read_run(source, number, params, queue):
+    """Summarise one run (in its own process) and put (number, row) on the queue."""
+    try :
+        psana, ds = open_source(run_source(source, number))
+        row = {'error' : 'no such run'}
+        for run in ds.runs():
+            row = summarise_run(psana, ds, run, params)
+    except Exception as e :
+        row = {'error' : 'could not read the run: ' + repr(e)}
+    queue.put((number, row))
+
+def read_runs(source, numbers, params, processes = 4, timeout = 600.):
+    """Read the runs, each in its own process and no more than processes at once.
+
+    Yields (number, row, message) as the runs finish: row is the summary of
+    the run (see summarise_run) or None if the process took longer than
+    timeout seconds (it is killed) or died without a summary (e.g. in
+    psana), in which case message says why. So one bad run cannot stall or
+    stop the others.
+    """
+    queue   = multiprocessing.Queue()
+    todo    = list(numbers)
+    running = {}
+    while len(todo) > 0 or len(running) > 0 :
+        while len(todo) > 0 and len(running) < processes :
+            n = todo.pop(0)
+            p = multiprocessing.Process(target = read_run, args = (source, n, params, queue))
+            p.daemon = True
+            p.start()
+            running[n] = (p, time.time())
+
+        try :
+            n, row = queue.get(timeout = 0.1)
+            if n in running :
+                running.pop(n)[0].join()
+                yield n, row, None
+        except Queue.Empty :
+            pass
+
+        for n, (p, t0) in running.items():
+            if time.time() - t0 > timeout :
+                p.terminate()
+                p.join()
+                running.pop(n)
+                yield n, None, 'timed out after ' + str(timeout) + ' seconds'
+            elif not p.is_alive() and p.exitcode != 0 :
+                running.pop(n)
+                yield n, None, 'the process died with exit code ' + str(p.exitcode)
+
+# the columns that can be switched on in [output], in order
+output_columns = ['id', 'events', 'z_stage', 'pulse_length', 'photon_energy', 'seconds', 'hms', 'date', 'st']
+
+def selected_columns(params):
+    return [c for c in output_columns if params['output'][c]]
+
+def format_row(row, params):
+    """The values of the columns selected in [output] for a row of the run index."""
+    NA = lambda v : 'NA' if v is None else str(v)
+    timestring = row['id'].split('time=')[1].split(',')[0]
+    seconds    = row['stop'] - row['start']
+
+    columns = {'id'            : str(row['id']), \
+               'events'        : str(row['events']), \
+               'z_stage'       : NA(None if row['z_stage'] is None else (row['z_stage'] * 1.0e-3 + 0.56) * 1.0e3), \
+               'pulse_length'  : NA(row['pulse_length']), \
+               'photon_energy' : NA(row['photon_energy']), \
+               'seconds'       : str(seconds), \
+               'hms'           : str(seconds / 3600) + ':' + str((seconds / 60) % 60) + ':' + str(seconds % 60), \
+               'date'          : timestring[:10], \
+               'st'            : timestring[11:19]}
+    return [columns[c] for c in selected_columns(params)]
+
 
 if __name__ == "__main__":
     args = parse_cmdline_args()
@@ -81,109 +199,72 @@ if __name__ == "__main__":
     
     params = parse_parameters(config)
 
-    source = 'exp='+params['source']['exp']+':'+'run='+params['source']['runs']+':idx'
+    if args.source is None :
+        source = 'exp='+params['source']['exp']+':'+'run='+str(params['source']['runs'])+':idx'
+    else :
+        source = args.source
     print source
 
     print 'data source', source
-    #run_name = '0001'
-    #ds = psana.DataSource('exp=cxig2614:run='+run_name+':idx')
-    #ds = psana.DataSource('exp=cxif5315:run=139-152:idx')
-    #ds = psana.DataSource('exp=cxig4415:run=23:idx')
-    ds = psana.DataSource(source)
+    exp, runs = exp_run(source)
+    numbers   = run_numbers(runs)
 
-    header_init = True
+    if args.index is None :
+        args.index = params.get('index', {}).get('fnam', 'run_stats.sqlite')
+    index = RunIndex(args.index)
 
-    i = 0
-    for run in ds.runs():
-        times    = run.times()
-        mylength = len(times)
-        mytimes  = times[0:mylength]
+    # only read the runs that are new, or whose xtc files have changed
+    signatures = dict((n, run_signature(run_source(source, n))) for n in numbers)
+    stale = []
+    for n in numbers :
+        if args.rebuild or is_stale(index.get(exp, n), signatures[n]) :
+            stale.append(n)
+    print 'runs in the index:', len(numbers) - len(stale), 'runs to read:', len(stale)
 
-        for i in range(1):
-            try :
-                evt = run.event(mytimes[i])
-            except :
-                print 'could not extract any events for run:', run.run()
-                continue
-            evtId = evt.get(psana.EventId)
-            run_length = len(times)
-            #print run_length,zample_detector_encoded, '\t\t\t\t', evtId
+    # read them in parallel, in any order (timed out runs are not indexed,
+    # so that they are tried again next time)
+    processes = args.processes or params.get('index', {}).get('processes', 4)
+    timeout   = params.get('index', {}).get('timeout', 600.)
+    failed    = {}
+    for n, row, message in read_runs(source, stale, params, processes, timeout):
+        if row is None :
+            failed[n] = message
+            print 'run', n, message
+            continue
+        row['signature'] = signatures[n]
+        index.put(exp, n, row)
 
-            epics = ds.env().epicsStore()
-            try :
-                zample_detector_encoded = epics.value(params['epics']['zstage']) * 1.0e-3 + 0.56
-            except :
-                zample_detector_encoded = 'NA'
+    # and print them in run order
+    header_init = True
+    table = []
+    for n in numbers :
+        row = index.get(exp, n) if n not in failed else None
+        if row is None or row['error'] is not None :
+            print 'could not extract any events for run:', n
+            table.append((n, None))
+            continue
 
-            try :
-                pulse_length = epics.value(params['epics']['zstage'])
-            except :
-                pulse_length = 'NA'
+        header, outputstr = selected_columns(params), format_row(row, params)
+        table.append((n, outputstr))
+        if header_init :
+            for h in header:
+                print h, '\t',
 
-            # loop over frames untill we get something
-            for j in range(100):
-                try :
-                    evt = run.event(mytimes[i+j])
-                    beam = evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
-                    photon_energy_ev = beam.ebeamPhotonEnergy()
-                    photon_energy_ev *= 1.0e-3
-                except :
-                    photon_energy_ev = 'NA'
-                
-                if photon_energy_ev != 'NA' :
-                    break
-
-            timestring = str(evtId).split('time=')[1].split(',')[0]
-            timestamp = time.strptime(timestring[:-6],'%Y-%m-%d %H:%M:%S.%f')
-            
-            outputstr = []
-            header = []
-
-            if params['output']['id']:
-                header.append('id')
-                outputstr.append(str(evtId))
-
-            if params['output']['events']:
-                header.append('events')
-                outputstr.append(str(run_length))
-
-            if params['output']['z_stage']:
-                header.append('z_stage')
-                outputstr.append(str(zample_detector_encoded * 1.0e3))
-
-            if params['output']['pulse_length']:
-                header.append('pulse_length')
-                outputstr.append(str(pulse_length))
-
-            if params['output']['photon_energy']:
-                header.append('photon_energy')
-                outputstr.append(str(photon_energy_ev))
-
-            if params['output']['seconds']:
-                header.append('seconds')
-                outputstr.append(str(mytimes[-1].seconds() - mytimes[0].seconds()))
-
-            if params['output']['hms']:
-                header.append('hms')
-                outputstr.append( str(int((mytimes[-1].seconds() - mytimes[0].seconds())/3600.))+':'\
-                      +str(int((mytimes[-1].seconds() - mytimes[0].seconds())/60.))+':'\
-                      +str(int(mytimes[-1].seconds() - mytimes[0].seconds()) % 60))
-
-            if params['output']['date']:
-                header.append('date')
-                outputstr.append( timestring[:10] )
-
-            if params['output']['st']:
-                header.append('st')
-                outputstr.append( timestring[11:19] )
-
-            if header_init :
-                for h in header:
-                    print h, '\t',
-
-                print '\n'
-                header_init = False
-
-            for o in outputstr:
-                print o,
-            print ''
+            print '\n'
+            header_init = False
+
+        for o in outputstr:
+            print o,
+        print ''
+    index.close()
+
+    # a row for every run (NA for the runs without events) for the spreadsheet
+    if args.output is not None :
+        header = selected_columns(params)
+        f = sys.stdout if args.output == '-' else open(args.output, 'wb')
+        writer = csv.writer(f, delimiter = '\t' if args.output.endswith('.tsv') else ',')
+        writer.writerow(['run'] + header)
+        for n, outputstr in table :
+            writer.writerow([n] + (outputstr if outputstr is not None else ['NA' for h in header]))
+        if f is not sys.stdout :
+            f.close()
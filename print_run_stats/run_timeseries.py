@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Extract the per-event scalars of whole runs (EBeam, gas detector and the
+epics pvs of the config file) into columnar h5 arrays, in one pass over the
+events shared by all of the mpi processes, and print per-run summaries
+(mean, standard deviation and percentiles) of them.
+
+The detector is never read, so this is quick compared to (say) darkcal.py.
+The output has a group for each run with one (events,) dataset per column,
+sorted by the event index in the run:
+
+    r0014/index          the event index in the run
+    r0014/seconds        the event time
+    r0014/nanoseconds
+    r0014/fiducial
+    r0014/photon_energy  EBeam (eV), NaN for the events without one
+    r0014/charge         (nC)
+    r0014/l3_energy      (MeV)
+    r0014/f_11_ENRC      gas detector (mJ), NaN for the events without one
+    ...
+    r0014/z_stage        the [epics] pvs, under their names in the config file
+
+The summary of each column is in its attributes: valid (the number of
+non-NaN values), mean, std, min, max and percentile_N. An event that cannot
+be read is dropped: its row is all NaN and it is counted in the 'dropped'
+attribute of its run group.
+
+    $ mpirun -np 8 python run_timeseries.py config.ini
+"""
+
+import sys
+import os
+import argparse
+import ConfigParser
+import string
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import open_source, exp_run, psana_obj_from_string, run_label
+from scheduler import SharedCounter, dynamic_chunks, report_load
+from run_stats import parse_parameters
+
+# (column, method of the psana object, units)
+ebeam_columns  = [('photon_energy', 'ebeamPhotonEnergy', 'eV'), ('charge', 'ebeamCharge', 'nC'), \
+                  ('l3_energy', 'ebeamL3Energy', 'MeV')]
+gasdet_columns = [(m, m, 'mJ') for m in ['f_11_ENRC', 'f_12_ENRC', 'f_21_ENRC', 'f_22_ENRC']]
+id_columns     = ['run', 'index', 'seconds', 'nanoseconds', 'fiducial']
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(prog = 'mpirun -np [NUM] [OPTIONS] run_timeseries.py', \
+                                     description='extract the per-event ebeam, gas detector and epics values of whole runs into h5 arrays')
+    parser.add_argument('config', type=str, \
+                        help="file name of the configuration file")
+    parser.add_argument('-s', '--source', type=str, \
+                help="psana source string, overrides the config file (e.g exp=cxi01516:run=10:idx)")
+    parser.add_argument('-o', '--output', type=str, \
+                help="the output h5 file, overrides the config file (default exp-run-timeseries.h5)")
+    args = parser.parse_args()
+
+    # check that args.ini exists
+    if not os.path.exists(args.config):
+        raise NameError('config file does not exist: ' + args.config)
+    return args
+
+def bld_values(evt, psana_type, src, columns, out):
+    """Write the columns of a Bld object of the event into out (NaN if the event does not have it)."""
+    try :
+        obj = evt.get(psana_type, src)
+    except Exception :
+        obj = None
+    if obj is None :
+        out[:] = np.nan
+        return out
+    for i, (name, method, units) in enumerate(columns):
+        out[i] = getattr(obj, method)()
+    return out
+
+def epics_values(store, pvs, out):
+    """Write the current values of the epics pvs into out (NaN for the pvs that are not in the store)."""
+    for i, pv in enumerate(pvs):
+        try :
+            out[i] = float(store.value(pv))
+        except Exception :
+            out[i] = np.nan
+    return out
+
+def summary(x, percentiles):
+    """The valid (non-NaN) count, mean, std, min, max and percentiles of x as a list of (name, value)."""
+    x = x[np.isfinite(x)]
+    if len(x) == 0 :
+        return [('valid', 0)] + [(n, np.nan) for n in ['mean', 'std', 'min', 'max']] + \
+               [('percentile_' + str(p), np.nan) for p in percentiles]
+    return [('valid', len(x)), ('mean', np.mean(x)), ('std', np.std(x)), ('min', np.min(x)), ('max', np.max(x))] + \
+           [('percentile_' + str(p), v) for p, v in zip(percentiles, np.percentile(x, percentiles))]
+
+def print_summary(number, columns, summaries, percentiles, dropped = 0):
+    print '\nrun', number, '(dropped events: {0})'.format(dropped) if dropped > 0 else ''
+    print '{0:20}'.format('') + ''.join(['{0:>13}'.format(n) for n in ['valid', 'mean', 'std'] + [str(p) + '%' for p in percentiles]])
+    for name, s in zip(columns, summaries):
+        s = dict(s)
+        print '{0:20}{1:13d}'.format(name, s['valid']) + \
+              ''.join(['{0:13.6g}'.format(s[n]) for n in ['mean', 'std'] + ['percentile_' + str(p) for p in percentiles]])
+
+
+if __name__ == "__main__":
+    args = parse_cmdline_args()
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config)
+    params = parse_parameters(config)
+    tparams = params.get('timeseries', {})
+
+    if args.source is None :
+        source = 'exp='+params['source']['exp']+':'+'run='+str(params['source']['runs'])+':idx'
+    else :
+        source = args.source
+    exp, run = exp_run(source)
+
+    psana, ds = open_source(source)
+
+    ebeam_type  = psana_obj_from_string(tparams.get('ebeam_type', 'psana.Bld.BldDataEBeamV7'), psana)
+    ebeam_src   = psana.Source(tparams.get('ebeam_src', 'BldInfo(EBeam)'))
+    gasdet_type = psana_obj_from_string(tparams.get('gasdet_type', 'psana.Bld.BldDataFEEGasDetEnergyV1'), psana)
+    gasdet_src  = psana.Source(tparams.get('gasdet_src', 'BldInfo(FEEGasDetEnergy)'))
+    epics       = sorted(params.get('epics', {}).items())
+    pvs         = [pv for name, pv in epics]
+    columns     = [c[0] for c in ebeam_columns] + [c[0] for c in gasdet_columns] + [name for name, pv in epics]
+    units       = [c[2] for c in ebeam_columns] + [c[2] for c in gasdet_columns] + ['' for pv in pvs]
+    percentiles = list(np.atleast_1d(tparams.get('percentiles', [5, 50, 95])))
+    chunk_size  = tparams.get('chunk_size', 256)
+
+    # all of the runs of the source, their events are shared by all of the
+    # processes together rather than run by run
+    runs    = list(ds.runs())
+    numbers = [r.run() for r in runs]
+    times   = dict((r.run(), r.times()) for r in runs)
+    runs    = dict(zip(numbers, runs))
+
+    h5name = args.output
+    if h5name is None :
+        h5name = tparams.get('fnam', 'exp-run-timeseries.h5')
+        h5name = string.replace(h5name, 'exp', exp)
+        h5name = string.replace(h5name, 'run', run_label(numbers))
+        h5name = tparams.get('h5dir', './') + h5name
+
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    events = [(number, i) for number in numbers for i in range(len(times[number]))]
+    if rank == 0 :
+        print 'data source', source
+        print 'Number of events to process:', len(events), 'in', len(numbers), 'runs'
+        print 'columns:', ' '.join(columns)
+
+    # every rank takes chunks of the events until there are none left, and
+    # keeps the values of its events in one block of rows per chunk
+    ids     = []
+    values  = []
+    dropped = []
+    nebeam  = len(ebeam_columns)
+    ngasdet = len(gasdet_columns)
+    counter = SharedCounter(comm)
+    t0      = MPI.Wtime()
+    for start, stop in dynamic_chunks(counter, len(events), chunk_size):
+        ids.append(np.empty((stop - start, len(id_columns)), dtype=np.int64))
+        values.append(np.empty((stop - start, len(columns)), dtype=np.float64))
+        for j, (number, i) in enumerate(events[start : stop]):
+            t   = times[number][i]
+            ids[-1][j] = [number, i, t.seconds(), t.nanoseconds(), t.fiducial()]
+            row = values[-1][j]
+            # one bad event loses its row rather than stopping this rank
+            # (which would leave the others waiting for it forever)
+            try :
+                evt = runs[number].event(t)
+                bld_values(evt, ebeam_type, ebeam_src, ebeam_columns, row[: nebeam])
+                bld_values(evt, gasdet_type, gasdet_src, gasdet_columns, row[nebeam : nebeam + ngasdet])
+                epics_values(ds.env().epicsStore(), pvs, row[nebeam + ngasdet :])
+            except Exception as e :
+                print 'rank', rank, 'dropped event', i, 'of run', number, ':', e
+                row[:] = np.nan
+                dropped.append(number)
+
+        if rank == 0:
+            print 'no. of evnts, rank, dropped: {0:7d} {1:3} {2:3} \r'.format(sum([len(i) for i in ids]), rank, len(dropped)),
+            sys.stdout.flush()
+    t_busy = MPI.Wtime() - t0
+
+    comm.barrier()
+    counter.free()
+
+    ids    = np.concatenate(ids) if len(ids) > 0 else np.empty((0, len(id_columns)), dtype=np.int64)
+    values = np.concatenate(values) if len(values) > 0 else np.empty((0, len(columns)), dtype=np.float64)
+    report_load(comm, len(ids), t_busy)
+
+    # the rows of every rank, in run and event order
+    ids     = comm.gather(ids, root=0)
+    values  = comm.gather(values, root=0)
+    dropped = comm.gather(dropped, root=0)
+    if rank == 0 :
+        import h5py
+        ids     = np.concatenate(ids)
+        values  = np.concatenate(values)
+        dropped = [number for d in dropped for number in d]
+        print '\ndropped events:', len(dropped)
+        order  = np.lexsort((ids[:, 1], ids[:, 0]))
+        ids    = ids[order]
+        values = values[order]
+
+        print '\noutputing to', h5name
+        f = h5py.File(h5name, 'w')
+        f.attrs['source'] = source
+        for number in numbers :
+            rows = ids[:, 0] == number
+            g    = f.create_group('r' + str(number).zfill(4))
+            g.attrs['dropped'] = dropped.count(number)
+            for k, name in enumerate(id_columns[1 :]):
+                g.create_dataset(name, data = ids[rows, k + 1])
+
+            summaries = []
+            for k, name in enumerate(columns):
+                d = g.create_dataset(name, data = values[rows, k])
+                d.attrs['units'] = units[k]
+                summaries.append(summary(values[rows, k], percentiles))
+                for n, v in summaries[-1] :
+                    d.attrs[n] = v
+            print_summary(number, columns, summaries, percentiles, dropped.count(number))
+        f.close()
@@ -0,0 +1,168 @@
+"""
+A survey of the event keys of a run, cached on disk.
+
+The keys of the first event do not show the detectors that only turn up
+later in a run, or only in some of its events. So a survey looks at
+'samples' events spread evenly over the run (the first and the last
+included), split over a few processes that each open the run on their own,
+and counts every (type, source, alias) key:
+
+    schema = load_schema('exp=cxi01516:run=16:idx', samples = 1000, processes = 4)
+    for k in schema['keys'] :
+        print k['type'], k['src'], k['alias'], k['count'], k['first'], k['last']
+
+where count is the number of sampled events with that key and first and
+last are the indices (in the run) of the first and last sampled events
+that have it. The schema also has the run, the number of events and of
+samples and the epics pvNames and aliases. A sampled event that cannot be
+read is skipped (and printed) rather than ending the survey, 'skipped' is
+the number of them and count is out of the samples - skipped events that
+were read.
+
+The schema is written to a json file per run in cache_dir
+(exp-r0016-schema.json) and load_schema returns it from there, without
+opening the run, as long as the xtc files of the run have not changed (see
+event_source.run_signature) and it has at least as many samples. If the
+xtc files cannot be seen the run is surveyed again, as there is no telling
+whether the cache is current. A survey that cannot open the run raises and
+is not cached.
+"""
+
+import sys
+import os
+import json
+import time
+import multiprocessing
+import Queue
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import open_source, exp_run, run_numbers, run_signature
+
+def key_type(k):
+    """'psana.CsPad.DataV2' for the type of an event key (rather than "<class 'psana.CsPad.DataV2'>")."""
+    t = str(k.type())
+    if t.startswith('<') and "'" in t :
+        t = t.split("'")[1]
+    return t
+
+def sample_indices(events, samples):
+    """samples event indices spread evenly over 0, ..., events - 1 (all of them if there are fewer)."""
+    if events <= samples :
+        return range(events)
+    return sorted(set(np.linspace(0, events - 1, samples).astype(np.int64).tolist()))
+
+def survey_events(source, indices, queue):
+    """Count the keys of the events at indices of the (one run) source and put (indices, counts, skipped, error) on the queue.
+
+    counts is a dictionary {(type, src, alias) : [count, first, last]} and
+    skipped the indices of the events that could not be read. error is set
+    if the run could not be opened.
+    """
+    counts  = {}
+    skipped = []
+    try :
+        psana, ds = open_source(source)
+        run   = ds.runs().next()
+        times = run.times()
+        error = None
+    except Exception as e :
+        queue.put((indices, counts, skipped, repr(e)))
+        return
+
+    for i in indices :
+        try :
+            keys = [(key_type(k), str(k.src()), k.alias()) for k in run.event(times[i]).keys()]
+        except Exception as e :
+            # (one write, the processes print at the same time)
+            sys.stdout.write('skipped event ' + str(i) + ' of ' + source + ': ' + repr(e) + '\n')
+            sys.stdout.flush()
+            skipped.append(i)
+            continue
+        for key in keys :
+            if key in counts :
+                c = counts[key]
+                c[0] += 1
+                c[1]  = min(c[1], i)
+                c[2]  = max(c[2], i)
+            else :
+                counts[key] = [1, i, i]
+    queue.put((indices, counts, skipped, error))
+
+def merge_counts(a, b):
+    """Add the key counts b into a."""
+    for key, (count, first, last) in b.items():
+        if key in a :
+            a[key] = [a[key][0] + count, min(a[key][1], first), max(a[key][2], last)]
+        else :
+            a[key] = [count, first, last]
+    return a
+
+def survey(source, samples = 1000, processes = 4):
+    """Survey the keys of the first run of source (see the module doc string), returns the schema."""
+    psana, ds = open_source(source)
+    run    = ds.runs().next()
+    events = len(run.times())
+    epics  = ds.env().epicsStore()
+    schema = {'source' : source, 'run' : run.run(), 'events' : events, \
+              'pvNames' : list(epics.pvNames()), 'aliases' : list(epics.aliases())}
+
+    # every process takes every processes'th sample, so each of them
+    # looks at the whole run
+    indices   = sample_indices(events, samples)
+    processes = max(1, min(processes, len(indices)))
+    queue     = multiprocessing.Queue()
+    workers   = []
+    for p in range(processes):
+        w = multiprocessing.Process(target = survey_events, args = (source, indices[p :: processes], queue))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+
+    counts  = {}
+    skipped = 0
+    results = 0
+    while results < processes :
+        try :
+            part, c, s, error = queue.get(timeout = 0.1)
+        except Queue.Empty :
+            if not any([w.is_alive() for w in workers]) and queue.empty() :
+                raise RuntimeError('a survey process of ' + source + ' died without a result')
+            continue
+        if error is not None :
+            raise RuntimeError('could not survey ' + source + ': ' + error)
+        merge_counts(counts, c)
+        skipped += len(s)
+        results += 1
+    for w in workers :
+        w.join()
+
+    schema['samples'] = len(indices)
+    schema['skipped'] = skipped
+    schema['keys']    = [{'type' : t, 'src' : s, 'alias' : a, 'count' : c, 'first' : first, 'last' : last} \
+                         for (t, s, a), (c, first, last) in sorted(counts.items(), key = lambda i : (i[1][1], i[0]))]
+    return schema
+
+def schema_fnam(source, cache_dir = './'):
+    """The cache file of the schema of the (one run) source e.g. cache_dir/cxi01516-r0016-schema.json."""
+    exp, run = exp_run(source)
+    return os.path.join(cache_dir, exp + '-r' + str(run_numbers(run)[0]).zfill(4) + '-schema.json')
+
+def load_schema(source, samples = 1000, processes = 4, cache_dir = './', rebuild = False):
+    """The schema of the (one run) source from the cache, or from a new survey (which is then cached)."""
+    fnam      = schema_fnam(source, cache_dir)
+    signature = run_signature(source)
+    if not rebuild and signature is not None and os.path.exists(fnam) :
+        schema = json.load(open(fnam))
+        if schema.get('signature') == signature and schema['samples'] >= min(samples, schema['events']) :
+            return schema
+
+    schema = survey(source, samples, processes)
+    schema['signature'] = signature
+    schema['updated']   = time.time()
+    # written to a temporary file and renamed, so a cache file is always whole
+    tmp = fnam + '.tmp'
+    with open(tmp, 'w') as f :
+        json.dump(schema, f, indent = 1)
+    os.rename(tmp, fnam)
+    return schema
@@ -8,12 +8,24 @@ import numpy as np
 import time
 import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from event_source import open_source, exp_run, run_numbers, run_source
+from event_schema import load_schema
+
 def parse_cmdline_args():
     parser = argparse.ArgumentParser(description='print slac psana event variables')
     parser.add_argument('-c', '--config', type=str, \
                         help="file name of the configuration file")
     parser.add_argument('-s', '--source', type=str, \
                 help="psana source string (e.g exp=cxi01516:run=10:idx)")
+    parser.add_argument('-S', '--survey', action='store_true', \
+                help="count the event keys of events sampled over each run (rather than print the keys of the first event), cached per run")
+    parser.add_argument('-n', '--samples', type=int, \
+                help="the number of events sampled in each run by --survey (default 1000)")
+    parser.add_argument('-j', '--processes', type=int, \
+                help="the number of processes that sample each run (default 4)")
+    parser.add_argument('-r', '--rebuild', action='store_true', \
+                help="survey the runs again, even if they are in the cache")
     args = parser.parse_args()
 
     # check that args.ini exists
@@ -93,41 +105,68 @@ def my_psana_from_string(name):
     #ds = psana.DataSource('exp=cxig4415:run=23:idx')
     ds = psana.DataSource(source)
 
+def print_schema(schema):
+    # (caches from before 'skipped' have none)
+    read = schema['samples'] - schema.get('skipped', 0)
+    print '\nEvent keys of run', schema['run'], '(' + str(schema['samples']), 'of', schema['events'], 'events sampled,', \
+          schema.get('skipped', 0), 'could not be read):'
+    print '{0:>7} {1:>9} {2:>7} {3:>7}  type, source, alias'.format('count', 'fraction', 'first', 'last')
+    for k in schema['keys'] :
+        print '{0:7d} {1:9.3f} {2:7d} {3:7d}  {4}, {5}, {6}'.format(k['count'], k['count'] / float(max(read, 1)), \
+              k['first'], k['last'], k['type'], k['src'], k['alias'])
+
 if __name__ == "__main__":
     args = parse_cmdline_args()
     
-    if args.source is None :
+    params = {}
+    if args.config is not None :
         config = ConfigParser.ConfigParser()
         config.read(args.config)
         params = parse_parameters(config)
-        source = 'exp='+params['source']['exp']+':'+'run='+params['source']['runs']+':idx'
+
+    if args.source is None :
+        source = 'exp='+params['source']['exp']+':'+'run='+str(params['source']['runs'])+':idx'
     else :
         source = args.source
 
     print '\ndata source :', source
 
-    print '\nOpening dataset...'
-    import psana
-    ds = psana.DataSource(source)
+    if args.survey :
+        survey = params.get('survey', {})
+        for n in run_numbers(exp_run(source)[1]):
+            t0     = time.time()
+            schema = load_schema(run_source(source, n), args.samples or survey.get('samples', 1000), \
+                                 args.processes or survey.get('processes', 4), survey.get('cache_dir', './'), args.rebuild)
+            print_schema(schema)
+            print 'took {0:.2f}s'.format(time.time() - t0)
+
+        print '\nEpics pv Names (the confusing ones):'
+        print schema['pvNames']
+
+        print '\nEpics aliases (the not so confusing ones):'
+        print schema['aliases']
+    else :
+        print '\nOpening dataset...'
+        psana, ds = open_source(source)
 
-    print '\nEpics pv Names (the confusing ones):'
-    print ds.env().epicsStore().pvNames()
+        print '\nEpics pv Names (the confusing ones):'
+        print ds.env().epicsStore().pvNames()
 
 
-    print '\nEpics aliases (the not so confusing ones):'
-    print ds.env().epicsStore().aliases()
+        print '\nEpics aliases (the not so confusing ones):'
+        print ds.env().epicsStore().aliases()
 
 
-    print '\nEvent structure:'
-    run    = ds.runs().next()
-    times  = run.times()
-    evt    = run.event(times[0])
-    for k in evt.keys():
-        print 'type:', k.type(), 'source:', k.src(), 'alias:', k.alias(), 'key:', k.key()
+        print '\nEvent structure:'
+        run    = ds.runs().next()
+        times  = run.times()
+        evt    = run.event(times[0])
+        for k in evt.keys():
+            print 'type:', k.type(), 'source:', k.src(), 'alias:', k.alias(), 'key:', k.key()
 
-    print '\n\n'
-    for k in evt.keys():
-        print k
+        print '\n\n'
+        for k in evt.keys():
+            print k
 
-    #beam = evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
-    #print 'photon energy:', beam.ebeamPhotonEnergy()
+        #beam = evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
+        #print 'photon energy:', beam.ebeamPhotonEnergy()
@@ -0,0 +1,130 @@
+"""
+Periodic checkpoints of the accumulators of a job, so that it can resume.
+
+Every rank saves its accumulators (whatever 'write(f)' puts into an open
+h5 file) together with the (run, index) of every event that went into them
+to its own file next to the output file:
+
+    exp-run-CsPad-darkcal-checkpoint-rank000.h5
+    exp-run-CsPad-darkcal-checkpoint-rank001.h5
+    ...
+
+at most every 'interval' seconds, so the cost is one write of the
+accumulators per interval. The file is written to a temporary name and
+then renamed, so a job killed while saving leaves the previous checkpoint.
+
+To resume, every rank loads a share of the checkpoint files of the previous
+job (any number of ranks) into its accumulators and skips the events that
+are in any of them. The accumulators must be additive (sums, counts, min,
+max) for this to work. When a job finishes the merged state of all ranks is
+left in the rank 0 file, so running again with --resume and more runs (to
+the same output file) only processes the new events: this is how runs are
+appended to an existing output.
+
+Files carry a 'key' attribute (e.g. the pixel tile of makehist.py) and a
+rank only loads and skips the events of files with its own key.
+"""
+
+import os
+import glob
+import time
+import numpy as np
+
+def checkpoint_fnam(fnam, rank):
+    """The checkpoint file of a rank for the output file fnam."""
+    base, ext = os.path.splitext(fnam)
+    return base + '-checkpoint-rank' + str(rank).zfill(3) + ext
+
+def checkpoint_files(fnam, key = None):
+    """All of the checkpoint files of fnam (sorted), only those with this key if key is not None."""
+    import h5py
+    base, ext = os.path.splitext(fnam)
+    fnams = sorted(glob.glob(base + '-checkpoint-rank*' + ext))
+    if key is None :
+        return fnams
+    out = []
+    for fnam in fnams :
+        f = h5py.File(fnam, 'r')
+        if f.attrs.get('key', 0) == key :
+            out.append(fnam)
+        f.close()
+    return out
+
+def read_done(fnams):
+    """The set of (run, index) events in the checkpoint files."""
+    import h5py
+    done = set()
+    for fnam in fnams :
+        f = h5py.File(fnam, 'r')
+        done.update([tuple(e) for e in f['done'][()].tolist()])
+        f.close()
+    return done
+
+class Checkpoint(object):
+    """Save the accumulators of one rank every 'interval' seconds.
+
+    Args:
+        fnam (str): the output file name of the job.
+        rank (int): this rank.
+        interval (float or None): seconds between checkpoints, None for
+            no periodic checkpoints (save can still be called).
+        key (int): files are only resumed by ranks with the same key.
+    """
+    def __init__(self, fnam, rank, interval = 600., key = 0):
+        self.fnam     = checkpoint_fnam(fnam, rank)
+        self.interval = interval
+        self.key      = key
+        self.t_last   = time.time()
+        self.t_saving = 0.
+        self.saves    = 0
+
+    def due(self):
+        return self.interval is not None and self.interval > 0 and time.time() - self.t_last > self.interval
+
+    def save(self, write, done):
+        """Write the accumulators (write(f) for an open h5py.File f) and the done (run, index) events."""
+        import h5py
+        t0  = time.time()
+        tmp = self.fnam + '.tmp'
+        f   = h5py.File(tmp, 'w')
+        f.attrs['key'] = self.key
+        write(f)
+        f.create_dataset('done', data = np.array(done, dtype=np.int64).reshape((-1, 2)))
+        f.close()
+        os.rename(tmp, self.fnam)
+
+        self.t_last    = time.time()
+        self.t_saving += self.t_last - t0
+        self.saves    += 1
+
+    def remove(self):
+        if os.path.exists(self.fnam) :
+            os.remove(self.fnam)
+
+def resume(comm, fnam, key, load):
+    """Load the checkpoints of a previous job into the accumulators of the ranks in comm (collective).
+
+    The files with this key are shared round robin over the ranks of comm
+    and load(f) is called for each of them (f an open h5py.File, load should
+    add the state into the accumulators).
+
+    Returns:
+        done_before (set): (run, index) of every event in the files, skip these.
+        done (list): (run, index) of the events now in this ranks accumulators.
+    """
+    import h5py
+    fnams = checkpoint_files(fnam, key)
+    done  = []
+    for fnam in fnams[comm.Get_rank() :: comm.Get_size()]:
+        f = h5py.File(fnam, 'r')
+        load(f)
+        done += [tuple(e) for e in f['done'][()].tolist()]
+        f.close()
+    return read_done(fnams), done
+
+def remove_stale(fnam, size):
+    """Remove the checkpoint files of ranks >= size (left by a bigger job, call after every rank has saved)."""
+    for f in checkpoint_files(fnam):
+        rank = int(f.split('-checkpoint-rank')[-1].split('.')[0])
+        if rank >= size :
+            os.remove(f)
@@ -0,0 +1,90 @@
+"""
+Copy psana detector data into preallocated arrays.
+
+The detector kind is worked out once, from the first event:
+
+    im    = evt.get(detector_psana_type, detector_psana_source)
+    kind  = detector_kind(im)
+    shape, dtype = frame_shape(im, kind)
+
+after which each event is written straight into (a slice of) a buffer,
+without stacking the quads / frames into a new array first:
+
+    fill_frame(evt.get(detector_psana_type, detector_psana_source), kind, buffer[i])
+
+or added straight into an accumulator:
+
+    add_frame(evt.get(detector_psana_type, detector_psana_source), kind, im_sum)
+
+The kinds are:
+    'cspad' : im.quads(j).data() for j in range(im.quads_shape()[0]), e.g. (4, 8, 185, 388)
+    'pnccd' : im.frame(j).data() for j in range(im.frame_shape()[0]), e.g. (4, 512, 512)
+    'opal'  : im.data16(), e.g. (1024, 1024)
+"""
+
+def detector_kind(im):
+    """Return 'cspad', 'pnccd' or 'opal' for the detector data of an event."""
+    if im is None :
+        raise ValueError('no detector data in this event, check detector_psana_source and detector_psana_type')
+    try :
+        im.quads_shape()
+        return 'cspad'
+    except Exception :
+        pass
+    try :
+        im.frame_shape()
+        return 'pnccd'
+    except Exception :
+        pass
+    return 'opal'
+
+def panels(im, kind):
+    """Return a function k --> the k'th quad / frame of the detector (for 'opal' the whole frame)."""
+    if kind == 'cspad' :
+        return lambda k : im.quads(k).data()
+    elif kind == 'pnccd' :
+        return lambda k : im.frame(k).data()
+    else :
+        return lambda k : im.data16()
+
+def panel_count(im, kind):
+    if kind == 'cspad' :
+        return im.quads_shape()[0]
+    elif kind == 'pnccd' :
+        return im.frame_shape()[0]
+    else :
+        return None
+
+def frame_shape(im, kind):
+    """The shape (and numpy dtype) of one whole detector frame."""
+    n = panel_count(im, kind)
+    panel = panels(im, kind)(0)
+    if n is None :
+        return panel.shape, panel.dtype
+    return (n,) + panel.shape, panel.dtype
+
+def fill_frame(im, kind, out):
+    """Copy the detector data into out (of frame_shape) without any temporary arrays."""
+    if im is None :
+        raise ValueError('no detector data in this event')
+    n = panel_count(im, kind)
+    if n is None :
+        out[...] = im.data16()
+    else :
+        panel = panels(im, kind)
+        for k in range(n):
+            out[k] = panel(k)
+    return out
+
+def add_frame(im, kind, acc):
+    """Add the detector data straight into the accumulator acc (e.g. an int64 sum of frame_shape)."""
+    if im is None :
+        raise ValueError('no detector data in this event')
+    n = panel_count(im, kind)
+    if n is None :
+        acc += im.data16()
+    else :
+        panel = panels(im, kind)
+        for k in range(n):
+            acc[k] += panel(k)
+    return acc
@@ -0,0 +1,480 @@
+"""
+Open psana data sources, or a stand-in for psana that runs anywhere.
+
+    psana, ds = open_source(source)
+
+returns the psana module and psana.DataSource(source) for a normal psana
+source string (e.g. exp=cxi01516:run=10:idx), so the scripts keep working
+exactly as before. For the two stand-in sources:
+
+    synthetic:exp=test:run=1:detector=cspad:events=1000:rate=120
+    h5:exp=test:run=1:detector=cspad:fnam=frames.h5:dataset=data/data:rate=120
+
+it returns a module-like stand-in and a DataSource with the part of the
+psana interface that these scripts use:
+
+    ds.runs()                       --> runs
+    ds.env().epicsStore()           --> .value(name), .pvNames(), .aliases()
+    run.run(), run.times()          --> event times with .seconds(), .nanoseconds(), .fiducial()
+    run.event(t)                    --> evt
+    evt.get(psana.EventId)          --> the event id (str() looks like psana's)
+    evt.get(detector_type, source)  --> the detector with .quads(k).data() and .quads_shape() (cspad),
+                                        .frame(k).data() and .frame_shape() (pnccd) or .data16() (opal)
+    evt.get(psana.Bld.BldDataEBeamV7, src)            --> .ebeamPhotonEnergy(), .ebeamCharge(), .ebeamL3Energy()
+    evt.get(psana.Bld.BldDataFEEGasDetEnergyV1, src)  --> .f_11_ENRC(), .f_12_ENRC(), .f_21_ENRC(), .f_22_ENRC()
+    evt.keys()
+
+The stand-in has one detector, so evt.get returns it for any type that is
+not the EventId or a Bld type.
+
+Options of the stand-in sources:
+    exp, run  : the experiment name and run number (default 'test' and 1),
+                several runs are given like psana's e.g. run=3-5 or run=3,5
+                (run n starts at frame n - 1 of the bank).
+    detector  : 'cspad' (4, 8, 185, 388) int16, 'pnccd' (4, 512, 512) uint16
+                or 'opal' (1024, 1024) uint16.
+    events    : the number of events in the run (default 1000, for 'h5' the
+                default is the number of recorded frames, which are repeated
+                if events is larger).
+    rate      : deliver at most this many events per second to each process
+                (default 0, as fast as possible), e.g. 120 for the LCLS.
+    fnam, dataset : (h5 only) the recorded frames, an array of shape
+                (frames,) + detector shape. Scalars in the group 'epics' of
+                the file are served by the epics store.
+    seed      : (synthetic only) the random seed of the frames (default 0).
+
+The synthetic frames are a dark offset per pixel, gaussian noise and a few
+single photon hits. A small bank of them is made once and then cycled
+through, so making events costs (almost) nothing and the runs are
+repeatable. The frames are read-only, like psana's.
+"""
+
+import os
+import glob
+import time
+import numpy as np
+
+detector_shapes = {'cspad' : ((4, 8, 185, 388), np.int16), \
+                   'pnccd' : ((4, 512, 512),    np.uint16), \
+                   'opal'  : ((1024, 1024),     np.uint16)}
+
+def source_options(source):
+    """Split 'kind:key=value:key=value' into kind and a dictionary of options."""
+    items   = source.split(':')
+    options = {}
+    for item in items[1:]:
+        if '=' in item :
+            key, value = item.split('=', 1)
+            options[key] = value
+    return items[0], options
+
+def exp_run(source):
+    """The experiment name and run number (as strings) from any source string."""
+    items = dict([item.split('=', 1) for item in source.split(':') if '=' in item])
+    return items.get('exp', 'test'), items.get('run', '1')
+
+def run_numbers(run):
+    """The list of run numbers in a psana run string e.g. '14', '139-152' or '3,5,7-9' (or an int / list of ints)."""
+    if isinstance(run, (int, long, np.integer)) :
+        return [int(run)]
+    if not isinstance(run, str) :
+        return [int(r) for r in run]
+    runs = []
+    for item in run.split(','):
+        if '-' in item :
+            first, last = item.split('-')
+            runs += range(int(first), int(last) + 1)
+        else :
+            runs.append(int(item))
+    return runs
+
+def run_source(source, runs):
+    """The source string with its runs replaced by runs (a run number, a list of them or a psana run string)."""
+    if not isinstance(runs, str) :
+        runs = ','.join([str(r) for r in run_numbers(runs)])
+    items = [item for item in source.split(':') if not item.startswith('run=')]
+    return ':'.join(items[:1] + ['run=' + runs] + items[1:])
+
+def run_label(runs):
+    """'r0014' for one run and 'r0139-0152' for several (first and last), for output file names."""
+    runs = run_numbers(runs)
+    if len(runs) == 1 :
+        return 'r' + str(runs[0]).zfill(4)
+    return 'r' + str(min(runs)).zfill(4) + '-' + str(max(runs)).zfill(4)
+
+def first_event(numbers, times):
+    """The run number and time of the first event of the first of the runs numbers that has any (times[number] are the event times of each run)."""
+    for number in numbers :
+        if len(times[number]) > 0 :
+            return number, times[number][0]
+    raise ValueError('there are no events in run(s) ' + ', '.join([str(n) for n in numbers]))
+
+def xtc_dir(exp):
+    """Where the xtc files of an experiment are at the LCLS e.g. /reg/d/psdm/CXI/cxi01516/xtc."""
+    return os.path.join('/reg/d/psdm', exp[:3].upper(), exp, 'xtc')
+
+def run_signature(source, xtc = None):
+    """A string that changes when the data of the (one run) source changes, None if that is unknown.
+
+    For psana sources this is the names, sizes and modification times of the
+    xtc files of the run in xtc (default xtc_dir(exp)). The synthetic
+    stand-in is the same for the same source string and the h5 stand-in
+    changes with its file.
+    """
+    kind, options = source_options(source)
+    if kind == 'synthetic' :
+        return source
+    elif kind == 'h5' :
+        st = os.stat(options['fnam'])
+        return source + ',' + str(st.st_size) + ',' + str(int(st.st_mtime))
+
+    exp, run = exp_run(source)
+    if xtc is None :
+        xtc = xtc_dir(exp)
+    fnams = sorted(glob.glob(os.path.join(xtc, 'e*-r' + str(run).zfill(4) + '-s*-c*.xtc*')))
+    if len(fnams) == 0 :
+        return None
+    sig = []
+    for fnam in fnams :
+        st = os.stat(fnam)
+        sig.append(os.path.basename(fnam) + ',' + str(st.st_size) + ',' + str(int(st.st_mtime)))
+    return ';'.join(sig)
+
+def psana_obj_from_string(name, psana):
+    """Converts a string like 'psana.CsPad.DataV2' into the type in the psana (or stand-in) module."""
+    components = name.split('.')
+    if components[0] != 'psana' :
+        raise ValueError("psana types should start with 'psana.' (e.g. 'psana.CsPad.DataV2'): " + name)
+    mod = psana
+    for i in range(1, len(components)):
+        try :
+            mod = getattr(mod, components[i])
+        except AttributeError :
+            raise ValueError('psana has no type ' + name + ' (no ' + components[i] + ' in ' + '.'.join(components[:i]) + ')')
+    return mod
+
+def open_source(source):
+    """Return (psana module, data source) for a psana or stand-in source string (see the module doc string)."""
+    kind, options = source_options(source)
+    if kind in ['synthetic', 'h5'] :
+        return standin, DataSource(kind, **options)
+
+    import psana
+    return psana, psana.DataSource(source)
+
+#-----------------------------
+# the stand-in psana module
+#-----------------------------
+class Type(object):
+    """Stands in for a psana type such as psana.CsPad.DataV2."""
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') :
+            raise AttributeError(attr)
+        return Type(self.name + '.' + attr)
+
+    def __repr__(self):
+        return 'psana.' + self.name
+
+class Source(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+class EventTime(object):
+    def __init__(self, index, seconds, nanoseconds, fiducial):
+        self.index = index
+        self._seconds     = seconds
+        self._nanoseconds = nanoseconds
+        self._fiducial    = fiducial
+
+    def seconds(self):
+        return self._seconds
+
+    def nanoseconds(self):
+        return self._nanoseconds
+
+    def fiducial(self):
+        return self._fiducial
+
+class EventId(object):
+    def __init__(self, run, t):
+        self._run = run
+        self._time = t
+
+    def run(self):
+        return self._run
+
+    def time(self):
+        return (self._time.seconds(), self._time.nanoseconds())
+
+    def fiducials(self):
+        return self._time.fiducial()
+
+    def __str__(self):
+        # the same layout as psana, the time zone is always UTC
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self._time.seconds()))
+        return 'XtcEventId(run=' + str(self._run) + ', time=' + stamp + '.' + str(self._time.nanoseconds()).zfill(9) + \
+               '-00, fiducials=' + str(self._time.fiducial()) + ', ticks=0, vector=' + str(self._time.index) + ', control=0)'
+
+class Standin(object):
+    """Module-like stand-in for psana."""
+    Source    = Source
+    EventId   = EventId
+    EventTime = EventTime
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') :
+            raise AttributeError(attr)
+        return Type(attr)
+
+    def setOptions(self, options):
+        pass
+
+standin = Standin()
+
+class Array(object):
+    """A quad or frame, psana style (.data())."""
+    def __init__(self, data):
+        self._data = data
+
+    def data(self):
+        return self._data
+
+class Detector(object):
+    def __init__(self, kind, frame):
+        self.kind  = kind
+        self.frame_data = frame
+
+    def quads(self, k):
+        return Array(self.frame_data[k])
+
+    def quads_shape(self):
+        if self.kind != 'cspad' :
+            raise AttributeError('quads_shape')
+        return self.frame_data.shape[:1]
+
+    def frame(self, k):
+        return Array(self.frame_data[k])
+
+    def frame_shape(self):
+        if self.kind != 'pnccd' :
+            raise AttributeError('frame_shape')
+        return self.frame_data.shape[:1]
+
+    def data16(self):
+        return self.frame_data
+
+class EBeam(object):
+    def __init__(self, rng):
+        self.values = rng.normal(1., 1e-3, 3)
+
+    def ebeamPhotonEnergy(self):
+        return 9500. * self.values[0]
+
+    def ebeamCharge(self):
+        return 0.25 * self.values[1]
+
+    def ebeamL3Energy(self):
+        return 13500. * self.values[2]
+
+class GasDet(object):
+    def __init__(self, rng):
+        self.values = rng.gamma(4., 0.5, 4)
+
+    def f_11_ENRC(self):
+        return self.values[0]
+
+    def f_12_ENRC(self):
+        return self.values[1]
+
+    def f_21_ENRC(self):
+        return self.values[2]
+
+    def f_22_ENRC(self):
+        return self.values[3]
+
+class Key(object):
+    def __init__(self, t, src):
+        self._type = t
+        self._src  = src
+
+    def type(self):
+        return self._type
+
+    def src(self):
+        return self._src
+
+    def alias(self):
+        return ''
+
+    def key(self):
+        return ''
+
+    def __repr__(self):
+        return 'EventKey(type=' + str(self._type) + ', src=' + str(self._src) + ')'
+
+class Event(object):
+    """frame is a function that returns the detector frame of this event."""
+    def __init__(self, run, t, kind, frame):
+        self._id    = EventId(run, t)
+        self._t     = t
+        self._kind  = kind
+        self._frame = frame
+
+    def get(self, t, src = None):
+        if t is EventId :
+            return self._id
+        name = getattr(t, 'name', '')
+        # same values for the same event
+        rng  = np.random.RandomState(self._t.index)
+        if name.startswith('Bld.BldDataEBeam') :
+            return EBeam(rng)
+        if name.startswith('Bld.BldDataFEEGasDetEnergy') :
+            return GasDet(rng)
+        return Detector(self._kind, self._frame())
+
+    def keys(self):
+        return [Key('psana.EventId', ''), Key(repr(detector_types[self._kind]), 'DetInfo(Standin.0)'), \
+                Key('psana.Bld.BldDataEBeamV7', 'BldInfo(EBeam)'), \
+                Key('psana.Bld.BldDataFEEGasDetEnergyV1', 'BldInfo(FEEGasDetEnergy)')]
+
+detector_types = {'cspad' : Type('CsPad.DataV2'), 'pnccd' : Type('PNCCD.FramesV1'), 'opal' : Type('Camera.FrameV1')}
+
+class EpicsStore(object):
+    def __init__(self, values):
+        self.values = values
+
+    def value(self, name):
+        return self.values[name]
+
+    def pvNames(self):
+        return sorted(self.values.keys())
+
+    def aliases(self):
+        return []
+
+class Env(object):
+    def __init__(self, epics):
+        self.epics = epics
+
+    def epicsStore(self):
+        return self.epics
+
+class Run(object):
+    def __init__(self, ds, number):
+        self.ds = ds
+        self.number = number
+
+    def run(self):
+        return self.number
+
+    def times(self):
+        return [EventTime(i, self.ds.t0 + i / 120, (i % 120) * (10**9 / 120), 3 * i) for i in range(self.ds.events)]
+
+    def event(self, t):
+        self.ds.wait()
+        # the frame is only made / read when the detector is asked for
+        return Event(self.number, t, self.ds.detector, lambda : self.ds.frame(t.index + self.number - 1))
+
+class DataSource(object):
+    """Stand-in psana.DataSource, see the module doc string for the options."""
+    def __init__(self, kind, exp = 'test', run = 1, detector = 'cspad', events = None, rate = 0, \
+                 fnam = None, dataset = 'data/data', seed = 0, frames = 16):
+        if detector not in detector_shapes :
+            raise ValueError('unknown detector: ' + str(detector) + ' (use one of ' + str(detector_shapes.keys()) + ')')
+        self.exp      = exp
+        self.runs_list = run_numbers(run)
+        self.detector = detector
+        self.rate     = float(rate)
+        self.t0       = 1457640000
+        self.t_next   = 0.
+        shape, dtype  = detector_shapes[detector]
+
+        epics = {}
+        if kind == 'synthetic' :
+            # made on the first frame (scripts that only look at the times,
+            # the EBeam or the epics do not need any)
+            self.bank  = None
+            self.bank_args = (shape, dtype, int(frames), int(seed))
+            self.dset  = None
+            nframes    = int(frames)
+            default    = 1000
+        elif kind == 'h5' :
+            import h5py
+            if fnam is None :
+                raise ValueError("the h5 source needs a file name e.g. h5:fnam=frames.h5:dataset=data/data")
+            self.f     = h5py.File(fnam, 'r')
+            self.dset  = self.f[dataset]
+            nframes    = self.dset.shape[0]
+            default    = nframes
+            if self.dset.shape[1:] != shape and np.prod(self.dset.shape[1:]) != np.prod(shape) :
+                raise ValueError('the frames in ' + fnam + ':' + dataset + ' ' + str(self.dset.shape[1:]) + \
+                                 ' do not have the ' + detector + ' shape ' + str(shape))
+            if 'epics' in self.f :
+                for k in self.f['epics'].keys():
+                    epics[k] = self.f['epics'][k][()]
+        else :
+            raise ValueError("unknown stand-in source (should be 'synthetic' or 'h5'): " + str(kind))
+
+        self.shape   = shape
+        self.nframes = nframes
+        self.events  = int(events) if events is not None else default
+        self._env    = Env(EpicsStore(epics))
+
+    def frame(self, i):
+        if self.dset is None :
+            if self.bank is None :
+                self.bank = synthetic_frames(*self.bank_args)
+            return self.bank[i % self.nframes]
+        frame = self.dset[i % self.nframes].reshape(self.shape)
+        frame.setflags(write = False)
+        return frame
+
+    def wait(self):
+        # hold back the events to the requested rate
+        if self.rate > 0 :
+            now = time.time()
+            if self.t_next > now :
+                time.sleep(self.t_next - now)
+            self.t_next = max(now, self.t_next) + 1. / self.rate
+
+    def runs(self):
+        for number in self.runs_list :
+            yield Run(self, number)
+
+    def env(self):
+        return self._env
+
+def synthetic_frames(shape, dtype, frames = 16, seed = 0, dark = 1000., sigma = 5., adu = 30., photon_rate = 0.01):
+    """A bank of read-only detector frames: a dark offset per pixel plus noise and single photons."""
+    rng    = np.random.RandomState(seed)
+    offset = rng.normal(dark, 10. * sigma, shape).astype(np.float32)
+    bank   = []
+    for i in range(frames):
+        frame  = offset + rng.normal(0., sigma, shape).astype(np.float32)
+        frame += adu * (rng.random_sample(shape) < photon_rate)
+        frame  = np.rint(frame).astype(dtype)
+        frame.setflags(write = False)
+        bank.append(frame)
+    return bank
+
+if __name__ == '__main__':
+    # how fast the stand-in can deliver events on its own
+    for detector in ['cspad', 'pnccd', 'opal']:
+        psana, ds = open_source('synthetic:detector=' + detector + ':events=200')
+        run   = ds.runs().next()
+        times = run.times()
+        det_type = psana_obj_from_string('psana.' + detector_types[detector].name, psana)
+        # (make the frame bank first)
+        ds.frame(0)
+        t0 = time.time()
+        for t in times :
+            evt = run.event(t)
+            im  = evt.get(det_type, psana.Source('DetInfo(Standin.0)'))
+        t1 = time.time()
+        print '{0:6} : {1:8.0f} events per second'.format(detector, len(times) / (t1 - t0)), evt.get(psana.EventId)
@@ -0,0 +1,128 @@
+"""
+Detector layouts as precomputed index maps.
+
+A Geometry maps frames in the native psana shape (e.g. (4, 8, 185, 388) for
+a CsPad) to a 2D image and back. The maps are computed once, after which
+each transform is a single np.take, for one frame or a whole batch:
+
+    geom  = cspad_slab()
+    slab  = geom.to_image(frame)          # (4, 8, 185, 388)      --> (1480, 1552)
+    slabs = geom.to_image(frames)         # (n, 4, 8, 185, 388)   --> (n, 1480, 1552)
+    frame = geom.to_native(slab)          # (1480, 1552)          --> (4, 8, 185, 388)
+
+The layouts are:
+    cspad_slab()      : the quads side by side, each quad's 8 asics stacked
+                        in rows (the 'slab' of CsPadMaskMaker / cheetah).
+    pnccd()           : the 4 frames of a pnCCD in a 2x2 image, the bottom
+                        two rotated by 180 degrees (as psana assembles them).
+    from_pixel_maps() : an assembled image from per-pixel x, y coordinates,
+                        e.g. a cheetah style geometry file (read_pixel_maps).
+
+For an assembled image more than one native pixel can land on the same
+image pixel and some image pixels get none: to_image fills those with
+'fill', and to_native takes the image pixel nearest to each native pixel.
+"""
+
+import numpy as np
+
+class Geometry(object):
+    """Index maps between a native detector shape and a 2D image.
+
+    Args:
+        native_shape (tuple): the psana shape of one frame.
+        index (numpy.ndarray): image shaped, the flat native index of each
+            image pixel (-1 for image pixels without a native pixel).
+        inverse (numpy.ndarray): native shaped, the flat image index of each
+            native pixel.
+    """
+    def __init__(self, native_shape, index, inverse):
+        self.native_shape = tuple(native_shape)
+        self.image_shape  = index.shape
+        self.empty   = index < 0
+        self.index   = np.where(self.empty, 0, index).astype(np.intp)
+        self.inverse = inverse.reshape(self.native_shape).astype(np.intp)
+        if not np.any(self.empty) :
+            self.empty = None
+
+    def to_image(self, native, fill = 0, out = None):
+        """Native frame(s) of shape (...,) + native_shape --> image(s) of shape (...,) + image_shape."""
+        batch = native.shape[: native.ndim - len(self.native_shape)]
+        flat  = native.reshape(batch + (-1,))
+        image = np.take(flat, self.index, axis = -1, out = out)
+        if self.empty is not None :
+            image[..., self.empty] = fill
+        return image
+
+    def to_native(self, image, out = None):
+        """Image(s) of shape (...,) + image_shape --> native frame(s) of shape (...,) + native_shape."""
+        batch = image.shape[: image.ndim - 2]
+        flat  = image.reshape(batch + (-1,))
+        return np.take(flat, self.inverse, axis = -1, out = out)
+
+def from_index(native_shape, index):
+    """Make a Geometry from an image shaped map of flat native indices (-1 for empty pixels)."""
+    npix    = int(np.prod(native_shape))
+    inverse = np.zeros(npix, dtype=np.intp)
+    pixels  = np.flatnonzero(index.ravel() >= 0)
+    inverse[index.ravel()[pixels]] = pixels
+    return Geometry(native_shape, index, inverse)
+
+def cspad_slab(native_shape = (4, 8, 185, 388)):
+    """The CsPad quads side by side: (4, 8, 185, 388) --> (8 x 185, 4 x 388) = (1480, 1552)."""
+    quads, asics, rows, cols = native_shape
+    n = np.arange(np.prod(native_shape)).reshape((quads, asics * rows, cols))
+    index = np.concatenate([n[i] for i in range(quads)], axis = 1)
+    return from_index(native_shape, index)
+
+def pnccd(native_shape = (4, 512, 512)):
+    """The pnCCD frames in a 2x2 image: [[0, 3], [1 rotated 180, 2 rotated 180]] --> (1024, 1024)."""
+    n = np.arange(np.prod(native_shape)).reshape(native_shape)
+    top    = np.hstack((n[0], n[3]))
+    bottom = np.hstack((n[1][::-1, ::-1], n[2][::-1, ::-1]))
+    return from_index(native_shape, np.vstack((top, bottom)))
+
+def from_pixel_maps(x, y, pixel_size = 1., native_shape = None):
+    """Make an assembled image layout from per-pixel coordinates.
+
+    Args:
+        x, y (numpy.ndarray): the coordinates of each pixel (the column and
+            row directions of the image), in the native shape, or in the
+            CsPad slab shape (1480, 1552) in which case they are put into the
+            native shape first.
+        pixel_size (float): the size of one image pixel in the units of x, y.
+        native_shape (tuple): the native shape (default x.shape, or the CsPad
+            shape for slab shaped maps).
+    """
+    if native_shape is None :
+        native_shape = (4, 8, 185, 388) if x.shape == (1480, 1552) else x.shape
+    if x.shape == (1480, 1552) and tuple(native_shape) == (4, 8, 185, 388) :
+        slab = cspad_slab(native_shape)
+        x, y = slab.to_native(x), slab.to_native(y)
+
+    i = np.rint(y.ravel() / pixel_size).astype(np.intp)
+    j = np.rint(x.ravel() / pixel_size).astype(np.intp)
+    i -= i.min()
+    j -= j.min()
+    shape = (i.max() + 1, j.max() + 1)
+
+    index = -np.ones(shape, dtype=np.intp)
+    index[i, j] = np.arange(i.size)
+    inverse = i * shape[1] + j
+    return Geometry(native_shape, index, inverse)
+
+def read_pixel_maps(fnam, pixel_size = 110e-6, native_shape = None):
+    """Read a geometry file with 'x' and 'y' datasets (e.g. cheetah pixel maps in metres) into a Geometry."""
+    import h5py
+    f = h5py.File(fnam, 'r')
+    x = f['x'][()]
+    y = f['y'][()]
+    f.close()
+    return from_pixel_maps(x, y, pixel_size, native_shape)
+
+def native_geometry(kind, native_shape):
+    """The default image layout of a detector kind (see utils/detector.py), None if it is already an image."""
+    if kind == 'cspad' :
+        return cspad_slab(native_shape)
+    elif kind == 'pnccd' :
+        return pnccd(native_shape)
+    return None
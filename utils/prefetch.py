@@ -0,0 +1,181 @@
+"""
+Double buffered event reading.
+
+A background thread reads the next 'buffer_size' events into one of two
+preallocated buffers while the caller works on the other one, so that file
+reads and the numpy work overlap:
+
+    def read_event(t, out):
+        evt    = run.event(t)
+        out[:] = evt.get(detector_psana_type, detector_psana_source).data16()
+
+    reader = Prefetcher(read_event, run.times(), frame_shape, np.int16, 100)
+    for buffer, times in reader:
+        im_sum += np.sum(buffer, axis=0, dtype=np.int64)
+    print reader.report()
+
+read_event can be any function that writes an event into 'out' (or raises
+if it can't, in which case the event is counted as dropped) and the events
+can be any iterable, so this does not need psana (see the example at the
+bottom of this file). The buffer that is handed out is only valid until the
+next iteration.
+
+Note that the overlap is limited by the GIL: only the parts of the reading
+and of the numpy work that release it (most large numpy operations and
+file reads do) can run at the same time.
+"""
+
+import time
+import threading
+import Queue
+import numpy as np
+
+class Prefetcher(object):
+    """Iterate over (buffer, events) chunks read on a background thread.
+
+    Args:
+        read_event (callable): read_event(event, out) writes one event into out.
+        events (iterable): the events to read (e.g. psana times).
+        frame_shape (tuple): the shape of one event in the buffer.
+        dtype (numpy.dtype): the buffer data type.
+        buffer_size (int): the number of events in each buffer.
+        verbose (bool): print the exceptions of dropped events.
+        threaded (bool): read on a background thread. If False the events
+            are read in the calling thread (one buffer, no overlap), e.g.
+            when iterating over the events makes mpi calls and mpi does not
+            allow them from another thread.
+    """
+    def __init__(self, read_event, events, frame_shape, dtype, buffer_size, verbose = True, threaded = True):
+        self.read_event  = read_event
+        self.events      = events
+        self.buffer_size = buffer_size
+        self.verbose     = verbose
+        self.threaded    = threaded
+        nbuffers         = 2 if threaded else 1
+        self.buffers     = [np.empty((buffer_size,) + tuple(frame_shape), dtype=dtype) for i in range(nbuffers)]
+
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for i in range(len(self.buffers)):
+            self.free.put(i)
+
+        self.dropped       = 0
+        self.processed     = 0
+        self.read_time     = 0.
+        self.read_stall    = 0.
+        self.compute_time  = 0.
+        self.compute_stall = 0.
+        self.total_time    = 0.
+
+    def _fill(self, i, events):
+        """Read events into buffer i until it is full, return (n, ids, done)."""
+        n   = 0
+        ids = []
+        while n < self.buffer_size :
+            try :
+                event = next(events)
+            except StopIteration :
+                return n, ids, True
+            try :
+                self.read_event(event, self.buffers[i][n])
+                ids.append(event)
+                n += 1
+            except Exception as e :
+                if self.verbose : print e
+                self.dropped += 1
+        return n, ids, False
+
+    def _read(self):
+        try :
+            events = iter(self.events)
+            done   = False
+            while not done :
+                t0 = time.time()
+                i  = self.free.get()
+                self.read_stall += time.time() - t0
+
+                t0 = time.time()
+                n, ids, done = self._fill(i, events)
+                self.read_time += time.time() - t0
+
+                if n > 0 :
+                    self.full.put((i, n, ids))
+                else :
+                    self.free.put(i)
+            self.full.put(None)
+        except Exception as e :
+            # hand anything unexpected over to the main thread
+            self.full.put(e)
+
+    def __iter__(self):
+        if not self.threaded :
+            for chunk in self._iter_serial():
+                yield chunk
+            return
+
+        t_start = time.time()
+        thread  = threading.Thread(target = self._read)
+        thread.daemon = True
+        thread.start()
+        while True :
+            t0   = time.time()
+            item = self.full.get()
+            self.compute_stall += time.time() - t0
+            if item is None :
+                break
+            if isinstance(item, Exception) :
+                raise item
+
+            i, n, ids = item
+            t0 = time.time()
+            yield self.buffers[i][:n], ids
+            self.compute_time += time.time() - t0
+            self.processed    += n
+            self.free.put(i)
+        thread.join()
+        self.total_time += time.time() - t_start
+
+    def _iter_serial(self):
+        # read and compute in turn, so each stage waits for the other all the time
+        t_start = time.time()
+        events  = iter(self.events)
+        done    = False
+        while not done :
+            t0 = time.time()
+            n, ids, done = self._fill(0, events)
+            self.read_time     += time.time() - t0
+            self.compute_stall += time.time() - t0
+            if n > 0 :
+                t0 = time.time()
+                yield self.buffers[0][:n], ids
+                self.compute_time += time.time() - t0
+                self.read_stall   += time.time() - t0
+                self.processed    += n
+        self.total_time += time.time() - t_start
+
+    def stalls(self):
+        """Return the percentage of the time that the reader and the compute stage were stalled."""
+        total = max(self.total_time, 1e-12)
+        return 100. * self.read_stall / total, 100. * self.compute_stall / total
+
+    def report(self):
+        read_stall, compute_stall = self.stalls()
+        return 'events: {0} dropped: {1} time: {2:.1f}s  read stalled: {3:.1f}%  compute stalled: {4:.1f}%'.format(\
+               self.processed, self.dropped, self.total_time, read_stall, compute_stall)
+
+if __name__ == '__main__':
+    # an example without psana: 'reading' and 'computing' take the same time
+    # so with the overlap the total should be close to half the serial time
+    def read_event(t, out):
+        time.sleep(0.002)
+        out[:] = t
+
+    reader = Prefetcher(read_event, range(1000), (100, 100), np.float32, 50)
+    total  = 0.
+    for buffer, events in reader:
+        time.sleep(0.002 * buffer.shape[0])
+        total += np.sum(buffer[:, 0, 0])
+
+    print 'sum of events:', total, '(should be', np.sum(range(1000)), ')'
+    print 'serial time would be about: {0:.1f}s'.format(1000 * 0.004)
+    print reader.report()
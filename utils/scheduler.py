@@ -0,0 +1,76 @@
+"""
+Hand out chunks of events to mpi ranks on demand.
+
+Rather than giving every rank len(events) / size events up front (which
+drops the remainder and makes everyone wait for the slowest node), rank 0
+exposes a single counter with mpi one-sided communication and each rank
+atomically takes the next 'chunk_size' events from it whenever it needs
+more work. No rank has to answer requests, so rank 0 works like the others.
+
+    counter = SharedCounter(comm)
+    for start, stop in dynamic_chunks(counter, len(times), chunk_size):
+        ... process times[start : stop]
+    counter.free()
+
+Every event is handed out exactly once and fast ranks simply take more
+chunks.
+"""
+
+import numpy as np
+
+class SharedCounter(object):
+    """An int64 counter on the root rank that any rank can atomically add to.
+
+    Creating (and freeing) the counter is collective over comm.
+    """
+    def __init__(self, comm, root = 0):
+        from mpi4py import MPI
+        self.MPI  = MPI
+        self.root = root
+        if comm.Get_rank() == root :
+            self.value = np.zeros(1, dtype=np.int64)
+            self.win   = MPI.Win.Create(self.value, disp_unit = self.value.itemsize, comm = comm)
+        else :
+            self.value = None
+            self.win   = MPI.Win.Create(None, disp_unit = 8, comm = comm)
+
+        self.incr   = np.zeros(1, dtype=np.int64)
+        self.result = np.zeros(1, dtype=np.int64)
+
+    def fetch_add(self, n):
+        """Add n to the counter and return the value before the addition."""
+        MPI = self.MPI
+        self.incr[0] = n
+        self.win.Lock(self.root, MPI.LOCK_SHARED)
+        self.win.Fetch_and_op([self.incr, MPI.INT64_T], [self.result, MPI.INT64_T], self.root, 0, MPI.SUM)
+        self.win.Unlock(self.root)
+        return int(self.result[0])
+
+    def free(self):
+        self.win.Free()
+
+def dynamic_chunks(counter, n, chunk_size):
+    """Yield (start, stop) ranges of [0, n) taken from the shared counter until there are none left."""
+    while True :
+        start = counter.fetch_add(chunk_size)
+        if start >= n :
+            return
+        yield start, min(start + chunk_size, n)
+
+def report_load(comm, events, seconds, root = 0):
+    """Print the events per second of every rank and the load imbalance on the root rank.
+
+    The load imbalance is max(t) / mean(t) - 1 where t is the time each rank
+    spent processing (0% means everyone finished together).
+    """
+    loads = comm.gather((events, seconds), root = root)
+    if comm.Get_rank() == root :
+        events  = np.array([l[0] for l in loads], dtype=np.float64)
+        seconds = np.array([l[1] for l in loads], dtype=np.float64)
+        print '\nrank  events  seconds  events/s'
+        for r in range(len(loads)):
+            print '{0:4d} {1:7d} {2:8.1f} {3:9.1f}'.format(r, int(events[r]), seconds[r], events[r] / max(seconds[r], 1e-12))
+        print 'total events: {0:d}  events/s: {1:.1f}  load imbalance: {2:.1f}%'.format(\
+              int(np.sum(events)), np.sum(events) / max(np.max(seconds), 1e-12), \
+              100. * (np.max(seconds) / max(np.mean(seconds), 1e-12) - 1.))
+    return loads